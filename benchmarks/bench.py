@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the probing, publishing and ingesting paths.
+
+Everything runs locally by default: probes go to a FakeHTTPFarm and
+statuses flow through a FakeBroker into a StubStore (see fakes.py).
+If Kafka and/or PostgreSQL are configured (same environment variables
+used by spy and spycollect) KafkaPublisher/KafkaSubscriber and
+PostgreSQLStore are benchmarked too, against the real services.
+
+Results are written as JSON, so they can be compared across runs.
+"""
+
+import sys
+import json
+import time
+import asyncio
+import asyncpg
+import argparse
+import platform
+import multiprocessing
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+
+from config.loaders import load_kafka_config
+from config.loaders import load_postgresql_config
+from health import codec
+from health import rollup
+from health.checker import HealthCheck
+from health.checker import HealthChecker
+from health.collector import HealthCollector
+from health.probes import Offload
+from health.probes import http_probe
+from health.probes import new_pooled_client
+from health.pubsub import KafkaPublisher
+from health.pubsub import KafkaSubscriber
+from health.status import HealthStatus
+from health.storage import PostgreSQLStore
+
+from fakes import BODY_MARKER
+from fakes import FakeBroker
+from fakes import FakeHTTPFarm
+from fakes import FakePublisher
+from fakes import FakeSubscriber
+from fakes import StubStore
+
+
+# Schema where the PostgreSQL benchmark saves the statuses, on copies of
+# the store tables, it is dropped after the benchmark.
+SCRATCH_SCHEMA = "spyglass_benchmark"
+
+STORE_TABLES = (
+    "spyglass_targets",
+    "spyglass_health_status",
+    *[table for table, _ in rollup.RESOLUTIONS.values()],
+)
+
+
+async def bench_http_probe(farm, probes, concurrency, warm):
+    urls = farm.urls(concurrency)
+    patterns = [BODY_MARKER.decode()]
+    client = new_pooled_client() if warm else None
+    statuses = []
+
+    async def prober(url, count):
+        for _ in range(count):
+            statuses.append(await http_probe(url, patterns, client))
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[
+            prober(url, probes // concurrency) for url in urls])
+    finally:
+        if client is not None:
+            await client.aclose()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "probes": len(statuses),
+        "probes_per_sec": len(statuses) / elapsed,
+        "healthy": sum(1 for s in statuses if s.healthy),
+        "response_time_ms_p50": _percentile(
+            [s.response_time_ms for s in statuses], 50),
+        "response_time_ms_p99": _percentile(
+            [s.response_time_ms for s in statuses], 99),
+    }
+
+
+async def bench_http_probe_offload(farm, probes, concurrency, processes):
+    urls = farm.urls(concurrency)
+    # WHY: the pattern is tried at each position of the body, so
+    # matching is CPU bound, like for big bodies with costly patterns.
+    patterns = ["x{1,50}" + BODY_MARKER.decode()]
+    client = new_pooled_client()
+    statuses = []
+    gaps = []
+    offload = None
+    if processes is not None:
+        context = multiprocessing.get_context("spawn")
+        executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=context)
+        # WHY: the processes are started before measuring
+        for _ in range(processes):
+            executor.submit(time.time).result()
+        offload = Offload(executor=executor, min_bytes=1)
+
+    async def prober(url, count):
+        for _ in range(count):
+            statuses.append(await http_probe(
+                url, patterns, client, offload=offload))
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            gaps.append(loop.time() - start)
+
+    ticking = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[
+            prober(url, probes // concurrency) for url in urls])
+    finally:
+        elapsed = time.perf_counter() - start
+        ticking.cancel()
+        await client.aclose()
+        if offload is not None:
+            offload.executor.shutdown()
+
+    return {
+        "probes": len(statuses),
+        "probes_per_sec": len(statuses) / elapsed,
+        "healthy": sum(1 for s in statuses if s.healthy),
+        "loop_lag_ms_p99": _percentile([g * 1000 for g in gaps], 99),
+        "loop_lag_ms_max": max(gaps, default=0) * 1000,
+    }
+
+
+async def bench_checker(farm, checks, period_sec, duration_sec, workers):
+    urls = farm.urls(checks)
+    broker = FakeBroker()
+    publisher = FakePublisher(broker)
+    timestamps = {}
+
+    async def handler(url, status):
+        timestamps.setdefault(url, []).append(status.timestamp)
+        await publisher.publish(url, status)
+
+    checker = HealthChecker(
+        handler,
+        [HealthCheck(url=url, period_sec=period_sec) for url in urls],
+        workers=workers,
+    )
+    tasks = checker.start()
+    await asyncio.sleep(duration_sec)
+    checker.stop()
+
+    # WHY: cancelling probes in flight is not reliable (see
+    # health.multiproc), the tasks are given time to finish first.
+    _, pending = await asyncio.wait(tasks, timeout=2 * period_sec)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending, timeout=period_sec)
+    await checker.close()
+
+    # WHY: jitter is how far the interval between two probes
+    # of the same check is from its period.
+    jitter_ms = []
+    for probe_timestamps in timestamps.values():
+        for prev, cur in zip(probe_timestamps, probe_timestamps[1:]):
+            interval = (cur - prev).total_seconds()
+            jitter_ms.append(abs(interval - period_sec) * 1000)
+
+    # WHY: jitter needs several probes of each check, without them
+    # it is reported as None instead of a misleading 0.
+    probes_per_check = [len(timestamps.get(url, [])) for url in urls]
+    if min(probes_per_check) < 3:
+        jitter_ms = []
+
+    probes = sum(probes_per_check)
+    return {
+        "probes": probes,
+        "probes_per_sec": probes / duration_sec,
+        "expected_probes_per_sec": checks / period_sec,
+        "min_probes_per_check": min(probes_per_check),
+        "published": broker.count(),
+        "jitter_ms_p50": _percentile(jitter_ms, 50),
+        "jitter_ms_p99": _percentile(jitter_ms, 99),
+        "jitter_ms_max": max(jitter_ms, default=None),
+    }
+
+
+async def bench_fake_publish(statuses, encoding):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, encoding)
+
+    start = time.perf_counter()
+    for url, status in statuses:
+        await publisher.publish(url, status)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "published": broker.count(),
+        "publish_per_sec": broker.count() / elapsed,
+    }
+
+
+async def bench_fake_ingest(statuses, encoding, writers, batch_size,
+                            store_latency_sec):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, encoding)
+    for url, status in statuses:
+        await publisher.publish(url, status)
+
+    subscriber = FakeSubscriber(broker)
+    store = StubStore(latency_sec=store_latency_sec)
+    collector = HealthCollector(
+        subscriber, store, writers=writers, batch_size=batch_size)
+
+    start = time.perf_counter()
+    await collector.run()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "rows": store.rows,
+        "rows_per_sec": store.rows / elapsed,
+        "commits": subscriber.commits,
+    }
+
+
+async def bench_kafka(cfg, statuses, encoding, linger_ms):
+    topic = "spyglass.benchmark.health.status"
+    publisher = KafkaPublisher(
+        cfg.uri, cfg.ssl_cafile, cfg.ssl_cert, cfg.ssl_keyfile, topic,
+        linger_ms=linger_ms, encoding=encoding)
+    subscriber = KafkaSubscriber(
+        cfg.uri, cfg.ssl_cafile, cfg.ssl_cert, cfg.ssl_keyfile, topic)
+
+    await publisher.start()
+    try:
+        start = time.perf_counter()
+        for url, status in statuses:
+            await publisher.publish(url, status)
+    finally:
+        # WHY: stopping flushes the pending batches, so
+        # they are accounted on the publishing time.
+        await publisher.stop()
+    publish_elapsed = time.perf_counter() - start
+
+    consumed = 0
+    await subscriber.start()
+    try:
+        start = time.perf_counter()
+        batches = subscriber.batches()
+        while consumed < len(statuses):
+            batch = await asyncio.wait_for(batches.__anext__(), 30)
+            consumed += sum(len(msgs) for msgs in batch.values())
+        consume_elapsed = time.perf_counter() - start
+    finally:
+        await subscriber.stop()
+
+    return {
+        "published": len(statuses),
+        "publish_per_sec": len(statuses) / publish_elapsed,
+        "consumed": consumed,
+        "consume_per_sec": consumed / consume_elapsed,
+    }
+
+
+async def bench_postgresql(cfg, statuses, writers, batch_size):
+    conn = await asyncpg.connect(cfg.uri)
+    try:
+        await _create_scratch_tables(conn)
+        store = PostgreSQLStore(_scratch_uri(cfg.uri), pool_size=writers)
+        await store.connect()
+        metrics = await _save_statuses(store, statuses, writers, batch_size)
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        await conn.close()
+
+    # WHY: statuses are unique, discarded ones mean the benchmark is
+    # measuring duplicates being dropped instead of inserts.
+    metrics["discarded"] = len(statuses) - metrics["rows"]
+    return metrics
+
+
+async def run(scale, external):
+    results = []
+
+    async def record(name, params, bench, **context):
+        # WHY: the context is informed along with the params,
+        # but it is not passed to the benchmark (eg: the farm config).
+        print(f"running {name} {params} {context}", file=sys.stderr)
+        results.append({
+            "name": name,
+            "params": dict(context, **params),
+            "metrics": await bench(**params),
+        })
+
+    farms = (
+        {"body_size": 1024, "latency_sec": 0, "status_codes": (200,)},
+        {"body_size": 512 * 1024, "latency_sec": 0, "status_codes": (200,)},
+        {"body_size": 1024, "latency_sec": 0.05, "status_codes": (200, 503)},
+    )
+    for farm_cfg in farms:
+        farm = FakeHTTPFarm(**farm_cfg)
+        await farm.start()
+        try:
+            for warm in (False, True):
+                await record(
+                    "http_probe",
+                    {"probes": 200 * scale, "concurrency": 20, "warm": warm},
+                    lambda **p: bench_http_probe(farm, **p),
+                    **farm_cfg,
+                )
+            # WHY: offloading only pays off for big bodies, the loop
+            # lag shows how long other probes wait on matching.
+            for processes in (None, 4):
+                if farm_cfg["body_size"] < 64 * 1024:
+                    break
+                await record(
+                    "http_probe_offload",
+                    {
+                        "probes": 40 * scale,
+                        "concurrency": 4,
+                        "processes": processes,
+                    },
+                    lambda **p: bench_http_probe_offload(farm, **p),
+                    **farm_cfg,
+                )
+            for workers in (None, 20):
+                # WHY: long enough for each check to be probed about
+                # 10 times, so the jitter is meaningful, with a load
+                # a single core sustains (cold probes are CPU bound).
+                params = {
+                    "checks": 20 * scale,
+                    "period_sec": 1,
+                    "duration_sec": 10,
+                    "workers": workers,
+                }
+                await record(
+                    "health_checker",
+                    params,
+                    lambda **p: bench_checker(farm, **p),
+                    **farm_cfg,
+                )
+        finally:
+            await farm.stop()
+
+    statuses = _statuses(10000 * scale)
+    for encoding in codec.ENCODINGS:
+        await record(
+            "fake_publish",
+            {"encoding": encoding},
+            lambda **p: bench_fake_publish(statuses, **p),
+        )
+        for writers, batch_size in ((1, None), (4, 500)):
+            await record(
+                "fake_ingest",
+                {
+                    "encoding": encoding,
+                    "writers": writers,
+                    "batch_size": batch_size,
+                    "store_latency_sec": 0.001,
+                },
+                lambda **p: bench_fake_ingest(statuses, **p),
+            )
+
+    if not external:
+        return results
+
+    kafka_cfg, err = load_kafka_config()
+    if err is None:
+        for linger_ms in (None, 100):
+            await record(
+                "kafka_pubsub",
+                {"encoding": codec.COMPACT_V1, "linger_ms": linger_ms},
+                lambda **p: bench_kafka(
+                    kafka_cfg, statuses[:1000 * scale], **p),
+            )
+    else:
+        print("skipping kafka benchmarks, no kafka config", file=sys.stderr)
+
+    pgcfg, err = load_postgresql_config()
+    if err is None:
+        await record(
+            "postgresql_store",
+            {"writers": 4, "batch_size": 500},
+            lambda **p: bench_postgresql(pgcfg, statuses, **p),
+        )
+    else:
+        print("skipping postgresql benchmarks, no config", file=sys.stderr)
+
+    return results
+
+
+async def _create_scratch_tables(conn):
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+    for table in STORE_TABLES:
+        await conn.execute(f'''
+            CREATE TABLE {SCRATCH_SCHEMA}.{table}
+            (LIKE {table} INCLUDING ALL)
+        ''')
+    # WHY: the copied default of the target ids would use (and advance)
+    # the sequence of the real targets table.
+    await conn.execute(f'''
+        CREATE SEQUENCE {SCRATCH_SCHEMA}.spyglass_targets_id_seq
+        OWNED BY {SCRATCH_SCHEMA}.spyglass_targets.id
+    ''')
+    await conn.execute(f'''
+        ALTER TABLE {SCRATCH_SCHEMA}.spyglass_targets ALTER COLUMN id
+        SET DEFAULT nextval('{SCRATCH_SCHEMA}.spyglass_targets_id_seq')
+    ''')
+
+
+def _scratch_uri(uri):
+    # WHY: asyncpg sends unknown query parameters as server
+    # settings, so the store finds the scratch tables first.
+    separator = "&" if urlparse(uri).query else "?"
+    return f"{uri}{separator}search_path={SCRATCH_SCHEMA},public"
+
+
+async def _save_statuses(store, statuses, writers, batch_size):
+    batches = [
+        statuses[i:i + batch_size]
+        for i in range(0, len(statuses), batch_size)
+    ]
+    queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+
+    async def writer():
+        rows = 0
+        while not queue.empty():
+            rows += await store.save_many(queue.get_nowait())
+        return rows
+
+    try:
+        start = time.perf_counter()
+        rows = await asyncio.gather(*[writer() for _ in range(writers)])
+        elapsed = time.perf_counter() - start
+    finally:
+        await store.disconnect()
+
+    return {
+        "rows": sum(rows),
+        "rows_per_sec": sum(rows) / elapsed,
+    }
+
+
+def _statuses(count):
+    # WHY: each status has its own timestamp, statuses of the same
+    # url with the same timestamp are duplicates (and discarded).
+    now = datetime.now(timezone.utc)
+    return [
+        (
+            f"https://benchmark.spyglass/check/{i % 100}",
+            HealthStatus(
+                timestamp=now + timedelta(microseconds=i),
+                healthy=True,
+                response_time_ms=1 + i % 500,
+                status_code=200,
+                error=None,
+                connection_reused=i % 2 == 0,
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+def _percentile(values, percentile):
+    if values == []:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percentile / 100))
+    return values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--scale", type=int, default=1,
+        help="multiplies the amount of work done by each benchmark")
+    parser.add_argument(
+        "--output", default="-",
+        help="file where the JSON results are written (default stdout)")
+    parser.add_argument(
+        "--external", action="store_true",
+        help="also benchmark Kafka and PostgreSQL, if they are configured")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.scale, args.external))
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "results": results,
+    }
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
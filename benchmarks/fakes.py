@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+from http import HTTPStatus
+
+from health import codec
+from health import rollup
+from health import storage
+from health.pubsub import HealthMessage
+
+
+# Marker at the end of the bodies served by the FakeHTTPFarm, so
+# patterns matching it need to search the whole body.
+BODY_MARKER = b"healthy"
+
+
+class FakeHTTPFarm:
+    """
+    A farm of local HTTP servers standing in for the probed websites.
+
+    Each server answers any request after latency_sec with a body of
+    body_size bytes (ending with BODY_MARKER). The status codes of the
+    responses cycle through the given status_codes. Connections are
+    kept alive, so warm probes can reuse them.
+    """
+
+    def __init__(self, servers=4, latency_sec=0, body_size=1024,
+                 status_codes=(200,)):
+        self.__servers_count = servers
+        self.__latency_sec = latency_sec
+        self.__body = b"x" * max(body_size - len(BODY_MARKER), 0)
+        self.__body += BODY_MARKER
+        self.__status_codes = itertools.cycle(status_codes)
+        self.__servers = []
+        self.requests = 0
+
+    async def start(self):
+        for _ in range(self.__servers_count):
+            server = await asyncio.start_server(
+                self.__handle, "127.0.0.1", 0)
+            self.__servers.append(server)
+
+    async def stop(self):
+        for server in self.__servers:
+            server.close()
+            await server.wait_closed()
+        self.__servers = []
+
+    def urls(self, count):
+        """
+        Returns count distinct urls spread across the servers.
+        """
+        ports = [s.sockets[0].getsockname()[1] for s in self.__servers]
+        return [
+            f"http://127.0.0.1:{ports[i % len(ports)]}/check/{i}"
+            for i in range(count)
+        ]
+
+    async def __handle(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                code = next(self.__status_codes)
+                if self.__latency_sec > 0:
+                    await asyncio.sleep(self.__latency_sec)
+                writer.write(
+                    f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n"
+                    f"Content-Length: {len(self.__body)}\r\n"
+                    "Content-Type: text/plain; charset=utf-8\r\n"
+                    "\r\n".encode() + self.__body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeBroker:
+    """
+    In memory stand-in for a Kafka topic with the given number of
+    partitions, messages are assigned to partitions by url.
+    """
+
+    def __init__(self, partitions=4):
+        self.partitions = [[] for _ in range(partitions)]
+
+    def append(self, url, value, encoding):
+        partition = self.partitions[hash(url) % len(self.partitions)]
+        partition.append((value, encoding))
+
+    def count(self):
+        return sum(len(p) for p in self.partitions)
+
+
+class FakePublisher:
+    """
+    Same interface as health.pubsub.KafkaPublisher, statuses are
+    encoded and appended to a FakeBroker.
+    """
+
+    def __init__(self, broker, encoding=codec.JSON):
+        self.__broker = broker
+        self.__encoding = encoding
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, url, status):
+        value = codec.encode(url, status, self.__encoding)
+        await self.publish_encoded(url, value)
+
+    async def publish_encoded(self, url, value):
+        self.__broker.append(url, value, self.__encoding)
+
+
+class FakeSubscriber:
+    """
+    Same interface as health.pubsub.KafkaSubscriber (batches, ack and
+    commit), it consumes all the messages on a FakeBroker, decoding
+    them, and then stops.
+    """
+
+    def __init__(self, broker, max_records=500):
+        self.__broker = broker
+        self.__max_records = max_records
+        self.acked = 0
+        self.commits = 0
+
+    async def batches(self):
+        positions = [0] * len(self.__broker.partitions)
+        while True:
+            batch = {}
+            remaining = self.__max_records
+            for i, partition in enumerate(self.__broker.partitions):
+                start = positions[i]
+                end = min(start + remaining, len(partition))
+                if start == end:
+                    continue
+                batch[i] = [
+                    _message(value, encoding, i, offset)
+                    for offset, (value, encoding) in enumerate(
+                        partition[start:end], start)
+                ]
+                positions[i] = end
+                remaining -= end - start
+                if remaining == 0:
+                    break
+
+            if batch == {}:
+                return
+            yield batch
+            # WHY: gives the writers a chance to run, as a real
+            # subscriber would while waiting for the network.
+            await asyncio.sleep(0)
+
+    def ack(self, health_msg):
+        self.acked += 1
+
+    async def commit(self):
+        self.commits += 1
+
+
+class StubStore:
+    """
+    Same interface as health.storage.PostgreSQLStore (save and
+    save_many), it does the same work the store does before going
+    to the database (records and rollups) and waits latency_sec
+    for each save, as if it was the database round trip.
+    """
+
+    def __init__(self, latency_sec=0):
+        self.__latency_sec = latency_sec
+        self.__target_ids = {}
+        self.rows = 0
+
+    async def save(self, url, health_status):
+        await self.save_many([(url, health_status)])
+
+    async def save_many(self, statuses):
+        records = [
+            storage._to_record(self.__target_id(url), status)
+            for url, status in statuses
+        ]
+        for resolution in rollup.RESOLUTIONS:
+            rollup.rollup(records, resolution)
+        if self.__latency_sec > 0:
+            await asyncio.sleep(self.__latency_sec)
+        self.rows += len(records)
+        return len(records)
+
+    def __target_id(self, url):
+        target_id = self.__target_ids.get(url)
+        if target_id is None:
+            target_id = len(self.__target_ids) + 1
+            self.__target_ids[url] = target_id
+        return target_id
+
+
+def _message(value, encoding, partition, offset):
+    url, status = codec.decode(value, encoding)
+    return HealthMessage(
+        url=url, status=status, partition=partition, offset=offset)
@@ -1,8 +1,14 @@
 import os
+import re
 import json
 from collections import namedtuple
 
+from health import codec
+from health import probes
 from health.checker import HealthCheck
+from health.errors import InvalidParamsError
+from health.sharding import Shards
+from health.storage import PARTITION_INTERVALS
 
 
 KafkaConfig = namedtuple('KafkaConfig', [
@@ -10,6 +16,23 @@ KafkaConfig = namedtuple('KafkaConfig', [
 
 PostgreSQLConfig = namedtuple('PostgreSQLConfig', ['uri'])
 
+StorageConfig = namedtuple('StorageConfig', [
+    'writers', 'batch_size', 'batch_max_delay_ms', 'max_retries',
+    'partition_interval', 'partition_premake', 'retention_hours'])
+
+KafkaPublisherConfig = namedtuple('KafkaPublisherConfig', [
+    'linger_ms', 'max_batch_size', 'compression_type', 'encoding'])
+
+KafkaSubscriberConfig = namedtuple('KafkaSubscriberConfig', [
+    'dead_letter_topic'])
+
+CheckerConfig = namedtuple('CheckerConfig', [
+    'workers', 'max_in_flight', 'max_in_flight_per_host', 'reload_sec',
+    'shard', 'shards', 'processes', 'coalesce_window_ms',
+    'offload_min_bytes', 'offload_processes'])
+
+MetricsConfig = namedtuple('MetricsConfig', ['host', 'port'])
+
 
 def load_kafka_config():
     """
@@ -50,6 +73,63 @@ def load_kafka_config():
         uri=uri, ssl_cafile=cafile, ssl_cert=cert, ssl_keyfile=privkey), None
 
 
+def load_kafka_publisher_config():
+    """
+    Loads kafka publisher tuning config from the environment.
+
+    All the configurations are optional, if an invalid value is
+    provided an informational string is returned as a second
+    return value, it can be used to provide help to the caller.
+    """
+
+    invalid = []
+    linger_ms = _load_int_from_env(
+        "SPYGLASS_KAFKA_PUBLISH_LINGER_MS",
+        "Time to wait batching statuses (enables batching)",
+        invalid,
+    )
+    max_batch_size = _load_int_from_env(
+        "SPYGLASS_KAFKA_PUBLISH_BATCH_BYTES",
+        "Max size of a batch of statuses in bytes",
+        invalid,
+    )
+    compression_type = os.environ.get("SPYGLASS_KAFKA_PUBLISH_COMPRESSION")
+    if compression_type not in (None, "gzip", "snappy", "lz4"):
+        invalid.append(
+            "SPYGLASS_KAFKA_PUBLISH_COMPRESSION : Compression of batches"
+            " : must be one of gzip, snappy or lz4")
+
+    encoding = os.environ.get("SPYGLASS_KAFKA_PUBLISH_ENCODING", codec.JSON)
+    if encoding not in codec.ENCODINGS:
+        encodings = ", ".join(codec.ENCODINGS)
+        invalid.append(
+            "SPYGLASS_KAFKA_PUBLISH_ENCODING : Encoding of statuses"
+            f" : must be one of {encodings}")
+
+    if invalid != []:
+        errmsg = "\nInvalid environment variables for kafka publisher config:"
+        return None, errmsg + "\n\n" + "\n".join(invalid)
+
+    return KafkaPublisherConfig(
+        linger_ms=linger_ms,
+        max_batch_size=max_batch_size,
+        compression_type=compression_type,
+        encoding=encoding,
+    ), None
+
+
+def load_kafka_subscriber_config():
+    """
+    Loads kafka subscriber config from the environment.
+
+    All the configurations are optional, so no informational
+    string is ever returned (it is always None).
+    """
+
+    dead_letter_topic = os.environ.get("SPYGLASS_KAFKA_DEAD_LETTER_TOPIC")
+    return KafkaSubscriberConfig(dead_letter_topic=dead_letter_topic), None
+
+
 def load_health_check_config():
     missing = []
     cfgpath = _load_from_env(
@@ -66,13 +146,29 @@ def load_health_check_config():
         with open(cfgpath, "r") as cfgfile:
             parsed_cfg = json.loads(cfgfile.read())
             checks = []
+            invalid = []
             for probe in parsed_cfg["probes"]:
+                patterns = []
+                for pattern in probe.get("patterns", []):
+                    try:
+                        patterns.append(probes.compile_pattern(pattern))
+                    except re.error as err:
+                        invalid.append(
+                            f"{probe['url']} : pattern '{pattern}' : {err}")
                 checks.append(HealthCheck(
                     url=probe["url"],
                     period_sec=probe["period_sec"],
-                    patterns=probe.get("patterns", []),
+                    patterns=patterns,
+                    warm=probe.get("warm", False),
+                    max_body_bytes=probe.get("max_body_bytes"),
+                    max_period_sec=probe.get("max_period_sec"),
+                    dns_cache=probe.get("dns_cache", False),
+                    method=probe.get("method", probes.GET),
                     )
                 )
+            if invalid != []:
+                errmsg = f"\nInvalid patterns on configuration:'{cfgpath}':"
+                return None, errmsg + "\n\n" + "\n".join(invalid)
             return checks, None
 
     except Exception as err:
@@ -80,6 +176,103 @@ def load_health_check_config():
         return None, m
 
 
+def load_checker_config():
+    """
+    Loads health checker tuning config from the environment.
+
+    All the configurations are optional, if an invalid value is
+    provided an informational string is returned as a second
+    return value, it can be used to provide help to the caller.
+    """
+
+    invalid = []
+    workers = _load_int_from_env(
+        "SPYGLASS_PROBE_WORKERS",
+        "Number of probe workers (enables the heap scheduler)",
+        invalid,
+    )
+    max_in_flight = _load_int_from_env(
+        "SPYGLASS_PROBE_MAX_IN_FLIGHT",
+        "Max number of probes in flight",
+        invalid,
+    )
+    max_in_flight_per_host = _load_int_from_env(
+        "SPYGLASS_PROBE_MAX_IN_FLIGHT_PER_HOST",
+        "Max number of probes in flight for a single host",
+        invalid,
+    )
+    reload_sec = _load_int_from_env(
+        "SPYGLASS_HEALTH_CHECKS_RELOAD_SEC",
+        "Period checking if the health checks config changed (enables reload)",
+        invalid,
+    )
+    processes = _load_int_from_env(
+        "SPYGLASS_PROBE_PROCESSES",
+        "Number of probing processes (enables multiple processes)",
+        invalid,
+    )
+    coalesce_window_ms = _load_int_from_env(
+        "SPYGLASS_PROBE_COALESCE_WINDOW_MS",
+        "Window probes of the same url share a request (enables coalescing)",
+        invalid,
+    )
+    offload_min_bytes = _load_int_from_env(
+        "SPYGLASS_PROBE_OFFLOAD_MIN_BYTES",
+        "Min body size matched off the event loop (enables offloading)",
+        invalid,
+    )
+    offload_processes = _load_int_from_env(
+        "SPYGLASS_PROBE_OFFLOAD_PROCESSES",
+        "Number of processes matching offloaded bodies (default is cores)",
+        invalid,
+    )
+    shard = os.environ.get("SPYGLASS_SHARD")
+    shards = os.environ.get("SPYGLASS_SHARDS")
+    if shards is not None:
+        shards = [name.strip() for name in shards.split(",")]
+        try:
+            Shards(shards)
+        except InvalidParamsError as err:
+            invalid.append(
+                "SPYGLASS_SHARDS : Comma separated names of all shards"
+                f" : {err}")
+        if shard not in shards:
+            invalid.append(
+                "SPYGLASS_SHARD : Name of the shard of this spy instance"
+                f" : must be one of {', '.join(shards)}")
+    elif shard is not None:
+        invalid.append(
+            "SPYGLASS_SHARDS : Comma separated names of all shards"
+            " : required when SPYGLASS_SHARD is set")
+
+    if offload_processes is not None and offload_min_bytes is None:
+        invalid.append(
+            "SPYGLASS_PROBE_OFFLOAD_PROCESSES : Number of processes matching"
+            " offloaded bodies : requires SPYGLASS_PROBE_OFFLOAD_MIN_BYTES")
+
+    if processes is not None and offload_min_bytes is not None:
+        invalid.append(
+            "SPYGLASS_PROBE_OFFLOAD_MIN_BYTES : Min body size matched off"
+            " the event loop : can't be used with SPYGLASS_PROBE_PROCESSES")
+
+    if invalid != []:
+        errmsg = "\nInvalid environment variables for health checker config:"
+        return None, errmsg + "\n\n" + "\n".join(invalid)
+
+    return CheckerConfig(
+        workers=workers,
+        max_in_flight=max_in_flight,
+        max_in_flight_per_host=max_in_flight_per_host,
+        reload_sec=reload_sec,
+        shard=shard,
+        shards=shards,
+        processes=processes,
+        coalesce_window_ms=coalesce_window_ms,
+        offload_min_bytes=offload_min_bytes,
+        offload_processes=offload_processes,
+    ), None
+
+
 def load_postgresql_config():
     """
     Loads postgresql related config from the environment.
@@ -103,6 +296,98 @@ def load_postgresql_config():
     return PostgreSQLConfig(uri=uri), None
 
 
+def load_storage_config():
+    """
+    Loads storage tuning config from the environment.
+
+    All the configurations are optional, if an invalid value is
+    provided an informational string is returned as a second
+    return value, it can be used to provide help to the caller.
+    """
+
+    invalid = []
+    writers = _load_int_from_env(
+        "SPYGLASS_STORE_WRITERS",
+        "Number of concurrent writers (and database connections)",
+        invalid,
+        default=1,
+    )
+    batch_size = _load_int_from_env(
+        "SPYGLASS_STORE_BATCH_SIZE",
+        "Max number of statuses saved per batch (enables batching)",
+        invalid,
+    )
+    batch_max_delay_ms = _load_int_from_env(
+        "SPYGLASS_STORE_BATCH_MAX_DELAY_MS",
+        "Max time a status waits on a batch before it is saved",
+        invalid,
+        default=1000,
+    )
+    max_retries = _load_int_from_env(
+        "SPYGLASS_STORE_MAX_RETRIES",
+        "Max number of retries saving statuses before giving up",
+        invalid,
+        default=5,
+    )
+    partition_interval = os.environ.get("SPYGLASS_STORE_PARTITION_INTERVAL")
+    if (partition_interval is not None and
+            partition_interval not in PARTITION_INTERVALS):
+        intervals = ", ".join(PARTITION_INTERVALS)
+        invalid.append(
+            "SPYGLASS_STORE_PARTITION_INTERVAL : Time range of partitions"
+            f" : must be one of {intervals}")
+    partition_premake = _load_int_from_env(
+        "SPYGLASS_STORE_PARTITION_PREMAKE",
+        "Number of partitions created ahead of time",
+        invalid,
+        default=3,
+    )
+    retention_hours = _load_int_from_env(
+        "SPYGLASS_STORE_RETENTION_HOURS",
+        "Partitions older than this are dropped (by default never)",
+        invalid,
+    )
+
+    if invalid != []:
+        errmsg = "\nInvalid environment variables for storage config:"
+        return None, errmsg + "\n\n" + "\n".join(invalid)
+
+    return StorageConfig(
+        writers=writers,
+        batch_size=batch_size,
+        batch_max_delay_ms=batch_max_delay_ms,
+        max_retries=max_retries,
+        partition_interval=partition_interval,
+        partition_premake=partition_premake,
+        retention_hours=retention_hours,
+    ), None
+
+
+def load_metrics_config():
+    """
+    Loads the metrics endpoint config from the environment.
+
+    All the configurations are optional, metrics are served only if
+    a port is provided. If an invalid value is provided an informational
+    string is returned as a second return value, it can be used to
+    provide help to the caller.
+    """
+
+    invalid = []
+    port = _load_int_from_env(
+        "SPYGLASS_METRICS_PORT",
+        "Port serving metrics on the Prometheus format (enables metrics)",
+        invalid,
+    )
+    host = os.environ.get("SPYGLASS_METRICS_HOST", "127.0.0.1")
+
+    if invalid != []:
+        errmsg = "\nInvalid environment variables for metrics config:"
+        return None, errmsg + "\n\n" + "\n".join(invalid)
+
+    return MetricsConfig(host=host, port=port), None
+
+
 def load_log_level():
     val = os.environ.get("SPYGLASS_LOG_LEVEL", "debug")
     return val.upper()
@@ -113,3 +398,14 @@ def _load_from_env(envvar, about, missing):
     if val is None:
         missing.append(envvar + " : " + about)
     return val
+
+
+def _load_int_from_env(envvar, about, invalid, default=None):
+    val = os.environ.get(envvar)
+    if val is None:
+        return default
+    try:
+        return int(val)
+    except ValueError:
+        invalid.append(f"{envvar} : {about} : must be an integer")
+        return default
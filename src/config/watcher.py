@@ -0,0 +1,55 @@
+import os
+import asyncio
+import logging
+
+from config.loaders import load_health_check_config
+
+
+async def watch_health_check_config(on_change, period_sec):
+    """
+    Watches the health checks config file, checking every period_sec
+    if it has been modified (the file is the same one loaded by
+    load_health_check_config).
+
+    When the file is modified the config is loaded and on_change is
+    called with the list of HealthCheck (eg: HealthChecker.update).
+    Configs that can't be loaded or that on_change rejects (raising
+    an exception) are logged and ignored, so the previous config is
+    kept until the file is fixed.
+
+    It runs forever, until the task running it is cancelled.
+    """
+    log = logging.getLogger(f"{__name__}.watch_health_check_config")
+    cfgpath = os.environ.get("SPYGLASS_HEALTH_CHECKS_CONFIG")
+    last_version = _file_version(cfgpath)
+
+    while True:
+        await asyncio.sleep(period_sec)
+
+        version = _file_version(cfgpath)
+        if version == last_version:
+            continue
+        last_version = version
+
+        checks, err = load_health_check_config()
+        if err is not None:
+            log.error(f"ignoring health checks config change: {err}")
+            continue
+
+        try:
+            on_change(checks)
+        except Exception as err:
+            log.error(f"ignoring health checks config change: {err}")
+            continue
+
+        log.info(f"health checks config reloaded from '{cfgpath}'")
+
+
+def _file_version(path):
+    # WHY: modification time alone may not change if the file is
+    # written twice in quick succession, the size helps on that.
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except (OSError, TypeError):
+        return None
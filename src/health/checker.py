@@ -1,19 +1,60 @@
+import re
+import time
+import heapq
+import random
 import asyncio
+import multiprocessing
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 
+from health import metrics
+from health import probes
+from health.dns import DNSCache
+from health.errors import InvalidParamsError
+from health.probes import compile_pattern
 from health.probes import http_probe
+from health.probes import http_probe_many
+from health.probes import new_pooled_client
+from health.probes import Offload
+from health.validators import ValidatorCache
 
 
 HealthCheck = namedtuple(
     'HealthCheck',
-    ['url', 'period_sec', 'patterns'],
-    defaults=(None,),
+    ['url', 'period_sec', 'patterns', 'warm', 'max_body_bytes',
+        'max_period_sec', 'dns_cache', 'method'],
+    defaults=(None, False, None, None, False, probes.GET),
 )
 
+# How much the period of an adaptive check grows after each healthy probe.
+BACKOFF_FACTOR = 2
 
-class InvalidParamsError(Exception):
-    pass
+
+# Checks of the same url being probed together (see coalesce_window_sec),
+# patterns_list has the patterns of each check, statuses is a future with
+# the resulting statuses, in the same order.
+_ProbeGroup = namedtuple('_ProbeGroup', ['patterns_list', 'statuses'])
+
+
+ProbeWaitStats = namedtuple(
+    'ProbeWaitStats',
+    ['count', 'total_sec', 'max_sec'],
+)
+
+_SCHEDULE_LAG = metrics.histogram(
+    "spyglass_probe_schedule_lag_seconds",
+    "How late probes started compared to their schedule",
+)
+_IN_FLIGHT = metrics.gauge(
+    "spyglass_probes_in_flight",
+    "Number of probes in flight",
+)
+_PROBE_DURATION = metrics.histogram(
+    "spyglass_probe_duration_seconds",
+    "Duration of probes (not including waiting for the in flight limits)",
+    labels=("healthy",),
+)
 
 
 class HealthChecker:
@@ -24,7 +65,17 @@ class HealthChecker:
     probe them (through HTTP) regularly.
     """
 
-    def __init__(self, handler, checks):
+    def __init__(
+        self,
+        handler,
+        checks,
+        workers=None,
+        max_in_flight=None,
+        max_in_flight_per_host=None,
+        coalesce_window_sec=None,
+        offload_min_bytes=None,
+        offload_processes=None,
+    ):
         """
         Creates a new HealthChecker.
 
@@ -39,40 +90,138 @@ class HealthChecker:
 
         The handler will be responsible for handling results for all the
         provided health check targets.
+
+        By default each health check gets its own asyncio task that sleeps
+        between probes. If workers is provided a single scheduler task
+        will keep all the probe deadlines on a min-heap and dispatch due
+        probes to a pool of workers (the given number of asyncio tasks),
+        which scales much better with a big number of health checks.
+
+        The max_in_flight and max_in_flight_per_host parameters limit how
+        many probes can be in flight at the same time, globally and per
+        host (the url netloc). Probes waiting for a slot are not timed,
+        the time spent waiting is available through probe_wait_stats.
+
+        Health checks are probed cold by default (new connection for each
+        probe). Checks with warm set to True will share a pooled client
+        that keeps connections alive across probes.
+
+        Checks are probed every period_sec by default. Checks with a
+        max_period_sec are adaptive, their period grows (by
+        BACKOFF_FACTOR) after each healthy probe, up to max_period_sec,
+        and after any unhealthy probe it snaps back to period_sec
+        (the next probe is done period_sec after the unhealthy one).
+
+        Checks resolve names on every new connection by default (cold
+        DNS). Checks with dns_cache set to True share a DNS cache
+        (see health.dns.DNSCache), so checks of the same hosts don't
+        resolve the same names over and over again.
+
+        Checks are probed with a GET by default, checks can set a
+        method to move less bytes (see health.probes.http_probe), like
+        HEAD (only for checks without patterns). Checks with the
+        CONDITIONAL_GET method share a cache of the validators of the
+        responses (see health.validators.ValidatorCache).
+
+        Checks of the same url are probed independently by default. If
+        coalesce_window_sec is provided, checks of the same url (and
+        same probing options, like warm) that fall due within the window
+        share a single request: the first one waits the window for
+        the others and the response is matched against the patterns of
+        each check, which still gets its own status. The window
+        delays the probes of urls with multiple checks, so it should be
+        much smaller than their periods. With workers the checks of the
+        same url are scheduled together and the first one only waits
+        (holding its worker) if another one is due within the window.
+
+        Patterns are matched on the event loop by default. If
+        offload_min_bytes is provided, bodies with at least that many
+        bytes are matched on a pool of processes instead (see
+        health.probes.Offload), so big bodies don't delay other probes.
+        The pool has offload_processes processes, by default as many
+        as the cores of the host.
         """
         if len(checks) == 0:
             raise InvalidParamsError(
                 "HealthChecker needs at least one HealthCheck defined")
 
-        for check in checks:
-            try:
-                res = urlparse(check.url)
-                if res.scheme == "":
-                    raise InvalidParamsError(
-                        f"url '{check.url}' doesn't have an scheme")
-                if res.netloc == "":
-                    raise InvalidParamsError(
-                        f"url '{check.url}' doesn't have an domain")
-            except Exception as err:
-                url = check.url
+        if workers is not None and workers <= 0:
+            raise InvalidParamsError(
+                f"workers must be a positive value, got: {workers}")
+
+        if max_in_flight is not None and max_in_flight <= 0:
+            m = max_in_flight
+            raise InvalidParamsError(
+                f"max_in_flight must be a positive value, got: {m}")
+
+        if max_in_flight_per_host is not None and max_in_flight_per_host <= 0:
+            m = max_in_flight_per_host
+            raise InvalidParamsError(
+                f"max_in_flight_per_host must be a positive value, got: {m}")
+
+        if coalesce_window_sec is not None and coalesce_window_sec <= 0:
+            w = coalesce_window_sec
+            raise InvalidParamsError(
+                f"coalesce_window_sec must be a positive value, got: {w}")
+
+        if offload_min_bytes is not None and offload_min_bytes <= 0:
+            m = offload_min_bytes
+            raise InvalidParamsError(
+                f"offload_min_bytes must be a positive value, got: {m}")
+
+        if offload_processes is not None:
+            if offload_min_bytes is None:
                 raise InvalidParamsError(
-                    f"can't parse health check url '{url}', err: '{err}'")
-            if check.period_sec <= 0:
-                psec = check.period_sec
+                    "offload_processes requires offload_min_bytes")
+            if offload_processes <= 0:
+                p = offload_processes
                 raise InvalidParamsError(
-                    f"period_sec must be a positive value, got: {psec}")
+                    f"offload_processes must be a positive value, got: {p}")
+
+        checks = [_prepare_check(check) for check in checks]
 
-        self.__checks = checks
+        self.__checks = {}
+        self.__next_id = 0
         self.__handler = handler
+        self.__workers = workers
+        self.__max_in_flight = max_in_flight
+        self.__max_in_flight_per_host = max_in_flight_per_host
+        self.__coalesce_window_sec = coalesce_window_sec
+        self.__offload_min_bytes = offload_min_bytes
+        self.__offload_processes = offload_processes
+        self.__offload = None
+        self.__same_url_checks = {}
+        self.__groups = {}
+        self.__global_limit = _NoLimit()
+        self.__host_limits = {}
+        self.__pooled_client = None
+        self.__keepalive_expiry_sec = None
+        self.__client_probes = {}
+        self.__client_closes = set()
+        self.__dns_cache = DNSCache()
+        self.__validators = ValidatorCache()
+        self.__wait_stats = ProbeWaitStats(count=0, total_sec=0, max_sec=0)
+        self.__deadlines = []
+        self.__periods = {}
+        self.__generations = {}
+        self.__in_flight = set()
+        self.__queued = set()
+        self.__wakeup = None
+        self.__stopped = None
+        self.__tasks = set()
         self.__run = False
 
+        for check in checks:
+            self.__add(check)
+
     def start(self):
         """
         Starts to periodically check for healthiness.
 
         Calling it will start multiple asynchronous tasks that
         will periodically probe HTTP endpoints and call
-        a handler with the results.
+        a handler with the results. When workers are configured
+        the tasks are the heap scheduler and the probe workers.
 
         Calling start on a checker that is already started
         will be ignored.
@@ -80,16 +229,44 @@ class HealthChecker:
         The created asyncio tasks will be returned, so the caller can
         use them to wait for completion, although in a normal scenario
         the tasks will never finish (unless the stop method is called).
+        Without workers the tasks of checks added after start are
+        not returned, and the task of a removed check finishes.
         """
         if self.__run:
             return
 
         self.__run = True
+        self.__stopped = asyncio.get_running_loop().create_future()
+
+        if self.__max_in_flight is not None:
+            self.__global_limit = asyncio.Semaphore(self.__max_in_flight)
+        self.__host_limits = {}
+
+        if self.__offload_min_bytes is not None:
+            self.__offload = Offload(
+                executor=self.__new_offload_executor(),
+                min_bytes=self.__offload_min_bytes,
+            )
+
+        self.__update_pooled_client()
+
+        if self.__workers is not None:
+            # WHY: the queue is bounded by the number of workers so
+            # when all workers are busy the scheduler waits for them
+            # instead of piling up probes that are already late.
+            queue = asyncio.Queue(maxsize=self.__workers)
+            tasks = [asyncio.create_task(self.__heap_scheduler(queue))]
+            for _ in range(self.__workers):
+                tasks.append(asyncio.create_task(self.__probe_worker(queue)))
+            self.__track(tasks)
+            return tasks
 
         tasks = []
-        for check in self.__checks:
-            tasks.append(asyncio.create_task(self.__probe_scheduler(check)))
+        for check_id, check in self.__checks.items():
+            tasks.append(asyncio.create_task(
+                self.__probe_scheduler(check_id, check)))
 
+        self.__track(tasks)
         return tasks
 
     def stop(self):
@@ -100,9 +277,651 @@ class HealthChecker:
         will be ignored.
         """
         self.__run = False
+        _wake(self.__wakeup)
+        _wake(self.__stopped)
+
+        if self.__offload is not None:
+            # WHY: probes still in flight match their bodies on
+            # the loop when the executor is gone (see health.probes).
+            self.__offload.executor.shutdown(wait=False)
+            self.__offload = None
+
+    async def close(self, timeout_sec=None):
+        """
+        Stops the checker (see stop), waits for its tasks to finish
+        (including the ones of checks added after start) and closes the
+        connections kept alive for warm checks.
+
+        Tasks only take long to finish if they have probes in flight,
+        if timeout_sec is provided the tasks still running after it are
+        cancelled (and given timeout_sec again to finish, cancelling
+        probes in flight is not reliable, the http client may swallow
+        the cancellation).
+
+        The checker can be started again after it is closed.
+        """
+        self.stop()
+        tasks = [task for task in self.__tasks if not task.done()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout_sec)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=timeout_sec)
+        # WHY: includes the clients replaced while running (see
+        # __update_pooled_client) whose probes were cancelled.
+        clients = set(self.__client_probes)
+        if self.__pooled_client is not None:
+            clients.add(self.__pooled_client)
+        self.__pooled_client = None
+        self.__keepalive_expiry_sec = None
+        self.__client_probes = {}
+        closes = [client.aclose() for client in clients]
+        await asyncio.gather(*closes, *self.__client_closes)
 
-    async def __probe_scheduler(self, check):
+    def add(self, check):
+        """
+        Adds a new HealthCheck, it can be called while the checker
+        is running, the check will be scheduled right away (with a
+        random phase inside its period when workers are configured).
+        """
+        self.__add(_prepare_check(check))
+
+    def remove(self, check):
+        """
+        Removes a HealthCheck (one that is equal to the given check),
+        it can be called while the checker is running, no new probes
+        will be done for the check (probes already in flight finish).
+        """
+        prepared = _prepare_check(check)
+        for check_id, c in self.__checks.items():
+            if c == prepared:
+                self.__remove(check_id)
+                return
+        raise InvalidParamsError(f"health check not found: {check}")
+
+    def update(self, checks):
+        """
+        Updates the health checks to the given ones, applying only
+        the difference from the current checks: checks that are not
+        on the given ones are removed and new checks are added.
+
+        Checks that didn't change keep their schedule (and their warm
+        connections), a check that has changed is removed and added
+        again. If any check is invalid nothing is changed.
+
+        Returns how many checks have been added and removed.
+        """
+        added = [_prepare_check(check) for check in checks]
+        if len(added) == 0:
+            raise InvalidParamsError(
+                "HealthChecker needs at least one HealthCheck defined")
+
+        removed = []
+        for check_id, check in self.__checks.items():
+            if check in added:
+                added.remove(check)
+            else:
+                removed.append(check_id)
+
+        for check_id in removed:
+            self.__remove(check_id)
+        for check in added:
+            self.__add(check)
+
+        return len(added), len(removed)
+
+    def checks(self):
+        """
+        Returns the current health checks (with compiled patterns).
+        """
+        return list(self.__checks.values())
+
+    def probe_wait_stats(self):
+        """
+        Returns a ProbeWaitStats with how many probes have been done
+        and how much time they spent waiting for the in flight limits
+        (total and the max a single probe waited), in seconds.
+        """
+        return self.__wait_stats
+
+    def __add(self, check):
+        check_id = self.__next_id
+        self.__next_id += 1
+        self.__checks[check_id] = check
+        key = _coalesce_key(check)
+        self.__same_url_checks[key] = self.__same_url_checks.get(key, 0) + 1
+
+        if not self.__run:
+            return
+
+        if check.warm:
+            self.__update_pooled_client()
+
+        if self.__workers is None:
+            self.__track([asyncio.create_task(
+                self.__probe_scheduler(check_id, check))])
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + random.random() * check.period_sec
+        self.__schedule(check_id, check, deadline)
+        _wake(self.__wakeup)
+
+    def __remove(self, check_id):
+        # WHY: the schedulers check if the check still exists before
+        # probing, the heap entries of removed checks are discarded.
+        check = self.__checks.pop(check_id)
+        key = _coalesce_key(check)
+        self.__same_url_checks[key] -= 1
+        if self.__same_url_checks[key] == 0:
+            del self.__same_url_checks[key]
+        if check.warm and self.__run:
+            self.__update_pooled_client()
+        self.__periods.pop(check_id, None)
+        self.__generations.pop(check_id, None)
+
+    def __track(self, tasks):
+        for task in tasks:
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    def __new_offload_executor(self):
+        # WHY: processes instead of threads, matching holds the GIL
+        # so a thread pool would keep the loop as busy as matching on
+        # it. Spawn instead of fork, forking a process that is
+        # running an asyncio loop is unsafe (see health.multiproc).
+        return ProcessPoolExecutor(
+            max_workers=self.__offload_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def __update_pooled_client(self):
+        warm_periods = [
+            _max_period(c) for c in self.__checks.values() if c.warm]
+        if warm_periods == []:
+            return
+
+        # WHY: connections idle for a little more than the
+        # longest warm period are kept, otherwise they would
+        # expire right before being reused. It is updated as
+        # warm checks are added and removed.
+        keepalive_expiry_sec = 2 * max(warm_periods)
+        if keepalive_expiry_sec == self.__keepalive_expiry_sec:
+            return
+
+        # WHY: the expiry of a pool can't be changed after it is
+        # created, so a new client replaces the current one, which
+        # is closed once its probes in flight finish.
+        client = self.__pooled_client
+        self.__pooled_client = new_pooled_client(
+            keepalive_expiry_sec=keepalive_expiry_sec)
+        self.__keepalive_expiry_sec = keepalive_expiry_sec
+        if client is not None and client not in self.__client_probes:
+            self.__close_client(client)
+
+    def __acquire_pooled_client(self):
+        client = self.__pooled_client
+        self.__client_probes[client] = self.__client_probes.get(client, 0) + 1
+        return client
+
+    def __release_pooled_client(self, client):
+        count = self.__client_probes.get(client)
+        if count is None:
+            # WHY: the probe outlived close, the client is closed
+            return
+        if count > 1:
+            self.__client_probes[client] = count - 1
+            return
+        del self.__client_probes[client]
+        if client is not self.__pooled_client:
+            self.__close_client(client)
+
+    def __close_client(self, client):
+        task = asyncio.create_task(client.aclose())
+        self.__client_closes.add(task)
+        task.add_done_callback(self.__client_closes.discard)
+
+    async def __probe_scheduler(self, check_id, check):
+        loop = asyncio.get_running_loop()
+        period = check.period_sec
+        stopped = self.__stopped
+        while self.__run:
+            deadline = loop.time() + period
+            # WHY: same as asyncio.sleep, but stopping wakes it up so
+            # the task finishes right away instead of a period later.
+            await asyncio.wait([stopped], timeout=period)
+            if not self.__run or check_id not in self.__checks:
+                return
+            _SCHEDULE_LAG.observe(loop.time() - deadline)
+            status = await self.__probe(check_id, check)
+            period = _adapt_period(check, period, status.healthy)
+
+    async def __heap_scheduler(self, queue):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.__deadlines = []
+        self.__periods = {}
+        self.__generations = {}
+        self.__in_flight = set()
+        self.__queued = set()
+
+        coalesce = self.__coalesce_window_sec is not None
+        for check_id, check, offset in _spread(self.__checks, coalesce):
+            self.__schedule(check_id, check, now + offset)
+
+        deadlines = self.__deadlines
         while self.__run:
-            await asyncio.sleep(check.period_sec)
-            status = await http_probe(check.url, check.patterns)
-            await self.__handler(check.url, status)
+            if deadlines == []:
+                await self.__sleep_until(None)
+                continue
+
+            deadline, check_id, generation, check = deadlines[0]
+            if generation != self.__generations.get(check_id):
+                heapq.heappop(deadlines)
+                continue
+
+            if deadline > loop.time():
+                await self.__sleep_until(deadline)
+                continue
+
+            if check_id not in self.__in_flight and queue.full():
+                # WHY: all workers are busy, the scheduler sleeps until
+                # a worker takes a probe (it wakes the scheduler up),
+                # so stopping isn't blocked waiting for the queue.
+                await self.__sleep_until(None)
+                continue
+
+            heapq.heappop(deadlines)
+            if check_id not in self.__in_flight:
+                # WHY: a check slower than its period is not dispatched
+                # again while its previous probe is in flight, the
+                # deadline is skipped (like missed deadlines are), so
+                # it doesn't take all the workers nor hammer the site.
+                self.__in_flight.add(check_id)
+                self.__queued.add(check_id)
+                queue.put_nowait((check_id, check))
+                _SCHEDULE_LAG.observe(loop.time() - deadline)
+            next_deadline = _next_deadline(
+                deadline, self.__periods[check_id], loop.time())
+            heapq.heappush(
+                deadlines, (next_deadline, check_id, generation, check))
+
+        # WHY: the probes waiting for a worker are discarded, so there
+        # is room for the stop signals and the scheduler finishes right
+        # away, instead of waiting for busy workers.
+        while not queue.empty():
+            check_id, _ = queue.get_nowait()
+            self.__in_flight.discard(check_id)
+            self.__queued.discard(check_id)
+        for _ in range(self.__workers):
+            queue.put_nowait(None)
+
+    def __schedule(self, check_id, check, deadline):
+        # WHY: the check id is used to untie equal deadlines,
+        # HealthCheck's can't be compared if they have patterns.
+        # The generation is used to discard deadlines of checks
+        # that have been rescheduled or removed.
+        self.__periods[check_id] = check.period_sec
+        self.__generations[check_id] = 0
+        heapq.heappush(self.__deadlines, (deadline, check_id, 0, check))
+
+    async def __sleep_until(self, deadline):
+        # WHY: same as asyncio.sleep, but it can be woken up earlier
+        # when a check is added or rescheduled to an earlier deadline.
+        # Without a deadline it sleeps until it is woken up.
+        loop = asyncio.get_running_loop()
+        self.__wakeup = loop.create_future()
+        handle = None
+        if deadline is not None:
+            handle = loop.call_at(deadline, _wake, self.__wakeup)
+        try:
+            await self.__wakeup
+        finally:
+            if handle is not None:
+                handle.cancel()
+
+    async def __probe_worker(self, queue):
+        while True:
+            item = await queue.get()
+            _wake(self.__wakeup)
+            if item is None:
+                return
+            check_id, check = item
+            self.__queued.discard(check_id)
+            try:
+                if check_id not in self.__checks:
+                    continue
+                status = await self.__probe(check_id, check)
+            finally:
+                self.__in_flight.discard(check_id)
+            if check.max_period_sec is not None:
+                self.__adapt(check_id, check, status.healthy)
+
+    def __adapt(self, check_id, check, healthy):
+        period = self.__periods.get(check_id)
+        if period is None:
+            # WHY: the check has been removed while it was probed
+            return
+
+        self.__periods[check_id] = _adapt_period(check, period, healthy)
+        if healthy or period == check.period_sec:
+            # WHY: the next deadline has already been scheduled with the
+            # previous period, the new one is used from then on.
+            return
+
+        # WHY: the next deadline may be a long backed off period away,
+        # it is discarded and the check is rescheduled to be probed
+        # soon, so failures are confirmed (or not) quickly.
+        loop = asyncio.get_running_loop()
+        generation = self.__generations[check_id] + 1
+        self.__generations[check_id] = generation
+        deadline = loop.time() + check.period_sec
+        heapq.heappush(
+            self.__deadlines, (deadline, check_id, generation, check))
+        _wake(self.__wakeup)
+
+    async def __probe(self, check_id, check):
+        key = _coalesce_key(check)
+        if (self.__coalesce_window_sec is None or
+                self.__same_url_checks.get(key, 0) < 2):
+            statuses = await self.__limited_probe(check, [check.patterns])
+            status = statuses[0]
+        elif key in self.__groups:
+            status = await self.__join_group(self.__groups[key], check)
+        elif self.__others_due(check_id, key):
+            status = await self.__lead_group(key, check)
+        else:
+            statuses = await self.__limited_probe(check, [check.patterns])
+            status = statuses[0]
+
+        await self.__handler(check.url, status)
+        return status
+
+    async def __lead_group(self, key, check):
+        loop = asyncio.get_running_loop()
+        group = _ProbeGroup(
+            patterns_list=[check.patterns], statuses=loop.create_future())
+        self.__groups[key] = group
+        try:
+            try:
+                await asyncio.sleep(self.__coalesce_window_sec)
+            finally:
+                del self.__groups[key]
+            statuses = await self.__limited_probe(check, group.patterns_list)
+        except BaseException:
+            # WHY: the checks that joined the group probe on their own
+            group.statuses.cancel()
+            raise
+
+        group.statuses.set_result(statuses)
+        return statuses[0]
+
+    def __others_due(self, check_id, key):
+        """
+        Returns if other checks with the same coalesce key are waiting
+        for a worker or are due within the coalesce window, so they
+        can join the group of the check. Without workers it is always
+        True, the checks don't hold a worker while waiting the window.
+        """
+        if self.__workers is None:
+            return True
+
+        for other_id in self.__queued:
+            other = self.__checks.get(other_id)
+            if other is not None and _coalesce_key(other) == key:
+                return True
+
+        loop = asyncio.get_running_loop()
+        limit = loop.time() + self.__coalesce_window_sec
+        for _, other_id, generation, other in _due_until(
+                self.__deadlines, limit):
+            if (other_id != check_id and
+                    other_id in self.__checks and
+                    generation == self.__generations.get(other_id) and
+                    _coalesce_key(other) == key):
+                return True
+        return False
+
+    async def __join_group(self, group, check):
+        index = len(group.patterns_list)
+        group.patterns_list.append(check.patterns)
+        try:
+            # WHY: a check being cancelled (eg: stopping) while it
+            # waits must not cancel the probe of the group.
+            statuses = await asyncio.shield(group.statuses)
+        except asyncio.CancelledError:
+            if not group.statuses.cancelled():
+                raise
+            statuses = await self.__limited_probe(check, [check.patterns])
+            index = 0
+        return statuses[index]
+
+    async def __limited_probe(self, check, patterns_list):
+        """
+        Probes the check url once for each of the given patterns (see
+        health.probes.http_probe_many), inside the in flight limits.
+        """
+        wait_start = time.perf_counter()
+
+        # WHY: the host limit is acquired first so a probe waiting
+        # on a busy host doesn't hold a global slot that could be used
+        # to probe other hosts.
+        async with self.__host_limit(check.url):
+            async with self.__global_limit:
+                probe_start = time.perf_counter()
+                self.__record_wait(probe_start - wait_start)
+                client = None
+                if check.warm:
+                    client = self.__acquire_pooled_client()
+                dns_cache = self.__dns_cache if check.dns_cache else None
+                validators = None
+                if check.method == probes.CONDITIONAL_GET:
+                    validators = self.__validators
+                _IN_FLIGHT.inc()
+                try:
+                    if len(patterns_list) == 1:
+                        statuses = [await http_probe(
+                            check.url,
+                            patterns_list[0],
+                            client,
+                            check.max_body_bytes,
+                            dns_cache,
+                            check.method,
+                            validators,
+                            self.__offload,
+                        )]
+                    else:
+                        statuses = await http_probe_many(
+                            check.url,
+                            patterns_list,
+                            client,
+                            check.max_body_bytes,
+                            dns_cache,
+                            check.method,
+                            validators,
+                            self.__offload,
+                        )
+                finally:
+                    _IN_FLIGHT.dec()
+                    if client is not None:
+                        self.__release_pooled_client(client)
+                duration = time.perf_counter() - probe_start
+                _PROBE_DURATION.labels(_healthy_label(statuses[0])).observe(
+                    duration)
+
+        return statuses
+
+    def __host_limit(self, url):
+        if self.__max_in_flight_per_host is None:
+            return _NoLimit()
+
+        host = urlparse(url).netloc
+        limit = self.__host_limits.get(host)
+        if limit is None:
+            limit = asyncio.Semaphore(self.__max_in_flight_per_host)
+            self.__host_limits[host] = limit
+        return limit
+
+    def __record_wait(self, wait_sec):
+        stats = self.__wait_stats
+        self.__wait_stats = ProbeWaitStats(
+            count=stats.count + 1,
+            total_sec=stats.total_sec + wait_sec,
+            max_sec=max(stats.max_sec, wait_sec),
+        )
+
+
+def _prepare_check(check):
+    """
+    Validates the check, returning it with its patterns compiled
+    (see health.probes.compile_pattern), so they are compiled only
+    once instead of on each probe.
+    """
+    try:
+        res = urlparse(check.url)
+        if res.scheme == "":
+            raise InvalidParamsError(
+                f"url '{check.url}' doesn't have an scheme")
+        if res.netloc == "":
+            raise InvalidParamsError(
+                f"url '{check.url}' doesn't have an domain")
+    except Exception as err:
+        url = check.url
+        raise InvalidParamsError(
+            f"can't parse health check url '{url}', err: '{err}'")
+    if check.period_sec <= 0:
+        psec = check.period_sec
+        raise InvalidParamsError(
+            f"period_sec must be a positive value, got: {psec}")
+    if (check.max_period_sec is not None and
+            check.max_period_sec < check.period_sec):
+        m = check.max_period_sec
+        raise InvalidParamsError(
+            f"max_period_sec can't be smaller than period_sec, got: {m}")
+    if check.max_body_bytes is not None and check.max_body_bytes <= 0:
+        m = check.max_body_bytes
+        raise InvalidParamsError(
+            f"max_body_bytes must be a positive value, got: {m}")
+    if check.method not in probes.METHODS:
+        raise InvalidParamsError(
+            f"unknown method '{check.method}' on '{check.url}'")
+    if check.method == probes.HEAD and check.patterns:
+        raise InvalidParamsError(
+            f"method '{check.method}' can't have patterns on '{check.url}'")
+
+    if check.patterns is None:
+        return check
+
+    patterns = []
+    for pattern in check.patterns:
+        try:
+            patterns.append(compile_pattern(pattern))
+        except re.error as err:
+            raise InvalidParamsError(
+                f"invalid pattern '{pattern}' on '{check.url}', err: '{err}'")
+    return check._replace(patterns=patterns)
+
+
+class _NoLimit:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def _spread(checks, coalesce=False):
+    """
+    Given a dict of checks by id returns a list of (id, check, offset)
+    with the offset of the first deadline of each check.
+
+    Checks that share the same period are spread evenly across the
+    period, with some jitter inside each slot, so they don't all
+    fire at the same time. If coalesce is True checks that can share
+    a probe (see _coalesce_key) share the same slot and offset.
+    """
+    by_period = {}
+    for check_id, check in checks.items():
+        key = _coalesce_key(check) if coalesce else check_id
+        slots = by_period.setdefault(check.period_sec, {})
+        slots.setdefault(key, []).append((check_id, check))
+
+    spread = []
+    for period, slots in by_period.items():
+        slot = period / len(slots)
+        for i, same_slot_checks in enumerate(slots.values()):
+            offset = slot * (i + random.random())
+            for check_id, check in same_slot_checks:
+                spread.append((check_id, check, offset))
+    return spread
+
+
+def _due_until(deadlines, limit):
+    """
+    Returns the entries of the deadlines heap that are due until limit,
+    only the entries due (and their children) are visited.
+    """
+    due = []
+    pending = [0]
+    while pending != []:
+        i = pending.pop()
+        if i >= len(deadlines) or deadlines[i][0] > limit:
+            continue
+        due.append(deadlines[i])
+        pending.extend((2 * i + 1, 2 * i + 2))
+    return due
+
+
+def _max_period(check):
+    if check.max_period_sec is None:
+        return check.period_sec
+    return check.max_period_sec
+
+
+def _adapt_period(check, period, healthy):
+    """
+    Returns the period to be used after a probe with the given
+    result, for non adaptive checks it is always period_sec.
+    """
+    if check.max_period_sec is None or not healthy:
+        return check.period_sec
+    return min(period * BACKOFF_FACTOR, check.max_period_sec)
+
+
+def _coalesce_key(check):
+    """
+    Returns the key of the checks that can share a single probe, the
+    ones with the same url and probing options (but any patterns).
+    """
+    return (
+        check.url,
+        check.warm,
+        check.max_body_bytes,
+        check.dns_cache,
+        check.method,
+    )
+
+
+def _healthy_label(status):
+    return "true" if status.healthy else "false"
+
+
+def _wake(future):
+    if future is not None and not future.done():
+        future.set_result(None)
+
+
+def _next_deadline(deadline, period, now):
+    """
+    Calculates the next deadline based on the absolute previous deadline,
+    so the time spent probing doesn't accumulate as drift.
+
+    If the scheduling is late for more than a period the missed deadlines
+    are skipped, preserving the original phase of the check.
+    """
+    next_deadline = deadline + period
+    if next_deadline < now:
+        missed = int((now - next_deadline) / period) + 1
+        next_deadline += missed * period
+    return next_deadline
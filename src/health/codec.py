@@ -0,0 +1,272 @@
+import json
+import struct
+import logging
+import dateutil.parser
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from health.status import HealthStatus
+from health.status import HealthError
+from health.status import HealthErrorKind
+from health.status import ProbeTimings
+
+
+# Name of the message header informing how the message is encoded.
+# Messages without it are JSON (the original encoding).
+ENCODING_HEADER = "spyglass-encoding"
+
+JSON = "json"
+COMPACT_V1 = "compact-v1"
+COMPACT_V2 = "compact-v2"
+
+ENCODINGS = (JSON, COMPACT_V1, COMPACT_V2)
+
+
+class InvalidEncodingError(Exception):
+    pass
+
+
+def encode(url, status, encoding=JSON):
+    """
+    Encodes the url and health status using the given encoding,
+    returning the encoded bytes.
+    """
+    if encoding == JSON:
+        return encode_json(url, status)
+    if encoding == COMPACT_V1:
+        return encode_compact(url, status)
+    if encoding == COMPACT_V2:
+        return encode_compact_v2(url, status)
+    raise InvalidEncodingError(f"unknown encoding '{encoding}'")
+
+
+def decode(value, encoding=None):
+    """
+    Decodes the bytes using the given encoding, returning
+    the url and health status. If encoding is None it is JSON.
+    """
+    if encoding is None or encoding == JSON:
+        return decode_json(value)
+    if encoding == COMPACT_V1:
+        return decode_compact(value)
+    if encoding == COMPACT_V2:
+        return decode_compact_v2(value)
+    raise InvalidEncodingError(f"unknown encoding '{encoding}'")
+
+
+def encode_json(url, status):
+    publish_data = {
+        "url": url,
+        "status": {
+            'timestamp': status.timestamp.isoformat(),
+            'healthy': status.healthy,
+            'response_time_ms': status.response_time_ms,
+            'status_code': status.status_code,
+            'connection_reused': status.connection_reused,
+        },
+    }
+    if status.error is not None:
+        publish_data["status"]["error"] = {
+            "kind": status.error.kind,
+            "details": status.error.details,
+        }
+    if status.timings is not None:
+        publish_data["status"]["timings"] = status.timings._asdict()
+
+    return json.dumps(publish_data).encode()
+
+
+def decode_json(value):
+    parsed_msg = json.loads(value.decode())
+    url = parsed_msg["url"]
+    parsed_status = parsed_msg["status"]
+    error = parsed_status.get("error", None)
+    health_err = None
+    timings = parsed_status.get("timings", None)
+
+    if error is not None:
+        health_err = HealthError(
+            kind=error["kind"],
+            details=error["details"],
+        )
+
+    # WHY: use date-util because python datetime... is bizarre
+    # stack overflow: https://bit.ly/30JwwwC
+    # me isolating the issue: https://bit.ly/36IoOGO
+    # Also, don't know why, info about the timezone is being
+    # lost (string has +00:00 in the end), so I force UTC.
+    timestamp = dateutil.parser.parse(parsed_status["timestamp"])
+    timestamp = timestamp.replace(tzinfo=timezone.utc)
+    health_status = HealthStatus(
+        timestamp=timestamp,
+        healthy=parsed_status["healthy"],
+        response_time_ms=parsed_status["response_time_ms"],
+        status_code=parsed_status["status_code"],
+        error=health_err,
+        connection_reused=parsed_status.get("connection_reused", False),
+        timings=None if timings is None else ProbeTimings(**timings),
+    )
+    return url, health_status
+
+
+# The compact encoding is a fixed size header followed by the url
+# and, if there is an error, by the error details. The header has:
+#
+# - timestamp: microseconds since the epoch (UTC)
+# - flags: see _HEALTHY, _CONNECTION_REUSED and _HAS_ERROR
+# - status code
+# - response time in ms
+# - error kind (0 if there is no error)
+# - url size
+#
+# Error details are a count followed by each detail size and data.
+#
+# The compact-v2 encoding is the same, followed by the probe timings
+# if there are any (see _HAS_TIMINGS). Each timing is in microseconds,
+# with _NO_TIMING for the phases that didn't happen.
+_COMPACT_HEADER = struct.Struct("!qBHIBH")
+_COMPACT_COUNT = struct.Struct("!H")
+_COMPACT_SIZE = struct.Struct("!I")
+_COMPACT_TIMINGS = struct.Struct(f"!{len(ProbeTimings._fields)}I")
+
+_HEALTHY = 1
+_CONNECTION_REUSED = 1 << 1
+_HAS_ERROR = 1 << 2
+_HAS_TIMINGS = 1 << 3
+
+_NO_TIMING = 0xFFFFFFFF
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+# WHY: all probed statuses have timings, so the timings dropped by the
+# compact-v1 encoding are only logged for the first of them.
+_timings_dropped_logged = False
+
+
+def encode_compact(url, status):
+    global _timings_dropped_logged
+    if status.timings is not None and not _timings_dropped_logged:
+        _timings_dropped_logged = True
+        log = logging.getLogger(f"{__name__}.encode_compact")
+        log.warning(
+            f"{COMPACT_V1} has no probe timings, they are not encoded,"
+            f" use {COMPACT_V2} to keep them")
+    return b"".join(_encode_compact_parts(url, status, 0))
+
+
+def encode_compact_v2(url, status):
+    if status.timings is None:
+        return b"".join(_encode_compact_parts(url, status, 0))
+
+    parts = _encode_compact_parts(url, status, _HAS_TIMINGS)
+    parts.append(_COMPACT_TIMINGS.pack(*[
+        _NO_TIMING if timing is None else round(timing * 1000)
+        for timing in status.timings
+    ]))
+    return b"".join(parts)
+
+
+def _encode_compact_parts(url, status, flags):
+    if status.healthy:
+        flags |= _HEALTHY
+    if status.connection_reused:
+        flags |= _CONNECTION_REUSED
+
+    error_kind = 0
+    if status.error is not None:
+        flags |= _HAS_ERROR
+        error_kind = int(status.error.kind)
+
+    encoded_url = url.encode()
+    parts = [
+        _COMPACT_HEADER.pack(
+            (status.timestamp - _EPOCH) // _MICROSECOND,
+            flags,
+            status.status_code,
+            status.response_time_ms,
+            error_kind,
+            len(encoded_url),
+        ),
+        encoded_url,
+    ]
+
+    if status.error is not None:
+        parts.append(_COMPACT_COUNT.pack(len(status.error.details)))
+        for detail in status.error.details:
+            encoded_detail = detail.encode()
+            parts.append(_COMPACT_SIZE.pack(len(encoded_detail)))
+            parts.append(encoded_detail)
+
+    return parts
+
+
+def decode_compact(value):
+    url, status, _, offset = _decode_compact(value)
+    _check_consumed(value, offset)
+    return url, status
+
+
+def decode_compact_v2(value):
+    url, status, flags, offset = _decode_compact(value)
+    if flags & _HAS_TIMINGS:
+        if offset + _COMPACT_TIMINGS.size > len(value):
+            raise InvalidEncodingError("compact message is truncated")
+        timings = ProbeTimings(*[
+            None if timing == _NO_TIMING else timing / 1000
+            for timing in _COMPACT_TIMINGS.unpack_from(value, offset)
+        ])
+        offset += _COMPACT_TIMINGS.size
+        status = status._replace(timings=timings)
+    _check_consumed(value, offset)
+    return url, status
+
+
+def _decode_compact(value):
+    (
+        timestamp_us,
+        flags,
+        status_code,
+        response_time_ms,
+        error_kind,
+        url_size,
+    ) = _COMPACT_HEADER.unpack_from(value)
+
+    offset = _COMPACT_HEADER.size
+    url = _decode_str(value, offset, url_size)
+    offset += url_size
+
+    error = None
+    if flags & _HAS_ERROR:
+        (count,) = _COMPACT_COUNT.unpack_from(value, offset)
+        offset += _COMPACT_COUNT.size
+        details = []
+        for _ in range(count):
+            (size,) = _COMPACT_SIZE.unpack_from(value, offset)
+            offset += _COMPACT_SIZE.size
+            details.append(_decode_str(value, offset, size))
+            offset += size
+        error = HealthError(kind=HealthErrorKind(error_kind), details=details)
+
+    status = HealthStatus(
+        timestamp=_EPOCH + timestamp_us * _MICROSECOND,
+        healthy=bool(flags & _HEALTHY),
+        response_time_ms=response_time_ms,
+        status_code=status_code,
+        error=error,
+        connection_reused=bool(flags & _CONNECTION_REUSED),
+    )
+    return url, status, flags, offset
+
+
+def _check_consumed(value, offset):
+    if offset != len(value):
+        raise InvalidEncodingError(
+            f"compact message has {len(value) - offset} unexpected bytes")
+
+
+def _decode_str(value, offset, size):
+    if offset + size > len(value):
+        raise InvalidEncodingError("compact message is truncated")
+    return value[offset:offset + size].decode()
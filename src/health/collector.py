@@ -0,0 +1,208 @@
+import time
+import asyncio
+import logging
+
+from health import metrics
+from health.errors import InvalidParamsError
+
+
+_BATCH_SIZE = metrics.histogram(
+    "spyglass_collector_batch_size",
+    "Number of statuses saved at once",
+    buckets=metrics.SIZE_BUCKETS,
+)
+_FLUSH_LATENCY = metrics.histogram(
+    "spyglass_store_flush_seconds",
+    "Time saving a batch of statuses on the store (retries not included)",
+)
+_FLUSH_RETRIES = metrics.counter(
+    "spyglass_store_flush_retries_total",
+    "Number of times saving statuses on the store has been retried",
+)
+
+
+class HealthCollector:
+    """
+    Collects health statuses and saves them.
+
+    Given a subscriber and a store it will save all statuses received
+    from the subscriber on the store, using multiple concurrent writers.
+
+    Messages are acknowledged on the subscriber only after they have
+    been saved on the store, so no message is lost if the store fails.
+    """
+
+    def __init__(
+        self,
+        subscriber,
+        store,
+        writers=1,
+        batch_size=None,
+        batch_max_delay_sec=1,
+        max_retries=5,
+        retry_backoff_sec=0.5,
+    ):
+        """
+        Creates a new HealthCollector.
+
+        The subscriber must be a health.pubsub.KafkaSubscriber, or
+        anything with the same batches, ack and commit methods.
+
+        The store must have a save(url, health_status) coroutine and, if
+        batching is used, a save_many(statuses) coroutine that receives
+        a list of (url, health_status) tuples.
+
+        The number of writers is how many concurrent tasks will be saving
+        statuses on the store, the store must support that many
+        concurrent saves (eg: PostgreSQLStore with a pool of that size).
+        Each partition is always handled by the same writer, so statuses
+        are saved in the same order they have on the partition, and
+        different partitions are handled concurrently (if there are
+        enough writers).
+
+        By default each status is saved individually. If batch_size is
+        provided each writer will gather its own batch of statuses
+        and save it when it has batch_size statuses or when the oldest
+        status on the batch has been waiting for batch_max_delay_sec.
+
+        Failures saving statuses are retried up to max_retries times,
+        waiting retry_backoff_sec before the first retry and doubling
+        the wait on each retry.
+        """
+        if writers <= 0:
+            raise InvalidParamsError(
+                f"writers must be a positive value, got: {writers}")
+        if batch_size is not None and batch_size <= 0:
+            raise InvalidParamsError(
+                f"batch_size must be a positive value, got: {batch_size}")
+        if batch_max_delay_sec <= 0:
+            d = batch_max_delay_sec
+            raise InvalidParamsError(
+                f"batch_max_delay_sec must be a positive value, got: {d}")
+        if max_retries < 0:
+            raise InvalidParamsError(
+                f"max_retries can't be negative, got: {max_retries}")
+        if retry_backoff_sec < 0:
+            b = retry_backoff_sec
+            raise InvalidParamsError(
+                f"retry_backoff_sec can't be negative, got: {b}")
+
+        self.__subscriber = subscriber
+        self.__store = store
+        self.__writers = writers
+        self.__batch_size = batch_size
+        self.__batch_max_delay_sec = batch_max_delay_sec
+        self.__max_retries = max_retries
+        self.__retry_backoff_sec = retry_backoff_sec
+        self.__log = logging.getLogger(f"{__name__}.HealthCollector")
+
+    async def run(self):
+        """
+        Collects health statuses until the subscriber is exhausted.
+
+        When the subscriber is exhausted all pending statuses are
+        saved before returning. If saving statuses fails even after
+        retrying the error is raised and collecting stops, the
+        statuses that could not be saved are not acknowledged.
+        """
+        # WHY: the queues are bounded so when the writers can't keep
+        # up the subscriber stops reading new statuses.
+        queues = []
+        for _ in range(self.__writers):
+            queues.append(asyncio.Queue(maxsize=self.__max_batch()))
+
+        tasks = [asyncio.create_task(self.__reader(queues))]
+        for queue in queues:
+            tasks.append(asyncio.create_task(self.__writer(queue)))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __reader(self, queues):
+        async for batch in self.__subscriber.batches():
+            for partition, msgs in batch.items():
+                queue = queues[hash(partition) % len(queues)]
+                for msg in msgs:
+                    await queue.put(msg)
+
+        for queue in queues:
+            await queue.put(None)
+
+    async def __writer(self, queue):
+        done = False
+        while not done:
+            batch, done = await self.__next_batch(queue)
+            if batch == []:
+                continue
+
+            await self.__save(batch)
+            for msg in batch:
+                self.__subscriber.ack(msg)
+            await self.__subscriber.commit()
+
+    async def __save(self, batch):
+        backoff_sec = self.__retry_backoff_sec
+        retries = 0
+
+        _BATCH_SIZE.observe(len(batch))
+
+        while True:
+            start = time.perf_counter()
+            try:
+                if self.__batch_size is None:
+                    msg = batch[0]
+                    await self.__store.save(msg.url, msg.status)
+                else:
+                    statuses = [(msg.url, msg.status) for msg in batch]
+                    await self.__store.save_many(statuses)
+                _FLUSH_LATENCY.observe(time.perf_counter() - start)
+                self.__log.debug("saved %d health statuses", len(batch))
+                return
+            except Exception as err:
+                if retries == self.__max_retries:
+                    self.__log.error(
+                        f"error storing health messages: {err}, giving up")
+                    raise
+                self.__log.warning(
+                    f"error storing health messages: {err}, "
+                    f"retrying in {backoff_sec} seconds")
+
+            _FLUSH_RETRIES.inc()
+            await asyncio.sleep(backoff_sec)
+            backoff_sec *= 2
+            retries += 1
+
+    async def __next_batch(self, queue):
+        """
+        Returns the next batch of statuses and if the queue is done
+        (no more statuses will be available).
+        """
+        item = await queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.__batch_max_delay_sec
+
+        while len(batch) < self.__max_batch():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def __max_batch(self):
+        if self.__batch_size is None:
+            return 1
+        return self.__batch_size
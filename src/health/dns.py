@@ -0,0 +1,121 @@
+import socket
+import asyncio
+
+from health.errors import InvalidParamsError
+
+
+# How long resolved addresses are cached.
+DEFAULT_TTL_SEC = 60
+
+# How long failures to resolve a name are cached.
+DEFAULT_NEGATIVE_TTL_SEC = 10
+
+# Max amount of names cached, expired entries are evicted first.
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class DNSCache:
+    """
+    Caches name resolutions, so probes of the same hosts don't
+    resolve the same names over and over again.
+
+    Resolved addresses are cached for ttl_sec and failures (names
+    that don't resolve) for negative_ttl_sec, the failure is raised
+    again for all the lookups while it is cached. Concurrent lookups
+    of the same name share a single resolution.
+
+    The system resolver (getaddrinfo) doesn't inform the TTL of the
+    records, so the TTLs are the same for all names, they should be
+    shorter than the TTLs of the records of the probed hosts.
+
+    Resolution is done by the given resolver, a coroutine with the
+    same parameters as loop.getaddrinfo, by default the event loop
+    getaddrinfo is used.
+    """
+
+    def __init__(
+        self,
+        ttl_sec=DEFAULT_TTL_SEC,
+        negative_ttl_sec=DEFAULT_NEGATIVE_TTL_SEC,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        resolver=None,
+    ):
+        if ttl_sec <= 0:
+            raise InvalidParamsError(
+                f"ttl_sec must be a positive value, got: {ttl_sec}")
+        if negative_ttl_sec < 0:
+            n = negative_ttl_sec
+            raise InvalidParamsError(
+                f"negative_ttl_sec can't be negative, got: {n}")
+        if max_entries <= 0:
+            raise InvalidParamsError(
+                f"max_entries must be a positive value, got: {max_entries}")
+
+        self.__ttl_sec = ttl_sec
+        self.__negative_ttl_sec = negative_ttl_sec
+        self.__max_entries = max_entries
+        self.__resolver = resolver
+        self.__entries = {}
+        self.__lookups = {}
+
+    async def getaddrinfo(self, host, port):
+        """
+        Same as loop.getaddrinfo for stream sockets, but cached.
+        """
+        loop = asyncio.get_running_loop()
+        key = (host, port)
+
+        entry = self.__entries.get(key)
+        if entry is not None:
+            expires, addresses, err = entry
+            if expires > loop.time():
+                if err is not None:
+                    # WHY: raising the same instance again would keep
+                    # growing its traceback (and the frames it holds).
+                    err_type, err_args = err
+                    raise err_type(*err_args)
+                return addresses
+            del self.__entries[key]
+
+        lookup = self.__lookups.get(key)
+        if lookup is None:
+            lookup = asyncio.create_task(self.__resolve(host, port))
+            self.__lookups[key] = lookup
+            lookup.add_done_callback(lambda _: self.__lookups.pop(key, None))
+
+        # WHY: a caller giving up (eg: timeout) must not
+        # cancel the lookup other callers are waiting for.
+        return await asyncio.shield(lookup)
+
+    def clear(self):
+        self.__entries = {}
+
+    async def __resolve(self, host, port):
+        loop = asyncio.get_running_loop()
+        resolver = self.__resolver or loop.getaddrinfo
+        try:
+            addresses = await resolver(host, port, type=socket.SOCK_STREAM)
+        except OSError as err:
+            if self.__negative_ttl_sec > 0:
+                self.__store(
+                    (host, port),
+                    self.__negative_ttl_sec,
+                    None,
+                    (type(err), err.args),
+                )
+            raise
+        self.__store((host, port), self.__ttl_sec, addresses, None)
+        return addresses
+
+    def __store(self, key, ttl_sec, addresses, err):
+        now = asyncio.get_running_loop().time()
+        if len(self.__entries) >= self.__max_entries:
+            self.__entries = {
+                k: entry for k, entry in self.__entries.items()
+                if entry[0] > now
+            }
+        if len(self.__entries) >= self.__max_entries:
+            # WHY: dicts keep the insertion order, so this is
+            # the entry that will expire first.
+            del self.__entries[next(iter(self.__entries))]
+        self.__entries[key] = (now + ttl_sec, addresses, err)
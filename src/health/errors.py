@@ -0,0 +1,7 @@
+class InvalidParamsError(Exception):
+    """
+    Raised when any of the health components (checker, collector,
+    caches, shards, etc) is created or called with invalid params.
+    All of them share this error, so it can be handled in one place.
+    """
+    pass
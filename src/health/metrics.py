@@ -0,0 +1,247 @@
+import math
+import asyncio
+import logging
+
+
+# Default buckets for durations in seconds, from 1ms to 30s.
+DURATION_BUCKETS_SEC = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1, 2.5, 5, 10, 30,
+)
+
+# Default buckets for sizes (like the number of items in a batch).
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class InvalidMetricError(Exception):
+    pass
+
+
+class Registry:
+    """
+    Keeps metrics and renders them on the Prometheus text format.
+
+    Metrics are cheap to update (no locking, everything runs on the
+    event loop), they are only formatted when they are rendered.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+
+    def counter(self, name, about, labels=()):
+        return self.__register(Counter(name, about, labels))
+
+    def gauge(self, name, about, labels=()):
+        return self.__register(Gauge(name, about, labels))
+
+    def histogram(self, name, about, buckets, labels=()):
+        return self.__register(Histogram(name, about, buckets, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.__metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def __register(self, metric):
+        if metric.name in self.__metrics:
+            raise InvalidMetricError(
+                f"metric '{metric.name}' is already registered")
+        self.__metrics[metric.name] = metric
+        return metric
+
+
+class _Metric:
+
+    kind = None
+
+    def __init__(self, name, about, labels):
+        self.name = name
+        self.__about = about
+        self.__labels = tuple(labels)
+        self.__children = {}
+
+    def labels(self, *values):
+        """
+        Returns the metric for the given label values (in the same
+        order the label names were given when it was created).
+        """
+        if len(values) != len(self.__labels):
+            raise InvalidMetricError(
+                f"metric '{self.name}' has labels {self.__labels}, "
+                f"got values: {values}")
+        child = self.__children.get(values)
+        if child is None:
+            child = self._new_child()
+            self.__children[values] = child
+        return child
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.__about}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in self.__children.items():
+            labels = list(zip(self.__labels, values))
+            lines.extend(self._render_child(child, labels))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _render_child(self, child, labels):
+        raise NotImplementedError()
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, child, labels):
+        return [f"{self.name}{_labels(labels)} {_number(child.value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Observations:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        # WHY: buckets are few, a linear search is as fast as bisect.
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, about, buckets, labels=()):
+        buckets = tuple(sorted(buckets))
+        if len(buckets) == 0:
+            raise InvalidMetricError(f"histogram '{name}' has no buckets")
+        super().__init__(name, about, labels)
+        self.__buckets = buckets
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _Observations(self.__buckets)
+
+    def _render_child(self, child, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(child.buckets, child.counts):
+            cumulative += count
+            le = labels + [("le", _number(bound))]
+            lines.append(f"{self.name}_bucket{_labels(le)} {cumulative}")
+        le = labels + [("le", "+Inf")]
+        lines.append(f"{self.name}_bucket{_labels(le)} {child.count}")
+        total = _number(child.total)
+        lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{_labels(labels)} {child.count}")
+        return lines
+
+
+# Registry used by all spyglass components.
+REGISTRY = Registry()
+
+
+def counter(name, about, labels=()):
+    return REGISTRY.counter(name, about, labels)
+
+
+def gauge(name, about, labels=()):
+    return REGISTRY.gauge(name, about, labels)
+
+
+def histogram(name, about, buckets=DURATION_BUCKETS_SEC, labels=()):
+    return REGISTRY.histogram(name, about, buckets, labels)
+
+
+async def serve_metrics(host, port, registry=REGISTRY):
+    """
+    Starts serving the metrics of the registry on the given host and
+    port, on the Prometheus text format (any path can be used, like
+    the usual /metrics). Returns the asyncio.Server.
+    """
+    log = logging.getLogger(f"{__name__}.serve_metrics")
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            if not request.startswith(b"GET "):
+                writer.write(
+                    b"HTTP/1.1 405 Method Not Allowed\r\n"
+                    b"Content-Length: 0\r\n"
+                    b"Connection: close\r\n\r\n")
+                return
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n" +
+                f"Content-Length: {len(body)}\r\n".encode() +
+                b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError) as err:
+            log.debug("error serving metrics: %s", err)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def _labels(labels):
+    if labels == []:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace(
+        "\n", r"\n")
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
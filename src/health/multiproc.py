@@ -0,0 +1,357 @@
+import struct
+import asyncio
+import logging
+import multiprocessing
+
+from health import codec
+from health import metrics
+from health.checker import HealthChecker
+from health.errors import InvalidParamsError
+from health.sharding import Shards
+
+
+# Results are sent from the processes as frames with the url and
+# the encoded status sizes followed by the url and encoded status.
+_FRAME_HEADER = struct.Struct("!HI")
+
+# How long a process waits for probes in flight when it is stopped.
+_STOP_GRACE_SEC = 2
+
+# How long closing waits for the processes to exit, a process may take
+# twice its grace period (see HealthChecker.close), plus a margin.
+_CLOSE_TIMEOUT_SEC = 3 * _STOP_GRACE_SEC
+
+
+class ProcessError(Exception):
+    pass
+
+
+class MultiProcessChecker:
+    """
+    Performs regular checks for healthiness on multiple processes.
+
+    Each process runs its own asyncio loop with a HealthChecker, so
+    probing (TLS, pattern matching) and encoding statuses can use
+    multiple cores. Checks are split among the processes by
+    consistent hashing on the url (see health.sharding), so
+    updating the checks moves as few checks as possible.
+
+    Statuses are encoded on the processes and sent to the parent
+    process through pipes, where they are all handled by the same
+    handler (eg: KafkaPublisher.publish_encoded), so there is a
+    single publishing path for all the processes.
+    """
+
+    def __init__(
+        self,
+        handler,
+        checks,
+        processes,
+        encoding=codec.JSON,
+        log_level=logging.WARNING,
+        metrics_host="127.0.0.1",
+        metrics_port=None,
+        **checker_opts,
+    ):
+        """
+        Creates a new MultiProcessChecker.
+
+        The provided handler must be a coroutine that will receive as
+        parameters the url and its encoded health status (encoded with
+        health.codec using the given encoding).
+
+        Processes is the number of processes and checker_opts are
+        passed to the HealthChecker of each process (eg: workers), so
+        limits like max_in_flight are per process.
+
+        Probing metrics (see health.metrics) are kept by each process,
+        if metrics_port is provided each process serves its metrics on
+        its own port, starting at metrics_port (process-0) and
+        incrementing it for each process.
+        """
+        if processes <= 0:
+            raise InvalidParamsError(
+                f"processes must be a positive value, got: {processes}")
+        if encoding not in codec.ENCODINGS:
+            raise codec.InvalidEncodingError(f"unknown encoding '{encoding}'")
+        if checker_opts.get("offload_min_bytes") is not None:
+            # WHY: the processes are daemonic, they can't start the
+            # processes bodies are offloaded to.
+            raise InvalidParamsError(
+                "offload_min_bytes can't be used with multiple processes")
+
+        # WHY: validates the checks and options before starting any
+        # process, errors are much easier to handle here.
+        HealthChecker(_nop_handler, checks, **checker_opts)
+
+        self.__handler = handler
+        self.__checks = list(checks)
+        self.__encoding = encoding
+        self.__log_level = log_level
+        self.__metrics_host = metrics_host
+        self.__metrics_port = metrics_port
+        self.__checker_opts = checker_opts
+        self.__names = [f"process-{i}" for i in range(processes)]
+        self.__shards = Shards(self.__names)
+        self.__controls = []
+        self.__processes = []
+        self.__tasks = []
+        self.__run = False
+        self.__log = logging.getLogger(f"{__name__}.MultiProcessChecker")
+
+    def start(self):
+        """
+        Starts the processes and to periodically check for healthiness.
+
+        Returns the asyncio tasks handling the results of each process,
+        they only finish when the checker is stopped. If a process exits
+        unexpectedly its task fails with a ProcessError.
+
+        Calling start on a checker that is already started
+        will be ignored.
+        """
+        if self.__run:
+            return
+
+        self.__run = True
+        self.__controls = []
+        self.__processes = []
+
+        # WHY: spawn instead of fork, forking a process that is
+        # running an asyncio loop (and kafka connections) is unsafe.
+        context = multiprocessing.get_context("spawn")
+        tasks = []
+        for i, name in enumerate(self.__names):
+            metrics_addr = None
+            if self.__metrics_port is not None:
+                metrics_addr = (self.__metrics_host, self.__metrics_port + i)
+            results_recv, results_send = context.Pipe(duplex=False)
+            control_recv, control_send = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_run_process,
+                name=f"spy-{name}",
+                args=(
+                    self.__shards.select(self.__checks, name),
+                    self.__encoding,
+                    self.__log_level,
+                    self.__checker_opts,
+                    metrics_addr,
+                    control_recv,
+                    results_send,
+                ),
+                daemon=True,
+            )
+            process.start()
+            # WHY: the other ends belong to the process now, if they are
+            # kept open here end of file is never detected.
+            results_send.close()
+            control_recv.close()
+
+            self.__controls.append(control_send)
+            self.__processes.append(process)
+            tasks.append(asyncio.create_task(
+                self.__handle_results(process, results_recv)))
+
+        self.__tasks = tasks
+        return list(tasks)
+
+    def stop(self):
+        """
+        Stops all the processes.
+
+        Calling stop on a checker that is already stopped
+        will be ignored.
+        """
+        if not self.__run:
+            return
+
+        self.__run = False
+        for control in self.__controls:
+            _send_control(control, None)
+
+    async def close(self, timeout_sec=_CLOSE_TIMEOUT_SEC):
+        """
+        Stops all the processes (see stop) and waits for them to exit,
+        after all the statuses they sent have been handled, so they are
+        not lost if the handler is closed right after (eg: stopping the
+        KafkaPublisher).
+
+        Each process gives its probes in flight some time to finish
+        before exiting, the processes still running after timeout_sec
+        are terminated (and their results given timeout_sec again to be
+        handled, before they are cancelled).
+        """
+        self.stop()
+        tasks = [task for task in self.__tasks if not task.done()]
+        if tasks == []:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout_sec)
+        if pending:
+            for process in self.__processes:
+                if process.is_alive():
+                    self.__log.warning(
+                        "%s didn't stop in time, terminating", process.name)
+                    process.terminate()
+            _, pending = await asyncio.wait(pending, timeout=timeout_sec)
+        for task in pending:
+            task.cancel()
+
+    def update(self, checks):
+        """
+        Updates the health checks to the given ones, each process
+        applies only the difference from its current checks (see
+        HealthChecker.update).
+
+        Returns how many checks have been added and removed.
+        """
+        HealthChecker(_nop_handler, checks, **self.__checker_opts)
+
+        added = list(checks)
+        removed = 0
+        for check in self.__checks:
+            if check in added:
+                added.remove(check)
+            else:
+                removed += 1
+        self.__checks = list(checks)
+
+        if self.__run:
+            for name, control in zip(self.__names, self.__controls):
+                _send_control(control, self.__shards.select(checks, name))
+
+        return len(added), removed
+
+    async def __handle_results(self, process, results):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), results)
+
+        while True:
+            try:
+                header = await reader.readexactly(_FRAME_HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+            url_size, value_size = _FRAME_HEADER.unpack(header)
+            url = (await reader.readexactly(url_size)).decode()
+            value = await reader.readexactly(value_size)
+            await self.__handler(url, value)
+
+        await loop.run_in_executor(None, process.join)
+        if self.__run:
+            raise ProcessError(
+                f"{process.name} exited unexpectedly, "
+                f"exit code: {process.exitcode}")
+        self.__log.debug("%s stopped", process.name)
+
+
+def _run_process(
+        checks, encoding, log_level, checker_opts, metrics_addr,
+        control, results):
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    asyncio.run(_process_main(
+        checks, encoding, checker_opts, metrics_addr, control, results))
+
+
+async def _process_main(
+        checks, encoding, checker_opts, metrics_addr, control, results):
+    log = logging.getLogger(f"{__name__}.process")
+    loop = asyncio.get_running_loop()
+    flow = _FlowControl()
+    transport, _ = await loop.connect_write_pipe(lambda: flow, results)
+
+    metrics_server = None
+    if metrics_addr is not None:
+        try:
+            metrics_server = await metrics.serve_metrics(*metrics_addr)
+        except OSError as err:
+            log.error(f"error serving metrics on {metrics_addr}: {err}")
+
+    async def handler(url, status):
+        value = codec.encode(url, status, encoding)
+        encoded_url = url.encode()
+        transport.write(
+            _FRAME_HEADER.pack(len(encoded_url), len(value)) +
+            encoded_url + value)
+        # WHY: if the parent process can't keep up the probes wait,
+        # instead of buffering statuses indefinitely.
+        await flow.drain()
+
+    checker = None
+    stopped = asyncio.Event()
+
+    def apply(checks):
+        nonlocal checker
+        # WHY: a process may end up without checks (more processes
+        # than checks), HealthChecker requires at least one check.
+        if checks == []:
+            if checker is not None:
+                # WHY: probes in flight are given some time
+                # to finish before the checker is closed.
+                asyncio.create_task(checker.close(_STOP_GRACE_SEC))
+                checker = None
+            return
+        if checker is None:
+            checker = HealthChecker(handler, checks, **checker_opts)
+            checker.start()
+            return
+        checker.update(checks)
+
+    def on_control():
+        try:
+            checks = control.recv()
+        except EOFError:
+            # WHY: the parent process died
+            checks = None
+        if checks is None:
+            loop.remove_reader(control.fileno())
+            stopped.set()
+            return
+        try:
+            apply(checks)
+        except Exception as err:
+            log.error(f"error updating health checks: {err}")
+
+    apply(checks)
+    loop.add_reader(control.fileno(), on_control)
+    await stopped.wait()
+
+    if checker is not None:
+        # WHY: probes in flight are given some time to finish by
+        # themselves, cancelling them is not reliable.
+        await checker.close(_STOP_GRACE_SEC)
+    if metrics_server is not None:
+        metrics_server.close()
+    transport.close()
+
+
+class _FlowControl(asyncio.Protocol):
+    def __init__(self):
+        self.__writable = asyncio.Event()
+        self.__writable.set()
+
+    def pause_writing(self):
+        self.__writable.clear()
+
+    def resume_writing(self):
+        self.__writable.set()
+
+    def connection_lost(self, exc):
+        self.__writable.set()
+
+    async def drain(self):
+        await self.__writable.wait()
+
+
+def _send_control(control, checks):
+    try:
+        control.send(checks)
+    except (BrokenPipeError, OSError):
+        # WHY: the process already exited, which is reported
+        # by the task handling its results.
+        pass
+
+
+async def _nop_handler(url, status):
+    pass
@@ -1,15 +1,123 @@
 import re
 import time
+import codecs
+import socket
+import asyncio
+import weakref
+import contextvars
 import httpx
+import httpcore
+from collections import namedtuple
 from datetime import datetime
 from datetime import timezone
 
 from health.status import HealthStatus
 from health.status import HealthError
 from health.status import HealthErrorKind
+from health.status import ProbeTimings
+from health.validators import Validators
 
 
-async def http_probe(url, patterns=None):
+# Max amount of body bytes read by a probe if no other limit is provided
+DEFAULT_MAX_BODY_BYTES = 4 * 1024 * 1024
+
+# Amount of text from the previous chunk of the body that is searched
+# again with the next chunk, so matches spanning chunks are found.
+MATCH_OVERLAP_CHARS = 4096
+
+# Min amount of body text searched on each call to the offload executor,
+# so a big body is sent to it on a few slices instead of chunk by chunk.
+OFFLOAD_SLICE_CHARS = 1024 * 1024
+
+# Max amount of body bytes a warm probe still reads after all patterns
+# matched, so the connection can be reused. Connections with more
+# body left than this are discarded, it is cheaper than reading it.
+WARM_DRAIN_BYTES = 64 * 1024
+
+# Probe methods (see http_probe)
+GET = "get"
+HEAD = "head"
+RANGED_GET = "ranged-get"
+CONDITIONAL_GET = "conditional-get"
+METHODS = (GET, HEAD, RANGED_GET, CONDITIONAL_GET)
+
+# Characters with special meaning on regexes, patterns without
+# them are literals, searched as plain substrings (see compile_pattern).
+_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+# Flags of patterns compiled from strings without any flags.
+_DEFAULT_FLAGS = re.compile("").flags
+
+# Syntax whose matches depend on the text around them (anchors, word
+# boundaries and lookarounds), patterns with it are not searched on
+# chunks of the body (see _search_body).
+_CONTEXT_SYNTAX = re.compile(r"[\^$]|\\[bBAZ]|\(\?<?[=!]")
+
+# Body matching offloaded to an executor (see http_probe), bodies with
+# at least min_bytes are matched on the executor instead of the loop.
+Offload = namedtuple('Offload', ['executor', 'min_bytes'])
+
+# Result of a probe request, the status doesn't consider the patterns,
+# unmatched has the patterns that didn't match (see _match_status).
+_ProbeResult = namedtuple(
+    '_ProbeResult',
+    ['status', 'unmatched', 'truncated', 'etag', 'last_modified'],
+    defaults=((), False, None, None),
+)
+
+# Timings of the probe being done by the current task, they are
+# collected by the transport (see _TimedBackend and _TimedStream).
+_probe_timings = contextvars.ContextVar("probe_timings", default=None)
+
+# DNS cache used by the probe being done by the current task, if any.
+_probe_dns_cache = contextvars.ContextVar("probe_dns_cache", default=None)
+
+
+def new_pooled_client(keepalive_expiry_sec=None):
+    """
+    Creates a new httpx.AsyncClient that keeps connections alive
+    and pools them, so it can be shared among warm probes.
+
+    Responses from the client have the information if the connection
+    was reused or not, which http_probe reports as part of the
+    resulting HealthStatus. The caller is responsible for closing
+    the client (aclose).
+    """
+    transport = _PooledTransport(
+        ssl_context=httpx.create_ssl_context(),
+        keepalive_expiry=keepalive_expiry_sec,
+    )
+    return httpx.AsyncClient(transport=transport)
+
+
+def compile_pattern(pattern):
+    """
+    Compiles a pattern to be matched on response bodies by http_probe,
+    raising re.error if it is invalid. Compiled patterns are returned
+    as they are.
+
+    Literal patterns (without any special characters) are searched as
+    plain substrings, which is much faster than the regex engine on
+    big bodies, the returned object has the same interface of compiled
+    regexes used by the probes (pattern, flags and search).
+    """
+    if not isinstance(pattern, str):
+        return pattern
+    if _SPECIAL_CHARS.isdisjoint(pattern):
+        return _LiteralPattern(pattern)
+    return re.compile(pattern)
+
+
+async def http_probe(
+    url,
+    patterns=None,
+    client=None,
+    max_body_bytes=None,
+    dns_cache=None,
+    method=GET,
+    validators=None,
+    offload=None,
+):
     """
     Probes an HTTP website for healthiness.
 
@@ -23,6 +131,10 @@ async def http_probe(url, patterns=None):
     result. Any 2XX result will be considered a success, any non 2XX result
     will be considered an error.
 
+    The response time is the time it took to get the response status
+    and headers, the body reading is not included on it since the body
+    may be only partially read.
+
     Some kind of errors don't have an HTTP status code and a response time,
     like network failures and timeouts.
     In these scenarios the status code and the response time will be 0.
@@ -34,69 +146,434 @@ async def http_probe(url, patterns=None):
     body of a successful response will be matched against each of the patterns,
     if any of them fail to match the response body it will be considered
     an error, but preserving the original http status code
-    received on the response.
+    received on the response. The regexes can be strings or already
+    compiled patterns (compiling them once with compile_pattern
+    is advised).
+
+    The body is matched as it is streamed and reading stops as soon
+    as all the patterns have matched. At most max_body_bytes
+    (DEFAULT_MAX_BODY_BYTES by default) are read from the body.
+
+    By default each probe is cold, it creates its own client and
+    establishes a new connection. If a client is provided (see
+    new_pooled_client) it will be used instead, allowing connections
+    to be reused across probes (warm probing). The resulting status
+    informs if the connection was reused, so cold and warm response
+    times can be told apart.
+
+    The status also has the timings of each phase of the probe (see
+    health.status.ProbeTimings), collected as the connection is
+    established and the request is sent.
+
+    Names are resolved on every new connection by default. If a
+    dns_cache is provided (see health.dns.DNSCache) names are resolved
+    through it instead, the time spent on it is still informed
+    on the timings (dns_ms).
+
+    The probe is a GET by default, other methods move less bytes:
+
+    - HEAD: only the status and headers are requested, since there is
+      no body any pattern fails to match.
+    - RANGED_GET: only the start of the body is requested (Range
+      header), the first byte if there are no patterns, otherwise the
+      first max_body_bytes. Servers that don't support ranges send
+      the whole body, it is read up to max_body_bytes as usual.
+    - CONDITIONAL_GET: the validators (ETag/Last-Modified) of the
+      previous response of the url are sent (If-None-Match and
+      If-Modified-Since), if the server responds 304 (not modified)
+      the probe is healthy, with the 304 status code, and the patterns
+      are not matched again, the result of the previous response is
+      used. Validators are kept on the given validators cache (see
+      health.validators.ValidatorCache), without it the probe is
+      the same as a GET.
+
+    Patterns are matched on the event loop by default, a big body
+    can keep the loop busy for a long time, delaying other probes
+    (and skewing their response times). If offload (see Offload) is
+    provided, the body of responses with at least min_bytes (by their
+    Content-Length or the bytes read so far) is matched on the given
+    executor, which should be a concurrent.futures.ProcessPoolExecutor
+    (the body is copied to the processes). Matching doesn't release
+    the GIL, so on a thread pool it keeps the loop as busy as
+    matching on the loop itself.
     """
+    statuses = await http_probe_many(
+        url, [patterns], client, max_body_bytes, dns_cache, method,
+        validators, offload)
+    return statuses[0]
 
-    async with httpx.AsyncClient() as client:
-        # WHY: Each probe creating a new client is not advised when
-        # there are concerns with performance, but for the case of
-        # probing it seems advantageous to always probe from the
-        # same state (initial one, establish new connection, etc).
 
-        start = time.perf_counter()
-        timestamp = datetime.now(timezone.utc)
+async def http_probe_many(
+    url,
+    patterns_list,
+    client=None,
+    max_body_bytes=None,
+    dns_cache=None,
+    method=GET,
+    validators=None,
+    offload=None,
+):
+    """
+    Same as http_probe, but for multiple checks of the same url, each
+    one with its own patterns (or None), with a single request.
 
-        try:
-            r = await client.get(url)
-        except httpx.TimeoutException as err:
-            return _non_http_error(timestamp, err, HealthErrorKind.TIMEOUT)
-        except Exception as err:
-            return _non_http_error(timestamp, err, HealthErrorKind.UNKNOWN)
-
-        response_time_ms = int((time.perf_counter() - start) * 1000)
-        if response_time_ms == 0:
-            # Happens on tests, maybe there is a website that fast ? =P
-            response_time_ms = 1
-
-        if not (r.status_code >= 200 and r.status_code < 300):
-            return HealthStatus(
+    Returns a list with one HealthStatus for each of the given patterns,
+    the same status http_probe would return for them. The body is
+    searched only once, for all the patterns, and patterns present on
+    more than one of the checks are searched only once too.
+    """
+
+    patterns_list = [
+        [compile_pattern(pattern) for pattern in patterns or []]
+        for patterns in patterns_list
+    ]
+    # WHY: dicts keep the insertion order, so the patterns are still
+    # searched in the order the checks informed them.
+    patterns = list({
+        _pattern_key(pattern): pattern
+        for patterns in patterns_list
+        for pattern in patterns
+    }.values())
+
+    if max_body_bytes is None:
+        max_body_bytes = DEFAULT_MAX_BODY_BYTES
+
+    searched = {_pattern_key(pattern) for pattern in patterns}
+    validators_key = (url, max_body_bytes)
+    conditional = method == CONDITIONAL_GET and validators is not None
+    cached = None
+    if conditional:
+        cached = validators.get(validators_key)
+        if cached is not None and not searched <= cached.searched:
+            # WHY: the body is needed to match the patterns that
+            # have not been matched on the cached content yet.
+            cached = None
+
+    headers = _request_headers(method, patterns, max_body_bytes, cached)
+    request = (method, headers)
+    if client is not None:
+        res = await _http_probe(
+            client, url, request, patterns, max_body_bytes, True, dns_cache,
+            offload)
+    else:
+        transport = _TimedTransport(ssl_context=httpx.create_ssl_context())
+        async with httpx.AsyncClient(transport=transport) as client:
+            # WHY: Each probe creating a new client is not advised when
+            # there are concerns with performance, but for the case of
+            # probing it seems advantageous to always probe from the
+            # same state (initial one, establish new connection, etc).
+            res = await _http_probe(
+                client, url, request, patterns, max_body_bytes, False,
+                dns_cache, offload)
+
+    status = res.status
+    unmatched = {_pattern_key(pattern) for pattern in res.unmatched}
+    truncated = res.truncated
+    if cached is not None and status.status_code == 304:
+        unmatched = cached.unmatched
+        truncated = cached.truncated
+    elif conditional and status.healthy:
+        validators.update(validators_key, Validators(
+            etag=res.etag,
+            last_modified=res.last_modified,
+            searched=frozenset(searched),
+            unmatched=frozenset(unmatched),
+            truncated=truncated,
+        ))
+
+    return [
+        _match_status(status, patterns, unmatched, truncated, max_body_bytes)
+        for patterns in patterns_list
+    ]
+
+
+def _request_headers(method, patterns, max_body_bytes, cached):
+    headers = {}
+    if method == RANGED_GET:
+        last_byte = max_body_bytes - 1 if patterns else 0
+        headers["Range"] = f"bytes=0-{last_byte}"
+    if cached is not None:
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+    return headers
+
+
+async def _http_probe(client, url, request, patterns, max_body_bytes, warm,
+                      dns_cache, offload):
+    timings = _Timings()
+    timings_token = _probe_timings.set(timings)
+    dns_cache_token = _probe_dns_cache.set(dns_cache)
+    try:
+        return await _timed_http_probe(
+            client, url, request, patterns, max_body_bytes, warm, timings,
+            offload)
+    finally:
+        _probe_dns_cache.reset(dns_cache_token)
+        _probe_timings.reset(timings_token)
+
+
+async def _timed_http_probe(client, url, request, patterns, max_body_bytes,
+                            warm, timings, offload):
+    """
+    Returns a _ProbeResult, the request is the method of the probe
+    and the headers of the request.
+    """
+    start = timings.start
+    timestamp = datetime.now(timezone.utc)
+    method, headers = request
+    conditional = "If-None-Match" in headers or "If-Modified-Since" in headers
+
+    try:
+        http_method = "HEAD" if method == HEAD else "GET"
+        async with client.stream(http_method, url, headers=headers) as r:
+            response_time_ms = int((time.perf_counter() - start) * 1000)
+            if response_time_ms == 0:
+                # Happens on tests, maybe there is a website that fast ? =P
+                response_time_ms = 1
+
+            probe_timings = timings.done()
+            connection_reused = r.ext.get("connection_reused", False)
+
+            # WHY: the body can only be iterated once, so the same
+            # iterator is shared when it is matched and then drained.
+            body = r.aiter_bytes()
+
+            not_modified = conditional and r.status_code == 304
+            if not (r.status_code >= 200 and r.status_code < 300 or
+                    not_modified):
+                if warm:
+                    await _drain_body(body, max_body_bytes)
+                return _ProbeResult(HealthStatus(
+                    timestamp=timestamp,
+                    healthy=False,
+                    status_code=r.status_code,
+                    response_time_ms=response_time_ms,
+                    error=HealthError(kind=HealthErrorKind.HTTP, details=[]),
+                    connection_reused=connection_reused,
+                    timings=probe_timings,
+                ))
+
+            success = HealthStatus(
                 timestamp=timestamp,
-                healthy=False,
+                healthy=True,
                 status_code=r.status_code,
                 response_time_ms=response_time_ms,
-                error=HealthError(kind=HealthErrorKind.HTTP, details=[]),
+                error=None,
+                connection_reused=connection_reused,
+                timings=probe_timings,
             )
 
-        success = HealthStatus(
-            timestamp=timestamp,
-            healthy=True,
-            status_code=r.status_code,
-            response_time_ms=response_time_ms,
-            error=None,
-        )
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
 
-        if patterns is None:
-            return success
+            if not patterns or not_modified:
+                if warm:
+                    await _drain_body(body, max_body_bytes)
+                return _ProbeResult(
+                    success, etag=etag, last_modified=last_modified)
 
-        errs = []
-        for pattern in patterns:
-            if not re.search(pattern, r.text):
-                err = f"unable to find match to '{pattern}' on response body"
-                errs.append(err)
+            unmatched, truncated = await _search_body(
+                body, r.encoding, patterns, max_body_bytes, offload,
+                _content_length(r))
+            if warm and not truncated:
+                await _drain_body(body, WARM_DRAIN_BYTES)
+            return _ProbeResult(
+                success, unmatched, truncated, etag, last_modified)
 
-        if errs == []:
-            return success
+    except httpx.TimeoutException as err:
+        return _ProbeResult(_non_http_error(
+            timestamp, err, HealthErrorKind.TIMEOUT, timings.done()))
+    except Exception as err:
+        return _ProbeResult(_non_http_error(
+            timestamp, err, HealthErrorKind.UNKNOWN, timings.done()))
+
+
+def _match_status(status, patterns, unmatched, truncated, max_body_bytes):
+    """
+    Returns the status of a check with the given patterns, unmatched
+    has the keys (see _pattern_key) of all the patterns that didn't
+    match on the body, searched or cached (see ValidatorCache).
+    """
+    unmatched = [p for p in patterns if _pattern_key(p) in unmatched]
+    if not status.healthy or unmatched == []:
+        return status
+
+    searched = "response body"
+    if truncated:
+        searched = f"first {max_body_bytes} bytes of response body"
+
+    errs = []
+    for pattern in unmatched:
+        errs.append(
+            f"unable to find match to '{pattern.pattern}' on {searched}")
+
+    return status._replace(
+        healthy=False,
+        error=HealthError(kind=HealthErrorKind.REGEX, details=errs),
+    )
+
+
+def _pattern_key(pattern):
+    return (pattern.pattern, pattern.flags)
+
+
+class _LiteralPattern:
+    """
+    A literal pattern, see compile_pattern. Equal to other literal
+    patterns with the same text, like compiled regexes are.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.flags = _DEFAULT_FLAGS
+
+    def search(self, text):
+        start = text.find(self.pattern)
+        if start < 0:
+            return None
+        return (start, start + len(self.pattern))
+
+    def __eq__(self, other):
+        if not isinstance(other, _LiteralPattern):
+            return NotImplemented
+        return self.pattern == other.pattern
+
+    def __hash__(self):
+        return hash(self.pattern)
+
+    def __repr__(self):
+        return f"_LiteralPattern({self.pattern!r})"
 
-        return HealthStatus(
-            timestamp=timestamp,
-            healthy=False,
-            status_code=r.status_code,
-            response_time_ms=response_time_ms,
-            error=HealthError(kind=HealthErrorKind.REGEX, details=errs),
-        )
 
+async def _drain_body(body, max_body_bytes):
+    # WHY: reading the rest of the body (instead of just closing the
+    # response) allows the connection to be reused by warm probes.
+    # Cold probes don't bother since the connection is discarded anyway.
+    read = 0
+    async for chunk in body:
+        read += len(chunk)
+        if read >= max_body_bytes:
+            return
 
-def _non_http_error(timestamp, err, kind):
+
+async def _search_body(body, encoding, patterns, max_body_bytes, offload,
+                       content_length):
+    """
+    Searches the patterns on the response body as it is streamed,
+    returning the patterns that didn't match and if the body
+    has been truncated (the max_body_bytes limit was reached).
+
+    Reading stops as soon as all patterns have matched. Each chunk
+    is searched together with the tail of the previous one, so
+    matches spanning chunks are found as long as they are not bigger
+    than the overlap. Patterns whose matches depend on the text around
+    them (like anchors and word boundaries) would match on the edges
+    of the chunks, they are searched once on the whole (read) body.
+
+    The body is decoded with the encoding of the response, without one
+    it is decoded as UTF-8, or as cp1252 if the first chunk is not
+    valid UTF-8, like httpx does for the response text.
+
+    Chunks are searched on the offload executor once the body is known
+    to be big, by its content length or the bytes read so far. Offloaded
+    chunks are gathered on slices of at least OFFLOAD_SLICE_CHARS (or
+    the offload min bytes, if bigger), so each call to the executor pays
+    its overhead for a big part of the body.
+    """
+    chunked = [p for p in patterns if not _needs_whole_body(p)]
+    whole = [p for p in patterns if _needs_whole_body(p)]
+    loop = asyncio.get_running_loop()
+    decoder = None
+    texts = []
+    tail = ""
+    pending = []
+    pending_chars = 0
+    read = 0
+    truncated = False
+
+    def offloading():
+        size = max(read, content_length)
+        return offload is not None and size >= offload.min_bytes
+
+    async def search(patterns, text):
+        if not offloading():
+            return _unmatched(patterns, text)
+        try:
+            return await loop.run_in_executor(
+                offload.executor, _unmatched, patterns, text)
+        except RuntimeError:
+            # WHY: the executor has been shut down or is broken (eg: a
+            # process of the pool died), the body is matched anyway.
+            return _unmatched(patterns, text)
+
+    async def search_chunk(text, last):
+        nonlocal chunked, tail, pending_chars
+        if whole != []:
+            texts.append(text)
+        if chunked == []:
+            return
+        pending.append(text)
+        pending_chars += len(text)
+        if offloading() and not last:
+            if pending_chars < max(offload.min_bytes, OFFLOAD_SLICE_CHARS):
+                return
+        text = tail + "".join(pending)
+        pending.clear()
+        pending_chars = 0
+        chunked = await search(chunked, text)
+        tail = text[-MATCH_OVERLAP_CHARS:]
+
+    async for chunk in body:
+        chunk = chunk[:max_body_bytes - read]
+        read += len(chunk)
+        truncated = read >= max_body_bytes
+        if decoder is None:
+            decoder = _body_decoder(encoding, chunk)
+        await search_chunk(decoder.decode(chunk, final=truncated), truncated)
+        if chunked == [] and whole == [] or truncated:
+            break
+    else:
+        final = "" if decoder is None else decoder.decode(b"", final=True)
+        await search_chunk(final, True)
+
+    if whole != []:
+        whole = await search(whole, "".join(texts))
+
+    unmatched = chunked + whole
+    return [p for p in patterns if p in unmatched], truncated
+
+
+def _needs_whole_body(pattern):
+    if isinstance(pattern, _LiteralPattern):
+        return False
+    return _CONTEXT_SYNTAX.search(pattern.pattern) is not None
+
+
+def _body_decoder(encoding, first_chunk):
+    if encoding is None:
+        encoding = "utf-8"
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(first_chunk)
+        except UnicodeDecodeError:
+            encoding = "cp1252"
+    return codecs.getincrementaldecoder(encoding)(errors="replace")
+
+
+def _unmatched(patterns, text):
+    # WHY: module level function, so it can be run on process pools
+    return [p for p in patterns if p.search(text) is None]
+
+
+def _content_length(response):
+    try:
+        return int(response.headers.get("Content-Length", 0))
+    except ValueError:
+        return 0
+
+
+def _non_http_error(timestamp, err, kind, timings):
     return HealthStatus(
         timestamp=timestamp,
         healthy=False,
@@ -106,4 +583,206 @@ def _non_http_error(timestamp, err, kind):
             kind=kind,
             details=[str(err)]
         ),
+        timings=timings,
     )
+
+
+class _Timings:
+    """
+    Timings of a probe being collected, see health.status.ProbeTimings.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.dns_ms = None
+        self.connect_ms = None
+        self.tls_ms = None
+        self.ttfb_ms = None
+        self.request_start = None
+
+    def request_sent(self):
+        if self.request_start is None:
+            self.request_start = time.perf_counter()
+
+    def response_received(self):
+        if self.ttfb_ms is None and self.request_start is not None:
+            self.ttfb_ms = _elapsed_ms(self.request_start)
+
+    def done(self):
+        return ProbeTimings(
+            dns_ms=self.dns_ms,
+            connect_ms=self.connect_ms,
+            tls_ms=self.tls_ms,
+            ttfb_ms=self.ttfb_ms,
+            total_ms=_elapsed_ms(self.start),
+        )
+
+
+def _elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+class _TimedBackend:
+    """
+    Wraps the backend of a connection pool, establishing connections
+    phase by phase (resolving the name, connecting and then the TLS
+    handshake) timing each one of them on the timings of the current
+    probe. Everything else is done by the wrapped backend.
+
+    WHY: httpcore (0.11) has no tracing hooks, the backend is the only
+    place where the connection phases can be told apart.
+    """
+
+    def __init__(self, backend):
+        self.__backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.__backend, name)
+
+    async def open_tcp_stream(
+        self, hostname, port, ssl_context, timeout, *, local_address
+    ):
+        timings = _probe_timings.get()
+        if timings is None:
+            return await self.__backend.open_tcp_stream(
+                hostname, port, ssl_context, timeout,
+                local_address=local_address)
+
+        loop = asyncio.get_running_loop()
+        connect_timeout = timeout.get("connect")
+        deadline = None
+        if connect_timeout is not None:
+            deadline = loop.time() + connect_timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(deadline - loop.time(), 0)
+
+        host = hostname.decode("ascii")
+        dns_cache = _probe_dns_cache.get()
+        if dns_cache is None:
+            lookup = loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        else:
+            lookup = dns_cache.getaddrinfo(host, port)
+
+        start = time.perf_counter()
+        try:
+            addresses = await asyncio.wait_for(lookup, remaining())
+        except asyncio.TimeoutError as err:
+            raise httpcore.ConnectTimeout(err)
+        except OSError as err:
+            raise httpcore.ConnectError(err)
+        timings.dns_ms = _elapsed_ms(start)
+
+        # WHY: each address is tried in order, like asyncio does.
+        start = time.perf_counter()
+        for *_, address in addresses:
+            try:
+                stream = await self.__backend.open_tcp_stream(
+                    address[0].encode("ascii"), port, None,
+                    dict(timeout, connect=remaining()),
+                    local_address=local_address)
+                break
+            except httpcore.ConnectError as err:
+                connect_err = err
+        else:
+            raise connect_err
+        timings.connect_ms = _elapsed_ms(start)
+
+        if ssl_context is not None:
+            start = time.perf_counter()
+            try:
+                stream = await stream.start_tls(
+                    hostname, ssl_context, dict(timeout, connect=remaining()))
+            except asyncio.TimeoutError as err:
+                await stream.aclose()
+                raise httpcore.ConnectTimeout(err)
+            except OSError as err:
+                await stream.aclose()
+                raise httpcore.ConnectError(err)
+            timings.tls_ms = _elapsed_ms(start)
+
+        return _TimedStream(stream)
+
+
+class _TimedStream:
+    """
+    Wraps a socket stream, informing the timings of the current probe when
+    the request is sent and when the first response byte is received,
+    so the time to first byte is measured even on reused connections.
+    """
+
+    def __init__(self, stream):
+        self.__stream = stream
+
+    def get_http_version(self):
+        return self.__stream.get_http_version()
+
+    async def start_tls(self, hostname, ssl_context, timeout):
+        stream = await self.__stream.start_tls(hostname, ssl_context, timeout)
+        return _TimedStream(stream)
+
+    async def read(self, n, timeout):
+        data = await self.__stream.read(n, timeout)
+        timings = _probe_timings.get()
+        if timings is not None:
+            timings.response_received()
+        return data
+
+    async def write(self, data, timeout):
+        timings = _probe_timings.get()
+        if timings is not None:
+            timings.request_sent()
+        await self.__stream.write(data, timeout)
+
+    async def aclose(self):
+        await self.__stream.aclose()
+
+    def is_connection_dropped(self):
+        return self.__stream.is_connection_dropped()
+
+
+class _TimedTransport(httpcore.AsyncConnectionPool):
+    """
+    Connection pool that collects the timings of the probes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # WHY: the pool only accepts backend names, not instances, so
+        # the backend it created is wrapped. It is not public API, if
+        # httpcore changes it probes fail right away, instead of
+        # silently losing their timings.
+        backend = getattr(self, "_backend", None)
+        if not hasattr(backend, "open_tcp_stream"):
+            raise RuntimeError(
+                f"httpcore {httpcore.__version__} is not supported,"
+                " probes require the connection pool of httpcore 0.11")
+        self._backend = _TimedBackend(backend)
+
+
+class _PooledTransport(_TimedTransport):
+    """
+    Connection pool that informs on the response ext if the
+    connection used for the request had already been used before.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__used_connections = weakref.WeakSet()
+
+    async def arequest(self, *args, **kwargs):
+        status_code, headers, stream, ext = await super().arequest(
+            *args, **kwargs)
+
+        # WHY: the pool wraps the response stream with the connection
+        # that has been used, there is no other way to get it on httpcore.
+        connection = getattr(stream, "connection", None)
+        reused = connection in self.__used_connections
+        if connection is not None:
+            self.__used_connections.add(connection)
+
+        ext = dict(ext)
+        ext["connection_reused"] = reused
+        return status_code, headers, stream, ext
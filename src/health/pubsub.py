@@ -1,36 +1,90 @@
-import json
+import time
+import asyncio
 import logging
-import dateutil.parser
-from datetime import timezone
+import functools
+from collections import deque
+from collections import namedtuple
 
-from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from aiokafka import AIOKafkaProducer, AIOKafkaConsumer, TopicPartition
 from aiokafka.helpers import create_ssl_context
 from aiokafka.errors import KafkaError, KafkaTimeoutError
+from aiokafka.errors import ConsumerStoppedError
 
-from health.status import HealthStatus
-from health.status import HealthError
+from health import codec
+from health import metrics
+
+
+_PUBLISH_LATENCY = metrics.histogram(
+    "spyglass_publish_latency_seconds",
+    "Time from publishing a status until kafka acknowledged it",
+)
+_PUBLISH_PENDING = metrics.gauge(
+    "spyglass_publish_pending",
+    "Statuses queued for publishing not acknowledged by kafka yet",
+)
+_PUBLISH_ERRORS = metrics.counter(
+    "spyglass_publish_errors_total",
+    "Statuses that could not be published (lost)",
+)
+_CONSUMER_LAG = metrics.gauge(
+    "spyglass_consumer_lag",
+    "Messages on the partition that have not been consumed yet",
+    labels=("topic", "partition"),
+)
 
 
 class KafkaPublisher:
-    "Publishes health check status on Kafka"
+    """
+    Publishes health check status on Kafka
+
+    By default each publish waits for the broker to acknowledge the
+    status. If linger_ms is provided the publisher works on batching
+    mode, publish just queues the status, which is sent on batches
+    (waiting up to linger_ms for a batch of max_batch_size bytes to
+    be filled) optionally compressed with compression_type
+    ("gzip", "snappy" or "lz4"). On batching mode delivery failures
+    are reported asynchronously (logged).
+
+    Statuses are encoded as JSON by default, the encoding can be
+    changed to any of the health.codec.ENCODINGS. The encoding is
+    informed on a message header, so subscribers can decode
+    messages with any encoding.
+    """
 
     def __init__(
-      self, uri, cafile, certfile, keyfile, topic="spyglass.health.status"):
+      self, uri, cafile, certfile, keyfile, topic="spyglass.health.status",
+      linger_ms=None, max_batch_size=None, compression_type=None,
+      encoding=codec.JSON):
+
+        if encoding not in codec.ENCODINGS:
+            raise codec.InvalidEncodingError(f"unknown encoding '{encoding}'")
 
         context = create_ssl_context(
             cafile=cafile,
             certfile=certfile,
             keyfile=keyfile,
         )
+        batching_opts = {}
+        if linger_ms is not None:
+            batching_opts["linger_ms"] = linger_ms
+        if max_batch_size is not None:
+            batching_opts["max_batch_size"] = max_batch_size
+        if compression_type is not None:
+            batching_opts["compression_type"] = compression_type
+
         # Seems like the idempotency and stronger guarantees are desirable if
         # it supports the throughput.
         # Would start with that and see how it scales.
         self.__topic = topic
+        self.__batching = linger_ms is not None
+        self.__encoding = encoding
+        self.__headers = [(codec.ENCODING_HEADER, encoding.encode())]
         self.__producer = AIOKafkaProducer(
             bootstrap_servers=uri,
             security_protocol="SSL",
             ssl_context=context,
             enable_idempotence=True,
+            **batching_opts,
         )
         self.__log = logging.getLogger(f"{__name__}.KafkaPublisher")
 
@@ -41,38 +95,112 @@ class KafkaPublisher:
         await self.__producer.stop()
 
     async def publish(self, url, status):
-        publish_data = {
-            "url": url,
-            "status": {
-                'timestamp': status.timestamp.isoformat(),
-                'healthy': status.healthy,
-                'response_time_ms': status.response_time_ms,
-                'status_code': status.status_code,
-            },
-        }
-        if status.error is not None:
-            publish_data["status"]["error"] = {
-                "kind": status.error.kind,
-                "details": status.error.details,
-            }
-
-        msg = json.dumps(publish_data)
+        value = codec.encode(url, status, self.__encoding)
+        await self.__publish(url, status, value)
+
+    async def publish_encoded(self, url, value):
+        """
+        Publishes a status of the url that has already been encoded
+        (with the publisher encoding), so encoding can be done elsewhere
+        (eg: on other processes).
+        """
+        await self.__publish(url, "(encoded)", value)
+
+    async def __publish(self, url, status, value):
+        if self.__batching:
+            await self.__enqueue(url, status, value)
+            return
+
+        start = time.perf_counter()
+        _PUBLISH_PENDING.inc()
         try:
-            self.__log.debug(f"publishing '{msg}' on 'self.__topic'")
-            await self.__producer.send_and_wait(self.__topic, msg.encode())
-            self.__log.debug(f"published '{msg}' with success")
+            self.__log.debug("publishing '%s' '%s'", url, status)
+            await self.__producer.send_and_wait(
+                self.__topic, value, headers=self.__headers)
+            _PUBLISH_LATENCY.observe(time.perf_counter() - start)
+            self.__log.debug("published '%s' '%s' with success", url, status)
         except KafkaTimeoutError:
-            self.__log.error(f"timeout publishing status, message lost: {msg}")
+            _PUBLISH_ERRORS.inc()
+            self.__log.error(
+                f"timeout publishing status, message lost: {url} {status}")
         except KafkaError as err:
-            errmsg = f"error: '{err}' publishing status, message lost: {msg}"
-            self.__log.error(errmsg)
+            _PUBLISH_ERRORS.inc()
+            errmsg = f"error: '{err}' publishing status, message lost: "
+            self.__log.error(f"{errmsg}{url} {status}")
+        finally:
+            _PUBLISH_PENDING.dec()
+
+    async def __enqueue(self, url, status, value):
+        start = time.perf_counter()
+        try:
+            self.__log.debug("enqueueing '%s' '%s'", url, status)
+            # WHY: send only waits for the message to be added to a
+            # batch, it only blocks if the producer buffer is full.
+            delivery = await self.__producer.send(
+                self.__topic, value, headers=self.__headers)
+        except KafkaTimeoutError:
+            _PUBLISH_ERRORS.inc()
+            self.__log.error(
+                f"timeout enqueueing status, message lost: {url} {status}")
+            return
+        except KafkaError as err:
+            _PUBLISH_ERRORS.inc()
+            errmsg = f"error: '{err}' enqueueing status, message lost: "
+            self.__log.error(f"{errmsg}{url} {status}")
+            return
+
+        _PUBLISH_PENDING.inc()
+        delivery.add_done_callback(
+            functools.partial(self.__delivered, url, status, start))
+
+    def __delivered(self, url, status, start, delivery):
+        _PUBLISH_PENDING.dec()
+        if delivery.cancelled():
+            _PUBLISH_ERRORS.inc()
+            self.__log.error(
+                f"publishing cancelled, message lost: {url} {status}")
+            return
+
+        err = delivery.exception()
+        if err is None:
+            _PUBLISH_LATENCY.observe(time.perf_counter() - start)
+            self.__log.debug("published '%s' '%s' with success", url, status)
+            return
+
+        _PUBLISH_ERRORS.inc()
+        errmsg = f"error: '{err}' publishing status, message lost: "
+        self.__log.error(f"{errmsg}{url} {status}")
+
+
+HealthMessage = namedtuple(
+    'HealthMessage',
+    ['url', 'status', 'partition', 'offset'],
+)
 
 
 class KafkaSubscriber:
-    "Subscribes to consume health check status on Kafka"
+    """
+    Subscribes to consume health check status on Kafka
+
+    Iterating over the subscriber gives (url, health_status) tuples.
+    The messages method gives HealthMessage's instead, which can be
+    acknowledged (ack) after being handled. The batches method gives
+    many HealthMessage's at once, grouped by partition, so partitions
+    can be handled concurrently.
+
+    By default offsets are committed automatically. If manual_commit is
+    True the offsets are committed only when commit is called, and only
+    up to the oldest message that has not been acknowledged yet, so
+    messages are never committed before being handled (at least once).
+
+    Messages that can't be parsed are logged and, if dead_letter_topic
+    is provided, published as is on the dead letter topic. They are
+    acknowledged automatically.
+    """
 
     def __init__(
-      self, uri, cafile, certfile, keyfile, topic="spyglass.health.status"):
+      self, uri, cafile, certfile, keyfile, topic="spyglass.health.status",
+      manual_commit=False, dead_letter_topic=None):
 
         context = create_ssl_context(
             cafile=cafile,
@@ -85,14 +213,33 @@ class KafkaSubscriber:
             security_protocol="SSL",
             ssl_context=context,
             group_id="spyglass-health-consumer",
+            enable_auto_commit=not manual_commit,
         )
+        self.__dead_letter_topic = dead_letter_topic
+        self.__dead_letter_producer = None
+        if dead_letter_topic is not None:
+            self.__dead_letter_producer = AIOKafkaProducer(
+                bootstrap_servers=uri,
+                security_protocol="SSL",
+                ssl_context=context,
+                enable_idempotence=True,
+            )
+        self.__offsets = {}
+        self.__commit_lock = None
         self.__log = logging.getLogger(f"{__name__}.KafkaSubscriber")
 
     async def start(self):
+        self.__commit_lock = asyncio.Lock()
+        if self.__dead_letter_producer is not None:
+            await self.__dead_letter_producer.start()
         await self.__consumer.start()
 
     async def stop(self):
-        await self.__consumer.stop()
+        try:
+            await self.__consumer.stop()
+        finally:
+            if self.__dead_letter_producer is not None:
+                await self.__dead_letter_producer.stop()
 
     def __aiter__(self):
         return self
@@ -100,39 +247,175 @@ class KafkaSubscriber:
     async def __anext__(self):
         self.__log.debug("getting next health message")
         async for msg in self.__consumer:
+            health_msg = await self.__parse(msg)
+            if health_msg is None:
+                continue
+            return health_msg.url, health_msg.status
+
+        raise StopAsyncIteration
+
+    async def messages(self):
+        """
+        Async generator of HealthMessage's.
+        """
+        async for msg in self.__consumer:
+            health_msg = await self.__parse(msg)
+            if health_msg is None:
+                continue
+            yield health_msg
+
+    async def batches(self, timeout_ms=1000, max_records=None):
+        """
+        Async generator of batches of HealthMessage's.
+
+        Each batch is a dict mapping partitions to the list of messages
+        fetched from the partition, in the same order as they are on
+        the partition. It waits up to timeout_ms for messages to be
+        available and each batch has at most max_records messages
+        (no limit by default).
+        """
+        while True:
             try:
-                parsed_msg = json.loads(msg.value.decode())
-                url = parsed_msg["url"]
-                parsed_status = parsed_msg["status"]
-                error = parsed_status.get("error", None)
-                health_err = None
-
-                if error is not None:
-                    health_err = HealthError(
-                        kind=error["kind"],
-                        details=error["details"],
-                    )
-
-                # WHY: use date-util because python datetime... is bizarre
-                # stack overflow: https://bit.ly/30JwwwC
-                # me isolating the issue: https://bit.ly/36IoOGO
-                # Also, don't know why, info about the timezone is being
-                # lost (string has +00:00 in the end), so I force UTC.
-                timestamp = dateutil.parser.parse(parsed_status["timestamp"])
-                timestamp = timestamp.replace(tzinfo=timezone.utc)
-                health_status = HealthStatus(
-                    timestamp=timestamp,
-                    healthy=parsed_status["healthy"],
-                    response_time_ms=parsed_status["response_time_ms"],
-                    status_code=parsed_status["status_code"],
-                    error=health_err,
+                records = await self.__consumer.getmany(
+                    timeout_ms=timeout_ms,
+                    max_records=max_records,
                 )
+            except ConsumerStoppedError:
+                return
 
-            except Exception as err:
-                self.__log.error(f"dropping invalid '{msg}'")
-                self.__log.error(f"error '{err}' parsing msg '{msg.value}'")
+            batch = {}
+            for partition, msgs in records.items():
+                self.__record_lag(partition, msgs)
+                for msg in msgs:
+                    health_msg = await self.__parse(msg)
+                    if health_msg is None:
+                        continue
+                    batch.setdefault(health_msg.partition, []).append(
+                        health_msg)
 
-            self.__log.debug(f"got health status: '{url}' '{health_status}'")
-            return url, health_status
+            if batch != {}:
+                self.__log.debug("got batch from %d partitions", len(batch))
+                yield batch
 
-        raise StopAsyncIteration
+    def ack(self, health_msg):
+        """
+        Acknowledges that the message has been handled, so
+        its offset can be committed.
+        """
+        self.__offsets[health_msg.partition].ack(health_msg.offset)
+
+    async def commit(self):
+        """
+        Commits the offsets of all partitions up to the oldest
+        message that has not been acknowledged yet.
+
+        Errors committing are logged, the messages will
+        be consumed again (at least once).
+        """
+        async with self.__commit_lock:
+            offsets = {}
+            for partition, pending in self.__offsets.items():
+                offset = pending.committable()
+                if offset is not None:
+                    offsets[partition] = offset
+
+            if offsets == {}:
+                return
+
+            try:
+                await self.__consumer.commit(offsets)
+            except KafkaError as err:
+                self.__log.error(f"error '{err}' committing '{offsets}'")
+
+    async def __parse(self, msg):
+        partition = TopicPartition(msg.topic, msg.partition)
+        pending = self.__offsets.get(partition)
+        if pending is None or not pending.delivered(msg.offset):
+            # WHY: after a rebalance offsets may go back, the previously
+            # delivered offsets are not relevant anymore.
+            pending = _PendingOffsets()
+            pending.delivered(msg.offset)
+            self.__offsets[partition] = pending
+
+        try:
+            url, health_status = codec.decode(msg.value, _encoding(msg))
+        except Exception as err:
+            self.__log.error(f"dropping invalid '{msg}'")
+            self.__log.error(f"error '{err}' parsing msg '{msg.value}'")
+            await self.__dead_letter(msg)
+            pending.ack(msg.offset)
+            return None
+
+        self.__log.debug("got health status: '%s' '%s'", url, health_status)
+        return HealthMessage(
+            url=url,
+            status=health_status,
+            partition=partition,
+            offset=msg.offset,
+        )
+
+    def __record_lag(self, partition, msgs):
+        if msgs == []:
+            return
+        highwater = self.__consumer.highwater(partition)
+        if highwater is None:
+            return
+        lag = highwater - msgs[-1].offset - 1
+        _CONSUMER_LAG.labels(partition.topic, partition.partition).set(lag)
+
+    async def __dead_letter(self, msg):
+        if self.__dead_letter_producer is None:
+            return
+
+        topic = self.__dead_letter_topic
+        try:
+            await self.__dead_letter_producer.send_and_wait(topic, msg.value)
+        except KafkaError as err:
+            errmsg = f"error: '{err}' sending '{msg}' to dead letter topic"
+            self.__log.error(errmsg)
+
+
+def _encoding(msg):
+    for key, value in msg.headers or ():
+        if key == codec.ENCODING_HEADER:
+            return value.decode()
+    return None
+
+
+class _PendingOffsets:
+    """
+    Keeps track of the delivered offsets of a partition that
+    have not been committed yet.
+    """
+
+    def __init__(self):
+        self.__delivered = deque()
+        self.__acked = set()
+
+    def delivered(self, offset):
+        """
+        Registers a delivered offset, returning False if offsets
+        went back (the offset is not registered in that case).
+        """
+        if self.__delivered and offset <= self.__delivered[-1]:
+            return False
+        self.__delivered.append(offset)
+        return True
+
+    def ack(self, offset):
+        self.__acked.add(offset)
+
+    def committable(self):
+        """
+        Returns the offset that can be committed (the offset of the
+        next message to be consumed) or None if there is nothing new
+        to commit.
+        """
+        last_acked = None
+        while self.__delivered and self.__delivered[0] in self.__acked:
+            last_acked = self.__delivered.popleft()
+            self.__acked.remove(last_acked)
+
+        if last_acked is None:
+            return None
+        return last_acked + 1
@@ -0,0 +1,123 @@
+import math
+import bisect
+from collections import namedtuple
+from datetime import timedelta
+
+from health.errors import InvalidParamsError
+
+
+# Rollup resolutions, each with the table where its rollups are
+# saved and the size of the time bucket of each rollup.
+RESOLUTIONS = {
+    "minutely": ("spyglass_health_status_minutely", timedelta(minutes=1)),
+    "hourly": ("spyglass_health_status_hourly", timedelta(hours=1)),
+}
+
+ERROR_KINDS = ("unknown", "http", "regex", "timeout")
+
+# The latency sketch is a histogram with exponentially growing
+# buckets, each one 20% bigger than the previous one, so any
+# percentile can be estimated with an error of at most 20% and
+# sketches are merged by just summing the buckets. Bucket i has
+# response times up to LATENCY_BOUNDS_MS[i] (inclusive), the last
+# bucket has everything that is bigger than the last bound.
+LATENCY_GROWTH = 1.2
+LATENCY_MAX_MS = 60000
+LATENCY_BOUNDS_MS = tuple(sorted({
+    math.ceil(LATENCY_GROWTH ** i)
+    for i in range(math.ceil(math.log(LATENCY_MAX_MS, LATENCY_GROWTH)) + 1)
+}))
+LATENCY_BUCKETS = len(LATENCY_BOUNDS_MS) + 1
+
+Rollup = namedtuple('Rollup', [
+    'bucket', 'target_id', 'count', 'healthy_count',
+    'error_counts', 'latency_sketch'])
+
+
+def rollup(records, resolution):
+    """
+    Aggregates stored records (see health.storage) by time bucket
+    (using the given resolution) and target.
+
+    Returns a list of Rollup. The error_counts of each Rollup has the
+    count of each kind of error, in the same order as ERROR_KINDS,
+    the latency_sketch is a list with the count of each latency
+    bucket. Only statuses that got a response are on the sketch.
+    """
+    _, size = resolution_of(resolution)
+    rollups = {}
+
+    for record in records:
+        (timestamp, target_id, healthy, status_code,
+            response_time_ms, _, error_kind, *_) = record
+
+        bucket = _floor(timestamp, size)
+        key = (bucket, target_id)
+        r = rollups.get(key)
+        if r is None:
+            r = [0, 0, [0] * len(ERROR_KINDS), [0] * LATENCY_BUCKETS]
+            rollups[key] = r
+
+        r[0] += 1
+        if healthy:
+            r[1] += 1
+        if error_kind is not None:
+            r[2][ERROR_KINDS.index(error_kind)] += 1
+        if status_code != 0:
+            r[3][latency_bucket(response_time_ms)] += 1
+
+    return [
+        Rollup(
+            bucket=bucket,
+            target_id=target_id,
+            count=r[0],
+            healthy_count=r[1],
+            error_counts=r[2],
+            latency_sketch=r[3],
+        )
+        for (bucket, target_id), r in rollups.items()
+    ]
+
+
+def latency_bucket(response_time_ms):
+    return bisect.bisect_left(LATENCY_BOUNDS_MS, response_time_ms)
+
+
+def latency_percentile(sketch, percentile):
+    """
+    Estimates the given percentile (0-100) of the response times
+    on the latency sketch, returning the upper bound (in ms) of the
+    bucket where the percentile is. Returns None if the sketch is
+    empty and math.inf if it is beyond the last bound.
+    """
+    total = sum(sketch)
+    if total == 0:
+        return None
+
+    rank = math.ceil(total * percentile / 100)
+    seen = 0
+    for i, count in enumerate(sketch):
+        seen += count
+        if seen >= rank and count > 0:
+            break
+
+    if i == len(LATENCY_BOUNDS_MS):
+        return math.inf
+    return LATENCY_BOUNDS_MS[i]
+
+
+def merge_sketches(*sketches):
+    return [sum(counts) for counts in zip(*sketches)]
+
+
+def resolution_of(resolution):
+    try:
+        return RESOLUTIONS[resolution]
+    except KeyError:
+        resolutions = ", ".join(RESOLUTIONS)
+        raise InvalidParamsError(
+            f"invalid resolution '{resolution}', must be: {resolutions}")
+
+
+def _floor(timestamp, size):
+    return timestamp - (timestamp - timestamp.min) % size
@@ -0,0 +1,54 @@
+import hashlib
+
+from health.errors import InvalidParamsError
+
+
+class Shards:
+    """
+    Splits health checks across shards using consistent hashing on
+    the check url (rendezvous hashing), so each check is owned by
+    a single shard and multiple spy instances (one per shard) can
+    probe all the checks without duplicating probes.
+
+    When a shard is added only the checks that the new shard now owns
+    move (about 1/N of them), when a shard is removed only the checks
+    it owned move to the other shards, all other checks stay put.
+
+    Shards are identified by name, so removing any of the shards
+    don't change the others, and the hashing is stable across
+    processes and hosts (it doesn't depend on Python's hash).
+    """
+
+    def __init__(self, names):
+        names = list(names)
+        if len(names) == 0:
+            raise InvalidParamsError("at least one shard is required")
+        if len(set(names)) != len(names):
+            raise InvalidParamsError(f"shard names must be unique: {names}")
+        if "" in names:
+            raise InvalidParamsError(f"shard names can't be empty: {names}")
+
+        self.__names = names
+
+    def owner(self, url):
+        """
+        Returns the name of the shard that owns the url.
+        """
+        # WHY: ties are broken by the name, so the owner doesn't
+        # depend on the order of the names.
+        return max(self.__names, key=lambda name: (_score(name, url), name))
+
+    def select(self, checks, name):
+        """
+        Returns the checks (a list of HealthCheck) owned by the given shard.
+        """
+        if name not in self.__names:
+            raise InvalidParamsError(
+                f"unknown shard '{name}', shards: {self.__names}")
+        return [check for check in checks if self.owner(check.url) == name]
+
+
+def _score(name, url):
+    digest = hashlib.blake2b(
+        f"{name}\n{url}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
@@ -12,10 +12,27 @@ class HealthErrorKind(IntEnum):
 HealthError = namedtuple('HealthError', ['kind', 'details'])
 
 
+# Time spent on each phase of a probe, in milliseconds (with sub
+# millisecond precision). Phases that didn't happen are None, like
+# dns_ms, connect_ms and tls_ms when the connection was reused, or
+# the phases after the one that failed. The total_ms is the time until
+# the response status and headers were received, or until the probe
+# failed, so failures have a meaningful duration too.
+ProbeTimings = namedtuple('ProbeTimings', [
+    'dns_ms',
+    'connect_ms',
+    'tls_ms',
+    'ttfb_ms',
+    'total_ms',
+])
+
+
 HealthStatus = namedtuple('HealthStatus', [
     'timestamp',
     'healthy',
     'response_time_ms',
     'status_code',
     'error',
-])
+    'connection_reused',
+    'timings',
+], defaults=(False, None))
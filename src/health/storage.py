@@ -1,81 +1,331 @@
 import asyncpg
 import logging
+from collections import namedtuple
+from datetime import datetime
+from datetime import timedelta
 from urllib.parse import urlparse
 
+from health import rollup
 from health.status import HealthErrorKind
+from health.status import ProbeTimings
 
 
 class PostgreSQLStoreError(Exception):
     pass
 
 
+_COLUMNS = [
+    'timestamp',
+    'target_id',
+    'healthy',
+    'status_code',
+    'response_time_ms',
+    'connection_reused',
+    'error_kind',
+    'error_details',
+    *ProbeTimings._fields,
+]
+
+_STAGING_TABLE = "spyglass_health_status_staging"
+
+_ROLLUP_COLUMNS = [
+    'bucket',
+    'target_id',
+    'count',
+    'healthy_count',
+    *[f"error_{kind}" for kind in rollup.ERROR_KINDS],
+    'latency_sketch',
+]
+
+# WHY: counters are summed, so rollups of different batches merge.
+_ROLLUP_UPDATES = ",\n".join(
+    f"{c} = r.{c} + EXCLUDED.{c}" for c in _ROLLUP_COLUMNS[2:-1])
+
+_TABLE = "spyglass_health_status"
+
+# Supported partition intervals, each with the size of the partition
+# and the format of the timestamp used to name the partitions.
+PARTITION_INTERVALS = {
+    "daily": (timedelta(days=1), "%Y%m%d"),
+    "hourly": (timedelta(hours=1), "%Y%m%d%H"),
+}
+
+Partition = namedtuple('Partition', ['name', 'start', 'end'])
+
+# Partition that gets the statuses out of the range of all the other
+# partitions (eg: clock skew), without it saving them would fail.
+DEFAULT_PARTITION = f"{_TABLE}_default"
+
+
 class PostgreSQLStore:
-    "Stores health checks on a SQL database"
+    """
+    Stores health checks on a SQL database
+
+    Connections are pooled, pool_size is the max number of connections
+    that will be opened, so it is also the max number of concurrent
+    saves that can be done on the store.
+
+    Each url (website and path) is saved once on the targets table and
+    the health statuses refer to it by id, the ids are cached in memory
+    so only urls never seen before need a trip to the database.
+    """
+
+    def __init__(self, uri, pool_size=1):
+        if pool_size <= 0:
+            raise PostgreSQLStoreError(
+                f"pool_size must be positive, got: {pool_size}")
 
-    def __init__(self, uri):
         self.__uri = uri
+        self.__pool_size = pool_size
+        self.__pool = None
+        self.__target_ids = {}
         self.__log = logging.getLogger(f"{__name__}.SQLStore")
 
     async def connect(self):
-        self.__conn = await asyncpg.connect(self.__uri)
+        self.__pool = await asyncpg.create_pool(
+            self.__uri,
+            min_size=1,
+            max_size=self.__pool_size,
+        )
 
     async def save(self, url, health_status):
-        if self.__conn is None:
+        if self.__pool is None:
             raise PostgreSQLStoreError(
                 "trying to save but not connected to db")
 
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc
-        path = parsed_url.path + parsed_url.query
-        timestamp = health_status.timestamp.replace(tzinfo=None)
+        async with self.__pool.acquire() as conn:
+            target_ids = await self.__resolve_targets(conn, [url])
+            record = _to_record(target_ids[url], health_status)
+            columns = ", ".join(_COLUMNS)
+            values = ", ".join(f"${i + 1}" for i in range(len(_COLUMNS)))
+            async with conn.transaction():
+                result = await conn.execute(f'''
+                    INSERT INTO spyglass_health_status({columns})
+                    VALUES({values})
+                    ON CONFLICT DO NOTHING
+                ''', *record)
+                # WHY: result is the command status, like "INSERT 0 1"
+                if int(result.split()[-1]) == 0:
+                    self.__log.warning(
+                        f"discarding duplicated health status "
+                        f"{url} {health_status}")
+                    return
+                await self.__save_rollups(conn, [record])
 
-        try:
-            if health_status.error is None:
-                await self.__conn.execute('''
-                    INSERT INTO spyglass_health_status(
-                        timestamp,
-                        website,
-                        path,
-                        healthy,
-                        status_code,
-                        response_time_ms
-                        ) VALUES($1, $2, $3, $4, $5, $6)
-                    ''', timestamp, domain, path, health_status.healthy,
-                                          health_status.status_code,
-                                          health_status.response_time_ms)
-                return
-
-            # Not the nicest way to represent list of values... Probably
-            # Almost out of time at this point :-(
-            error_details = ",".join(health_status.error.details)
-            error_kind = error_kind_to_db_enum(health_status.error.kind)
-
-            await self.__conn.execute('''
-                INSERT INTO spyglass_health_status(
-                    timestamp,
-                    website,
-                    path,
-                    healthy,
-                    status_code,
-                    response_time_ms,
-                    error_kind,
-                    error_details
-                    ) VALUES($1, $2, $3, $4, $5, $6, $7, $8)
-            ''', timestamp, domain, path, health_status.healthy,
-                                      health_status.status_code,
-                                      health_status.response_time_ms,
-                                      error_kind,
-                                      error_details)
-
-        except asyncpg.exceptions.UniqueViolationError:
-            self.__log.warning(
-                f"discarding duplicated health status {url} {health_status}")
+    async def save_many(self, statuses):
+        """
+        Saves multiple health statuses at once.
+
+        The statuses must be an iterable of (url, health_status) tuples.
+        They are copied to a staging table (COPY is much faster than
+        inserting one row at a time) and then moved to the health status
+        table in the same transaction, duplicated statuses are discarded.
+        The rollups of the saved statuses are updated on the same
+        transaction too.
+
+        Returns the number of statuses that have been saved.
+        """
+        if self.__pool is None:
+            raise PostgreSQLStoreError(
+                "trying to save but not connected to db")
+
+        statuses = list(statuses)
+        if statuses == []:
+            return 0
+
+        async with self.__pool.acquire() as conn:
+            target_ids = await self.__resolve_targets(
+                conn, [url for url, _ in statuses])
+            records = [
+                _to_record(target_ids[url], status)
+                for url, status in statuses
+            ]
+            return await self.__save_records(conn, records)
+
+    async def manage_partitions(self, interval, premake, retention=None):
+        """
+        Manages the partitions of the health status table, which must
+        have been created as a partitioned table (see tools/setup-database).
+
+        Creates the partition for the current time and premake partitions
+        ahead of it (if they don't exist yet) along with the
+        DEFAULT_PARTITION. Statuses on the default partition are moved
+        to the partitions created for their time range. If a retention
+        (timedelta) is provided partitions with data older than the
+        retention are dropped (and such data is deleted from the
+        default partition). The interval must be one of
+        PARTITION_INTERVALS.
+
+        Returns the names of the created and the dropped partitions.
+        """
+        if self.__pool is None:
+            raise PostgreSQLStoreError(
+                "trying to manage partitions but not connected to db")
+
+        now = datetime.utcnow()
+        existent = set(await self.__pool.fetchval('''
+            SELECT coalesce(array_agg(child.relname::text), '{}')
+            FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = $1
+        ''', _TABLE))
+
+        created = []
+        if DEFAULT_PARTITION not in existent:
+            await self.__pool.execute(f'''
+                CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION}
+                PARTITION OF {_TABLE} DEFAULT
+            ''')
+            created.append(DEFAULT_PARTITION)
+
+        for partition in partitions_ahead(now, interval, premake):
+            if partition.name in existent:
+                continue
+            await self.__create_partition(partition)
+            created.append(partition.name)
+
+        dropped = []
+        if retention is not None:
+            oldest = now - retention
+            for name in expired_partitions(existent, interval, oldest):
+                # WHY: dropping a partition is instant, deleting
+                # old rows would be slow and bloat the table.
+                await self.__pool.execute(f"DROP TABLE IF EXISTS {name}")
+                dropped.append(name)
+            # WHY: the default partition is never dropped, but it
+            # only gets the few statuses out of range so it is cheap.
+            await self.__pool.execute(f'''
+                DELETE FROM {DEFAULT_PARTITION} WHERE timestamp < $1
+            ''', oldest)
+
+        if created != [] or dropped != []:
+            self.__log.info(
+                f"created partitions {created}, dropped partitions {dropped}")
+        return created, dropped
 
     async def disconnect(self):
-        if self.__conn is None:
+        if self.__pool is None:
+            return
+        await self.__pool.close()
+        self.__pool = None
+
+    async def __create_partition(self, partition):
+        """
+        Creates the partition moving to it the statuses of its time
+        range that are on the default partition, postgres refuses
+        to create a partition overlapping rows of the default one.
+        """
+        async with self.__pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {partition.name}
+                    (LIKE {_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                ''')
+                await conn.execute(f'''
+                    WITH moved AS (
+                        DELETE FROM {DEFAULT_PARTITION}
+                        WHERE timestamp >= $1 AND timestamp < $2
+                        RETURNING *
+                    )
+                    INSERT INTO {partition.name} SELECT * FROM moved
+                ''', partition.start, partition.end)
+                await conn.execute(f'''
+                    ALTER TABLE {_TABLE} ATTACH PARTITION {partition.name}
+                    FOR VALUES FROM ('{partition.start.isoformat()}')
+                    TO ('{partition.end.isoformat()}')
+                ''')
+
+    async def __resolve_targets(self, conn, urls):
+        """
+        Returns a dict mapping each one of the urls to its target id,
+        creating the targets that don't exist yet.
+        """
+        missing = {}
+        for url in urls:
+            if url not in self.__target_ids and url not in missing:
+                missing[url] = _split_url(url)
+
+        if missing != {}:
+            websites = [website for website, _ in missing.values()]
+            paths = [path for _, path in missing.values()]
+            # WHY: no transaction here, targets are never deleted so
+            # even if saving the statuses fails they are still useful.
+            await conn.execute('''
+                INSERT INTO spyglass_targets(website, path)
+                SELECT * FROM unnest($1::text[], $2::text[])
+                ON CONFLICT DO NOTHING
+            ''', websites, paths)
+            rows = await conn.fetch('''
+                SELECT t.id, t.website, t.path FROM spyglass_targets t
+                JOIN unnest($1::text[], $2::text[]) AS u(website, path)
+                ON t.website = u.website AND t.path = u.path
+            ''', websites, paths)
+            ids = {(row["website"], row["path"]): row["id"] for row in rows}
+            for url, target in missing.items():
+                self.__target_ids[url] = ids[target]
+
+        return {url: self.__target_ids[url] for url in urls}
+
+    async def __save_records(self, conn, records):
+        async with conn.transaction():
+            # WHY: temporary tables are per connection and the rows are
+            # deleted on commit, so it is created once per connection
+            # and is always empty when a new batch starts.
+            await conn.execute(f'''
+                CREATE TEMPORARY TABLE IF NOT EXISTS {_STAGING_TABLE}
+                (LIKE spyglass_health_status INCLUDING DEFAULTS)
+                ON COMMIT DELETE ROWS
+            ''')
+            await conn.copy_records_to_table(
+                _STAGING_TABLE, records=records, columns=_COLUMNS)
+            columns = ", ".join(_COLUMNS)
+            # WHY: rollups must count only the statuses that were
+            # actually saved, not the discarded duplicates.
+            saved_records = await conn.fetch(f'''
+                INSERT INTO spyglass_health_status({columns})
+                SELECT {columns} FROM {_STAGING_TABLE}
+                ON CONFLICT DO NOTHING
+                RETURNING {columns}
+            ''')
+            await self.__save_rollups(
+                conn, [tuple(r) for r in saved_records])
+
+        saved = len(saved_records)
+        if saved < len(records):
+            duplicated = len(records) - saved
+            self.__log.warning(
+                f"discarded {duplicated} duplicated health statuses")
+        return saved
+
+    async def __save_rollups(self, conn, records):
+        if records == []:
             return
-        await self.__conn.close()
-        self.__conn = None
+        for resolution, (table, _) in rollup.RESOLUTIONS.items():
+            # WHY: concurrent writers may update the same rollups,
+            # updating them always in the same order avoids deadlocks.
+            rollups = sorted(rollup.rollup(records, resolution))
+            await conn.executemany(f'''
+                INSERT INTO {table} AS r({", ".join(_ROLLUP_COLUMNS)})
+                VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                ON CONFLICT (bucket, target_id) DO UPDATE SET
+                    {_ROLLUP_UPDATES},
+                    latency_sketch = ARRAY(
+                        SELECT a + b FROM unnest(
+                            r.latency_sketch, EXCLUDED.latency_sketch
+                        ) WITH ORDINALITY AS s(a, b, i) ORDER BY i
+                    )
+            ''', [
+                (
+                    r.bucket,
+                    r.target_id,
+                    r.count,
+                    r.healthy_count,
+                    *r.error_counts,
+                    r.latency_sketch,
+                )
+                for r in rollups
+            ])
 
 
 def error_kind_to_db_enum(kind):
@@ -86,3 +336,91 @@ def error_kind_to_db_enum(kind):
     if kind == HealthErrorKind.TIMEOUT:
         return "timeout"
     return "unknown"
+
+
+def partition_name(start, interval):
+    _, name_format = _partition_interval(interval)
+    return f"{_TABLE}_p{start.strftime(name_format)}"
+
+
+def partitions_ahead(now, interval, premake):
+    """
+    Returns the Partition containing now followed by premake
+    partitions (the next ones). Timestamps are UTC (no timezone).
+    """
+    size, _ = _partition_interval(interval)
+    start = datetime.min + ((now - datetime.min) // size) * size
+
+    partitions = []
+    for _ in range(premake + 1):
+        end = start + size
+        partitions.append(Partition(
+            name=partition_name(start, interval),
+            start=start,
+            end=end,
+        ))
+        start = end
+    return partitions
+
+
+def expired_partitions(names, interval, oldest):
+    """
+    Returns the names of the partitions that only have data older
+    than oldest. Names that are not partitions created with the
+    given interval are ignored.
+    """
+    size, name_format = _partition_interval(interval)
+    prefix = f"{_TABLE}_p"
+
+    expired = []
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            start = datetime.strptime(name[len(prefix):], name_format)
+        except ValueError:
+            continue
+        if partition_name(start, interval) != name:
+            continue
+        if start + size <= oldest:
+            expired.append(name)
+    return sorted(expired)
+
+
+def _partition_interval(interval):
+    try:
+        return PARTITION_INTERVALS[interval]
+    except KeyError:
+        intervals = ", ".join(PARTITION_INTERVALS)
+        raise PostgreSQLStoreError(
+            f"invalid partition interval '{interval}', must be: {intervals}")
+
+
+def _to_record(target_id, health_status):
+    timestamp = health_status.timestamp.replace(tzinfo=None)
+    error_kind = None
+    error_details = None
+    timings = health_status.timings
+    if timings is None:
+        timings = ProbeTimings(*[None] * len(ProbeTimings._fields))
+
+    if health_status.error is not None:
+        error_details = list(health_status.error.details)
+        error_kind = error_kind_to_db_enum(health_status.error.kind)
+
+    return (
+        timestamp,
+        target_id,
+        health_status.healthy,
+        health_status.status_code,
+        health_status.response_time_ms,
+        health_status.connection_reused,
+        error_kind,
+        error_details,
+        *timings,
+    )
+
+
+def _split_url(url):
+    parsed_url = urlparse(url)
+    return parsed_url.netloc, parsed_url.path + parsed_url.query
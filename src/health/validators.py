@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+from health.errors import InvalidParamsError
+
+
+# Max amount of targets with cached validators, the oldest are evicted.
+DEFAULT_MAX_ENTRIES = 4096
+
+
+# Validators (ETag and Last-Modified) of the last response of a target
+# along with the result of matching patterns on its body. Searched and
+# unmatched are sets of (pattern, flags) of the compiled patterns.
+Validators = namedtuple(
+    'Validators',
+    ['etag', 'last_modified', 'searched', 'unmatched', 'truncated'],
+)
+
+
+class ValidatorCache:
+    """
+    Caches the validators of the responses of each target, so
+    conditional probes can ask the servers if the content changed
+    (If-None-Match/If-Modified-Since) instead of downloading it again.
+
+    The result of matching patterns on the body is cached along with
+    the validators, so when the content didn't change (304) the patterns
+    don't need to be matched again. Results of the same content
+    (same validators) are merged, so checks of the same target with
+    different patterns can all take advantage of it.
+
+    Targets are identified by any hashable key (eg: url). When
+    there are more than max_entries targets the ones that have
+    been updated least recently are evicted.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        if max_entries <= 0:
+            raise InvalidParamsError(
+                f"max_entries must be a positive value, got: {max_entries}")
+
+        self.__max_entries = max_entries
+        self.__entries = {}
+
+    def get(self, key):
+        """
+        Returns the Validators of the target or None.
+        """
+        return self.__entries.get(key)
+
+    def update(self, key, validators):
+        """
+        Updates the Validators of the target, if the cached validators
+        are the same the results of the patterns are merged.
+        Validators without an etag and last_modified are not cached.
+        """
+        cached = self.__entries.pop(key, None)
+
+        if validators.etag is None and validators.last_modified is None:
+            return
+
+        if cached is not None and cached[:2] == validators[:2]:
+            validators = validators._replace(
+                searched=cached.searched | validators.searched,
+                unmatched=(
+                    (cached.unmatched - validators.searched) |
+                    validators.unmatched
+                ),
+                truncated=cached.truncated or validators.truncated,
+            )
+
+        if len(self.__entries) >= self.__max_entries:
+            # WHY: dicts keep the insertion order, so this is
+            # the entry that has been updated least recently.
+            del self.__entries[next(iter(self.__entries))]
+        self.__entries[key] = validators
+
+    def clear(self):
+        self.__entries = {}
@@ -12,7 +12,12 @@ from config.loaders import load_kafka_config
 
 
 @pytest.mark.asyncio
-async def test_kafka_health_pubsub():
+@pytest.mark.parametrize("publisher_opts", [
+    {},
+    {"linger_ms": 100, "compression_type": "gzip"},
+    {"encoding": "compact-v1"},
+])
+async def test_kafka_health_pubsub(publisher_opts):
     cfg, err = load_kafka_config()
     if err is not None:
         pytest.skip(f"test requires kafka configuration:\n{err}")
@@ -21,7 +26,8 @@ async def test_kafka_health_pubsub():
     test_topic = "spyglass.integration.tests.health.status"
 
     publisher = KafkaPublisher(
-        cfg.uri, cfg.ssl_cafile, cfg.ssl_cert, cfg.ssl_keyfile, test_topic)
+        cfg.uri, cfg.ssl_cafile, cfg.ssl_cert, cfg.ssl_keyfile, test_topic,
+        **publisher_opts)
 
     subscriber = KafkaSubscriber(
         cfg.uri, cfg.ssl_cafile, cfg.ssl_cert, cfg.ssl_keyfile, test_topic)
@@ -0,0 +1,69 @@
+import re
+import json
+
+from config.loaders import load_checker_config
+from config.loaders import load_health_check_config
+
+
+def test_load_health_check_config_compiles_patterns(tmp_path, monkeypatch):
+    cfgpath = tmp_path / "checks.json"
+    cfgpath.write_text(json.dumps({"probes": [
+        {"url": "http://first", "period_sec": 10, "patterns": ["ok", "o+k"]},
+        {"url": "http://second", "period_sec": 10},
+    ]}))
+    monkeypatch.setenv("SPYGLASS_HEALTH_CHECKS_CONFIG", str(cfgpath))
+
+    checks, err = load_health_check_config()
+
+    assert err is None
+    assert [p.pattern for p in checks[0].patterns] == ["ok", "o+k"]
+    assert isinstance(checks[0].patterns[1], re.Pattern)
+    assert checks[0].patterns[0].search("is ok") is not None
+    assert checks[1].patterns == []
+
+    reloaded, err = load_health_check_config()
+    assert err is None
+    assert reloaded == checks
+
+
+def test_load_health_check_config_invalid_patterns(tmp_path, monkeypatch):
+    cfgpath = tmp_path / "checks.json"
+    cfgpath.write_text(json.dumps({"probes": [
+        {"url": "http://first", "period_sec": 10, "patterns": ["ok", "("]},
+        {"url": "http://second", "period_sec": 10, "patterns": ["[a-"]},
+    ]}))
+    monkeypatch.setenv("SPYGLASS_HEALTH_CHECKS_CONFIG", str(cfgpath))
+
+    checks, err = load_health_check_config()
+
+    assert checks is None
+    assert "http://first : pattern '('" in err
+    assert "http://second : pattern '[a-'" in err
+
+
+def test_load_checker_config_invalid_shards(monkeypatch):
+    monkeypatch.setenv("SPYGLASS_SHARD", "a")
+    for shards in ["a,,b", "a,a", "a,b,a"]:
+        monkeypatch.setenv("SPYGLASS_SHARDS", shards)
+        cfg, err = load_checker_config()
+        assert cfg is None
+        assert "SPYGLASS_SHARDS" in err
+
+    monkeypatch.setenv("SPYGLASS_SHARDS", "a, b")
+    cfg, err = load_checker_config()
+    assert err is None
+    assert cfg.shards == ["a", "b"]
+
+
+def test_load_checker_config_offload_processes_requires_min_bytes(
+        monkeypatch):
+    monkeypatch.setenv("SPYGLASS_PROBE_OFFLOAD_PROCESSES", "2")
+    cfg, err = load_checker_config()
+    assert cfg is None
+    assert "SPYGLASS_PROBE_OFFLOAD_PROCESSES" in err
+
+    monkeypatch.setenv("SPYGLASS_PROBE_OFFLOAD_MIN_BYTES", "1024")
+    cfg, err = load_checker_config()
+    assert err is None
+    assert cfg.offload_processes == 2
+    assert cfg.offload_min_bytes == 1024
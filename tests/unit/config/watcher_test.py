@@ -0,0 +1,47 @@
+import json
+import asyncio
+import pytest
+
+from config.watcher import watch_health_check_config
+
+
+def write_config(path, urls):
+    probes = [{"url": url, "period_sec": 10} for url in urls]
+    path.write_text(json.dumps({"probes": probes}))
+
+
+@pytest.mark.asyncio
+async def test_watch_health_check_config(tmp_path, monkeypatch):
+    cfgpath = tmp_path / "checks.json"
+    write_config(cfgpath, ["http://first"])
+    monkeypatch.setenv("SPYGLASS_HEALTH_CHECKS_CONFIG", str(cfgpath))
+
+    changes = []
+
+    def on_change(checks):
+        if len(checks) == 3:
+            raise ValueError("rejected")
+        changes.append([check.url for check in checks])
+
+    period = 0.01
+    watcher = asyncio.create_task(watch_health_check_config(on_change, period))
+
+    try:
+        await asyncio.sleep(period * 5)
+        assert changes == []
+
+        write_config(cfgpath, ["http://first", "http://second"])
+        await asyncio.sleep(period * 5)
+        assert changes == [["http://first", "http://second"]]
+
+        cfgpath.write_text("invalid json")
+        await asyncio.sleep(period * 5)
+        write_config(cfgpath, ["http://1", "http://2", "http://3"])
+        await asyncio.sleep(period * 5)
+        assert len(changes) == 1
+
+        write_config(cfgpath, ["http://third"])
+        await asyncio.sleep(period * 5)
+        assert changes[-1] == ["http://third"]
+    finally:
+        watcher.cancel()
@@ -1,9 +1,110 @@
 import asyncio
 import pytest
+from collections import namedtuple
+from datetime import datetime
+from datetime import timezone
+from urllib.parse import urlparse
 
+from health import probes
+from health.status import HealthStatus
 from health.checker import HealthChecker
 from health.checker import HealthCheck
-from health.checker import InvalidParamsError
+from health.errors import InvalidParamsError
+
+
+ProbeCall = namedtuple('ProbeCall', [
+    'time', 'url', 'patterns_list', 'many', 'client', 'max_body_bytes',
+    'dns_cache', 'method', 'validators', 'offload'])
+
+
+class FakeProbe:
+    """
+    Stands in for health.probes.http_probe and http_probe_many on the
+    checker, recording each call (see ProbeCall) and the max number of
+    probes in flight (in total, per url and per host).
+
+    Each probe takes delay_sec (or the delay of its url on delays) and
+    is healthy if healthy(url, patterns) is true. By default it is the
+    healthy attribute, so tests can change it while probing.
+    """
+
+    def __init__(self, monkeypatch, delay_sec=0, delays=None, healthy=None):
+        self.calls = []
+        self.healthy = True
+        self.max_in_flight = 0
+        self.max_in_flight_per_url = {}
+        self.max_in_flight_per_host = {}
+        self.__delay_sec = delay_sec
+        self.__delays = delays or {}
+        self.__is_healthy = healthy or (lambda url, patterns: self.healthy)
+        self.__in_flight = []
+        monkeypatch.setattr("health.checker.http_probe", self.probe)
+        monkeypatch.setattr("health.checker.http_probe_many", self.probe_many)
+
+    def urls(self):
+        return [call.url for call in self.calls]
+
+    def times(self, url):
+        return [call.time for call in self.calls if call.url == url]
+
+    async def probe(self, url, patterns=None, *args):
+        statuses = await self.__probe(url, [patterns], False, *args)
+        return statuses[0]
+
+    async def probe_many(self, url, patterns_list, *args):
+        return await self.__probe(url, patterns_list, True, *args)
+
+    async def __probe(self, url, patterns_list, many, client=None,
+                      max_body_bytes=None, dns_cache=None, method=None,
+                      validators=None, offload=None):
+        loop = asyncio.get_running_loop()
+        self.calls.append(ProbeCall(
+            loop.time(), url, patterns_list, many, client, max_body_bytes,
+            dns_cache, method, validators, offload))
+
+        self.__in_flight.append(url)
+        self.__record_in_flight(url)
+        try:
+            await asyncio.sleep(self.__delays.get(url, self.__delay_sec))
+        finally:
+            self.__in_flight.remove(url)
+
+        return [
+            self.__status(self.__is_healthy(url, patterns))
+            for patterns in patterns_list
+        ]
+
+    def __record_in_flight(self, url):
+        host = urlparse(url).netloc
+        in_flight_host = [u for u in self.__in_flight
+                          if urlparse(u).netloc == host]
+        self.max_in_flight = max(self.max_in_flight, len(self.__in_flight))
+        self.max_in_flight_per_url[url] = max(
+            self.max_in_flight_per_url.get(url, 0),
+            self.__in_flight.count(url))
+        self.max_in_flight_per_host[host] = max(
+            self.max_in_flight_per_host.get(host, 0), len(in_flight_host))
+
+    def __status(self, healthy):
+        return HealthStatus(
+            timestamp=datetime.now(timezone.utc),
+            healthy=healthy,
+            response_time_ms=1,
+            status_code=200 if healthy else 500,
+            error=None,
+        )
+
+
+async def wait_until(condition, timeout_sec=10):
+    """
+    Waits until the condition is true, instead of a fixed time,
+    so tests don't fail when the machine is loaded.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_sec
+    while not condition():
+        assert loop.time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.005)
 
 
 @pytest.mark.asyncio
@@ -37,7 +138,7 @@ async def test_health_checker_probes_all_checks(httpx_mock):
         max_period = max(period1, period2, period3)
         await asyncio.sleep(max_period + max_time_skew_sec)
     finally:
-        checker.stop()
+        await checker.close()
 
     results_urls = {}
 
@@ -66,6 +167,13 @@ def test_health_checker_check_validation():
         HealthCheck(url="http://", period_sec=1),
         HealthCheck(url="http://valid_url", period_sec=0),
         HealthCheck(url="http://valid_url", period_sec=-1),
+        HealthCheck(url="http://valid_url", period_sec=1, patterns=["("]),
+        HealthCheck(url="http://valid_url", period_sec=1, max_body_bytes=0),
+        HealthCheck(url="http://valid_url", period_sec=1, max_period_sec=0.5),
+        HealthCheck(url="http://valid_url", period_sec=1, method="post"),
+        HealthCheck(
+            url="http://valid_url", period_sec=1, method="head",
+            patterns=["a"]),
     ]
 
     for check in invalid_checks:
@@ -74,3 +182,534 @@ def test_health_checker_check_validation():
 
     with pytest.raises(InvalidParamsError):
         HealthChecker(nop_handler, [])
+
+
+@pytest.mark.asyncio
+async def test_health_checker_with_workers_probes_all_checks(monkeypatch):
+    fake = FakeProbe(monkeypatch)
+    results = []
+
+    async def results_handler(url, status):
+        results.append((url, status))
+
+    urls = [f"http://test{i}" for i in range(4)]
+    checks = [HealthCheck(url=url, period_sec=0.05) for url in urls]
+    checker = HealthChecker(results_handler, checks, workers=2)
+
+    try:
+        checker.start()
+        await wait_until(lambda: set(fake.urls()) == set(urls))
+    finally:
+        await checker.close()
+
+    assert {url for url, _ in results} == set(urls)
+    assert all(status.healthy for _, status in results)
+
+
+@pytest.mark.asyncio
+async def test_health_checker_with_workers_keeps_period(monkeypatch):
+    period = 0.05
+    fake = FakeProbe(monkeypatch, delay_sec=period * 0.6)
+
+    async def results_handler(url, status):
+        pass
+
+    url = "http://test_health_checker_with_workers_keeps_period"
+    checker = HealthChecker(
+        results_handler,
+        [HealthCheck(url=url, period_sec=period)],
+        workers=1,
+    )
+
+    try:
+        checker.start()
+        await wait_until(lambda: len(fake.calls) >= 8)
+    finally:
+        await checker.close()
+
+    # WHY: deadlines are absolute, so the time spent on each probe is
+    # not added to the period. If it were every gap between probes
+    # would be at least 1.6 periods, with absolute deadlines a late
+    # probe is followed by one on time, with a gap of about a period.
+    times = fake.times(url)
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) < period * 1.5
+
+
+@pytest.mark.asyncio
+async def test_health_checker_with_workers_one_probe_per_check(monkeypatch):
+    fake = FakeProbe(monkeypatch, delays={"http://slow": 0.1})
+
+    async def results_handler(url, status):
+        pass
+
+    checker = HealthChecker(
+        results_handler,
+        [
+            HealthCheck(url="http://slow", period_sec=0.02),
+            HealthCheck(url="http://fast1", period_sec=0.02),
+            HealthCheck(url="http://fast2", period_sec=0.02),
+        ],
+        workers=4,
+    )
+
+    try:
+        tasks = checker.start()
+        await asyncio.sleep(0.35)
+    finally:
+        await checker.close()
+    await asyncio.wait(tasks, timeout=1)
+
+    # WHY: the slow probe takes 5 periods, its deadlines while it is
+    # in flight are skipped instead of taking all the workers.
+    assert fake.max_in_flight_per_url["http://slow"] == 1
+    assert 3 <= fake.urls().count("http://slow") <= 4
+    assert fake.urls().count("http://fast1") >= 10
+    assert fake.urls().count("http://fast2") >= 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [None, 1])
+async def test_health_checker_stop_finishes_tasks_right_away(
+        monkeypatch, workers):
+    fake = FakeProbe(monkeypatch, delay_sec=0.5)
+
+    async def results_handler(url, status):
+        pass
+
+    checker = HealthChecker(
+        results_handler,
+        [
+            HealthCheck(url=f"http://check{i}", period_sec=0.01)
+            for i in range(4)
+        ] + [HealthCheck(url="http://idle", period_sec=10)],
+        workers=workers,
+    )
+
+    tasks = checker.start()
+    await asyncio.sleep(0.05)
+    checker.stop()
+
+    # WHY: only the tasks with probes in flight wait for them, the
+    # scheduler doesn't wait for a busy worker to take the stop signal
+    # and sleeping schedulers are woken up.
+    in_flight = len(fake.calls)
+    done, pending = await asyncio.wait(tasks, timeout=0.1)
+    assert len(pending) == in_flight
+    if workers is not None:
+        assert tasks[0] in done
+
+    await checker.close()
+    assert all(task.done() for task in tasks)
+
+
+def test_health_checker_workers_validation():
+
+    async def nop_handler():
+        pass
+
+    check = HealthCheck(url="http://valid_url", period_sec=1)
+
+    for workers in [0, -1]:
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(nop_handler, [check], workers=workers)
+
+
+@pytest.mark.asyncio
+async def test_health_checker_limits_probes_in_flight(monkeypatch):
+    fake = FakeProbe(monkeypatch, delay_sec=0.02)
+
+    results = []
+
+    async def results_handler(url, status):
+        results.append((url, status))
+
+    checks = []
+    for host in range(3):
+        for path in range(4):
+            url = f"http://host{host}/path{path}"
+            checks.append(HealthCheck(url=url, period_sec=0.01))
+
+    checker = HealthChecker(
+        results_handler,
+        checks,
+        max_in_flight=4,
+        max_in_flight_per_host=2,
+    )
+
+    try:
+        checker.start()
+        await asyncio.sleep(0.2)
+    finally:
+        await checker.close()
+
+    assert len(results) > 0
+    assert fake.max_in_flight == 4
+    assert max(fake.max_in_flight_per_host.values()) == 2
+
+    wait_stats = checker.probe_wait_stats()
+    assert wait_stats.count >= len(results)
+    assert wait_stats.total_sec > 0
+    assert 0 < wait_stats.max_sec <= wait_stats.total_sec
+
+
+def test_health_checker_limits_validation():
+
+    async def nop_handler():
+        pass
+
+    check = HealthCheck(url="http://valid_url", period_sec=1)
+
+    for limit in [0, -1]:
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(nop_handler, [check], max_in_flight=limit)
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(nop_handler, [check], max_in_flight_per_host=limit)
+
+
+@pytest.mark.asyncio
+async def test_health_checker_warm_checks_share_pooled_client(monkeypatch):
+    fake = FakeProbe(monkeypatch)
+
+    async def results_handler(url, status):
+        pass
+
+    cold_url = "http://cold"
+    warm_url1 = "http://warm1"
+    warm_url2 = "http://warm2"
+
+    checker = HealthChecker(results_handler, [
+        HealthCheck(url=cold_url, period_sec=0.01),
+        HealthCheck(url=warm_url1, period_sec=0.01, warm=True),
+        HealthCheck(url=warm_url2, period_sec=0.01, warm=True),
+    ])
+
+    try:
+        checker.start()
+        await asyncio.sleep(0.05)
+    finally:
+        await checker.close()
+
+    clients = {}
+    for call in fake.calls:
+        clients.setdefault(call.url, set()).add(call.client)
+
+    assert clients[cold_url] == {None}
+    assert len(clients[warm_url1]) == 1
+    assert clients[warm_url1] == clients[warm_url2]
+    assert None not in clients[warm_url1]
+
+
+@pytest.mark.asyncio
+async def test_health_checker_pooled_client_keepalive_and_close(monkeypatch):
+    fake = FakeProbe(monkeypatch, delays={"http://long": 0.2})
+    expiries = {}
+    closed = []
+
+    # WHY: the fake probes don't use the clients, which httpx reports
+    # as closed (is_closed) until they are used, so closing is recorded.
+    def new_pooled_client(keepalive_expiry_sec):
+        client = probes.new_pooled_client(keepalive_expiry_sec)
+        expiries[client] = keepalive_expiry_sec
+        aclose = client.aclose
+
+        async def recording_aclose():
+            closed.append(client)
+            await aclose()
+
+        client.aclose = recording_aclose
+        return client
+
+    monkeypatch.setattr("health.checker.new_pooled_client", new_pooled_client)
+
+    async def results_handler(url, status):
+        pass
+
+    short = HealthCheck(url="http://short", period_sec=0.01, warm=True)
+    long = HealthCheck(url="http://long", period_sec=0.01, warm=True,
+                       max_period_sec=5)
+    checker = HealthChecker(results_handler, [short])
+
+    def last_client(url):
+        return [call.client for call in fake.calls if call.url == url][-1]
+
+    try:
+        checker.start()
+        await wait_until(lambda: "http://short" in fake.urls())
+        first = last_client("http://short")
+        assert expiries[first] == 0.02
+
+        # WHY: the connections of checks added later must not
+        # expire between their probes, the expiry of a pool can't
+        # be changed, so the client is replaced.
+        checker.add(long)
+        await wait_until(lambda: "http://long" in fake.urls())
+        second = last_client("http://long")
+        assert expiries[second] == 10
+        await wait_until(lambda: first in closed)
+
+        # WHY: the probe of the long check is still in flight
+        checker.remove(long)
+        await wait_until(lambda: last_client("http://short") not in (
+            first, second))
+        third = last_client("http://short")
+        assert expiries[third] == 0.02
+        assert second not in closed
+        await wait_until(lambda: second in closed)
+    finally:
+        await checker.close()
+
+    assert closed == [first, second, third]
+    assert {call.client for call in fake.calls} == {first, second, third}
+
+
+@pytest.mark.asyncio
+async def test_health_checker_dns_cached_checks_share_cache(monkeypatch):
+    fake = FakeProbe(monkeypatch)
+
+    async def results_handler(url, status):
+        pass
+
+    cold_url = "http://cold"
+    cached_url1 = "http://cached1"
+    cached_url2 = "http://cached2"
+
+    checker = HealthChecker(results_handler, [
+        HealthCheck(url=cold_url, period_sec=0.01),
+        HealthCheck(url=cached_url1, period_sec=0.01, dns_cache=True),
+        HealthCheck(url=cached_url2, period_sec=0.01, dns_cache=True),
+    ])
+
+    try:
+        checker.start()
+        await asyncio.sleep(0.05)
+    finally:
+        await checker.close()
+
+    caches = {}
+    for call in fake.calls:
+        caches.setdefault(call.url, set()).add(call.dns_cache)
+
+    assert caches[cold_url] == {None}
+    assert len(caches[cached_url1]) == 1
+    assert caches[cached_url1] == caches[cached_url2]
+    assert None not in caches[cached_url1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [None, 1])
+async def test_health_checker_adaptive_period(monkeypatch, workers):
+    fake = FakeProbe(monkeypatch)
+
+    async def results_handler(url, status):
+        pass
+
+    period = 0.02
+    max_period = 0.16
+    checker = HealthChecker(
+        results_handler,
+        [HealthCheck(url="http://adaptive", period_sec=period,
+                     max_period_sec=max_period)],
+        workers=workers,
+    )
+
+    try:
+        checker.start()
+        await asyncio.sleep(0.5)
+        healthy_probes = len(fake.calls)
+        fake.healthy = False
+        await asyncio.sleep(0.5)
+    finally:
+        await checker.close()
+
+    # WHY: with a fixed period there would be 25 probes, backing off
+    # it should be around 6 (0.02 + 0.04 + 0.08 + 0.16 + 0.16...).
+    assert 3 <= healthy_probes <= 10
+
+    # WHY: the first unhealthy probe may take up to max_period, after
+    # that the period snaps back and probes are done every period.
+    times = [call.time for call in fake.calls]
+    unhealthy = times[healthy_probes:]
+    assert len(unhealthy) >= 10
+    assert unhealthy[0] - times[healthy_probes - 1] <= max_period * 1.5
+    gaps = [b - a for a, b in zip(unhealthy, unhealthy[1:])]
+    assert max(gaps) <= period * 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [None, 2])
+async def test_health_checker_add_remove_update(monkeypatch, workers):
+    fake = FakeProbe(monkeypatch)
+
+    async def results_handler(url, status):
+        pass
+
+    period = 0.02
+    kept = HealthCheck(url="http://kept", period_sec=period, patterns=["k"])
+    removed = HealthCheck(url="http://removed", period_sec=period)
+    added = HealthCheck(url="http://added", period_sec=period)
+    checker = HealthChecker(results_handler, [kept, removed], workers=workers)
+
+    try:
+        checker.start()
+        await asyncio.sleep(0.1)
+        loop = asyncio.get_running_loop()
+        update_time = loop.time()
+        assert checker.update([kept, added]) == (1, 1)
+        await asyncio.sleep(0.1)
+        assert checker.update([kept, added]) == (0, 0)
+        checker.remove(added)
+        remove_time = loop.time()
+        await asyncio.sleep(0.1)
+    finally:
+        await checker.close()
+
+    assert checker.checks() == [HealthChecker(
+        results_handler, [kept]).checks()[0]]
+
+    # WHY: a probe may have been already dispatched when it is removed
+    assert len([t for t in fake.times(removed.url) if t > update_time]) <= 1
+    assert len([t for t in fake.times(added.url) if t > remove_time]) <= 1
+    assert len(fake.times(added.url)) >= 3
+
+    # WHY: the kept check is not rescheduled, its period is not disturbed.
+    kept_times = fake.times(kept.url)
+    assert len(kept_times) >= 10
+    gaps = [b - a for a, b in zip(kept_times, kept_times[1:])]
+    assert max(gaps) <= period * 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [None, 4])
+async def test_health_checker_coalesces_same_url_checks(monkeypatch, workers):
+    fake = FakeProbe(
+        monkeypatch, healthy=lambda url, patterns: patterns is None)
+
+    results = []
+
+    async def results_handler(url, status):
+        results.append((url, status.healthy))
+
+    shared_url = "http://shared"
+    other_url = "http://other"
+    checker = HealthChecker(
+        results_handler,
+        [
+            HealthCheck(url=shared_url, period_sec=0.05),
+            HealthCheck(url=shared_url, period_sec=0.05, patterns=["a"]),
+            HealthCheck(url=shared_url, period_sec=0.05, patterns=["b"]),
+            HealthCheck(url=other_url, period_sec=0.05),
+        ],
+        workers=workers,
+        coalesce_window_sec=0.04,
+    )
+
+    try:
+        tasks = checker.start()
+        await asyncio.sleep(0.3)
+    finally:
+        await checker.close()
+
+    # WHY: probes already scheduled (or waiting the window) finish
+    await asyncio.wait(tasks, timeout=1)
+
+    single_probes = [call.url for call in fake.calls if not call.many]
+    many_probes = [
+        (call.url, call.patterns_list) for call in fake.calls if call.many]
+
+    assert set(single_probes) == {other_url}
+    assert len(many_probes) > 0
+
+    shared_results = [healthy for url, healthy in results if url == shared_url]
+    probed = [p for _, patterns_list in many_probes for p in patterns_list]
+    assert len(shared_results) == len(probed)
+    assert shared_results.count(True) == probed.count(None)
+
+    # WHY: with workers the checks of the same url are scheduled
+    # together too, so every round coalesces all of them.
+    for url, patterns_list in many_probes:
+        assert url == shared_url
+        assert len(patterns_list) == 3
+
+
+@pytest.mark.asyncio
+async def test_health_checker_with_workers_waits_window_only_if_others_due(
+        monkeypatch):
+    fake = FakeProbe(monkeypatch)
+
+    async def results_handler(url, status):
+        pass
+
+    url = "http://shared"
+    checker = HealthChecker(
+        results_handler,
+        [
+            HealthCheck(url=url, period_sec=0.05),
+            HealthCheck(url=url, period_sec=10, patterns=["a"]),
+        ],
+        workers=2,
+        coalesce_window_sec=0.2,
+    )
+
+    try:
+        tasks = checker.start()
+        await asyncio.sleep(0.6)
+    finally:
+        await checker.close()
+    await asyncio.wait(tasks, timeout=1)
+
+    # WHY: the slow check is not due, so the fast check is probed
+    # without waiting the window, otherwise (holding the worker while
+    # waiting) it would be probed at most every 0.2s.
+    assert len(fake.times(url)) >= 6
+
+
+def test_health_checker_coalesce_validation():
+
+    async def nop_handler():
+        pass
+
+    check = HealthCheck(url="http://valid_url", period_sec=1)
+
+    for window in [0, -1]:
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(nop_handler, [check], coalesce_window_sec=window)
+
+
+def test_health_checker_offload_validation():
+
+    async def nop_handler():
+        pass
+
+    check = HealthCheck(url="http://valid_url", period_sec=1)
+
+    for value in [0, -1]:
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(nop_handler, [check], offload_min_bytes=value)
+        with pytest.raises(InvalidParamsError):
+            HealthChecker(
+                nop_handler, [check], offload_min_bytes=1024,
+                offload_processes=value)
+
+    with pytest.raises(InvalidParamsError):
+        HealthChecker(nop_handler, [check], offload_processes=1)
+
+
+def test_health_checker_add_remove_update_validation():
+
+    async def nop_handler():
+        pass
+
+    check = HealthCheck(url="http://valid_url", period_sec=1)
+    checker = HealthChecker(nop_handler, [check])
+
+    with pytest.raises(InvalidParamsError):
+        checker.add(HealthCheck(url="http://valid_url", period_sec=0))
+    with pytest.raises(InvalidParamsError):
+        checker.remove(HealthCheck(url="http://not_added", period_sec=1))
+    with pytest.raises(InvalidParamsError):
+        checker.update([])
+    with pytest.raises(InvalidParamsError):
+        checker.update([HealthCheck(url="http://valid_url", period_sec=0)])
+
+    assert len(checker.checks()) == 1
@@ -0,0 +1,138 @@
+import pytest
+from datetime import datetime
+from datetime import timezone
+
+from health import codec
+from health.status import HealthStatus
+from health.status import HealthError
+from health.status import HealthErrorKind
+from health.status import ProbeTimings
+
+
+def test_codec_encodings_roundtrip():
+    url = "https://codec.test/path?query=1"
+    statuses = [
+        success_health_status(),
+        failure_health_status(HealthErrorKind.HTTP, []),
+        failure_health_status(HealthErrorKind.REGEX, ["some", "détails"]),
+        failure_health_status(HealthErrorKind.TIMEOUT, ["timeout"]),
+    ]
+
+    for encoding in codec.ENCODINGS:
+        for status in statuses:
+            value = codec.encode(url, status, encoding)
+            got_url, got_status = codec.decode(value, encoding)
+
+            assert got_url == url
+            assert got_status == status
+            assert got_status.timestamp.tzinfo == timezone.utc
+
+
+def test_codec_timings_roundtrip():
+    url = "https://codec.test"
+    timings = ProbeTimings(
+        dns_ms=1.234, connect_ms=0.5, tls_ms=None, ttfb_ms=20.001,
+        total_ms=3600000.0)
+    statuses = [
+        success_health_status()._replace(timings=timings),
+        failure_health_status(HealthErrorKind.TIMEOUT, ["timeout"])._replace(
+            timings=timings._replace(ttfb_ms=None)),
+    ]
+
+    for encoding in (codec.JSON, codec.COMPACT_V2):
+        for status in statuses:
+            value = codec.encode(url, status, encoding)
+            assert codec.decode(value, encoding) == (url, status)
+
+    # WHY: compact-v1 has no timings, they are not encoded
+    for status in statuses:
+        value = codec.encode(url, status, codec.COMPACT_V1)
+        _, got_status = codec.decode(value, codec.COMPACT_V1)
+        assert got_status == status._replace(timings=None)
+
+
+def test_codec_compact_v1_logs_dropped_timings(monkeypatch, caplog):
+    monkeypatch.setattr(codec, "_timings_dropped_logged", False)
+    url = "https://codec.test"
+    status = success_health_status()
+
+    codec.encode(url, status, codec.COMPACT_V1)
+    assert caplog.records == []
+
+    timings = ProbeTimings(
+        dns_ms=None, connect_ms=None, tls_ms=None, ttfb_ms=1.0,
+        total_ms=2.0)
+    for _ in range(3):
+        codec.encode(url, status._replace(timings=timings), codec.COMPACT_V1)
+    codec.encode(url, status._replace(timings=timings), codec.COMPACT_V2)
+
+    assert len(caplog.records) == 1
+    assert caplog.records[0].levelname == "WARNING"
+    assert codec.COMPACT_V2 in caplog.records[0].getMessage()
+
+
+def test_codec_decodes_json_by_default():
+    url = "https://codec.test"
+    status = success_health_status()
+
+    value = codec.encode(url, status)
+
+    assert codec.decode(value) == (url, status)
+
+
+def test_codec_compact_is_smaller_than_json():
+    url = "https://codec.test"
+    status = failure_health_status(HealthErrorKind.REGEX, ["detail"])
+
+    json_value = codec.encode(url, status, codec.JSON)
+    compact_value = codec.encode(url, status, codec.COMPACT_V1)
+
+    assert len(compact_value) * 2 < len(json_value)
+
+
+def test_codec_compact_preserves_error_kind():
+    url = "https://codec.test"
+    status = failure_health_status(HealthErrorKind.UNKNOWN, ["err"])
+
+    value = codec.encode(url, status, codec.COMPACT_V1)
+    _, got_status = codec.decode(value, codec.COMPACT_V1)
+
+    assert got_status.error.kind is HealthErrorKind.UNKNOWN
+
+
+def test_codec_invalid_messages():
+    url = "https://codec.test"
+    value = codec.encode(url, success_health_status(), codec.COMPACT_V1)
+
+    with pytest.raises(codec.InvalidEncodingError):
+        codec.decode(value[:-1], codec.COMPACT_V1)
+
+    with pytest.raises(codec.InvalidEncodingError):
+        codec.decode(value + b"x", codec.COMPACT_V1)
+
+    with pytest.raises(codec.InvalidEncodingError):
+        codec.decode(value, "unknown")
+
+    with pytest.raises(codec.InvalidEncodingError):
+        codec.encode(url, success_health_status(), "unknown")
+
+
+def success_health_status():
+    return HealthStatus(
+        timestamp=datetime.now(timezone.utc),
+        healthy=True,
+        response_time_ms=50,
+        status_code=200,
+        error=None,
+        connection_reused=True,
+    )
+
+
+def failure_health_status(kind, details):
+    return HealthStatus(
+        timestamp=datetime.now(timezone.utc),
+        healthy=False,
+        response_time_ms=0,
+        status_code=0,
+        error=HealthError(kind=kind, details=details),
+    )
@@ -0,0 +1,212 @@
+import asyncio
+import pytest
+from datetime import datetime
+from datetime import timezone
+
+from health.status import HealthStatus
+from health.pubsub import HealthMessage
+from health.collector import HealthCollector
+from health.errors import InvalidParamsError
+
+
+class FakeSubscriber:
+
+    def __init__(self, statuses, delay_sec=0, partitions=1):
+        self.statuses = list(statuses)
+        self.delay_sec = delay_sec
+        self.partitions = partitions
+        self.acked = []
+        self.committed = []
+
+    async def batches(self):
+        for offset, (url, status) in enumerate(self.statuses):
+            await asyncio.sleep(self.delay_sec)
+            partition = offset % self.partitions
+            yield {partition: [HealthMessage(
+                url=url,
+                status=status,
+                partition=partition,
+                offset=offset,
+            )]}
+
+    def ack(self, msg):
+        self.acked.append(msg.offset)
+
+    async def commit(self):
+        self.committed = list(self.acked)
+
+
+class FakeStore:
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.saved = []
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def save(self, url, status):
+        await self.save_many([(url, status)])
+
+    async def save_many(self, statuses):
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("fake store failure")
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+
+        self.batches.append(list(statuses))
+        self.saved.extend(statuses)
+        return len(statuses)
+
+
+@pytest.mark.asyncio
+async def test_health_collector_saves_all_statuses():
+    statuses = new_statuses(10)
+    subscriber = FakeSubscriber(statuses)
+    store = FakeStore()
+    collector = HealthCollector(subscriber, store)
+
+    await collector.run()
+
+    assert store.saved == statuses
+    assert store.max_in_flight == 1
+    for batch in store.batches:
+        assert len(batch) == 1
+    assert subscriber.committed == list(range(len(statuses)))
+
+
+@pytest.mark.asyncio
+async def test_health_collector_concurrent_writers_with_batches():
+    statuses = new_statuses(50)
+    subscriber = FakeSubscriber(statuses, partitions=3)
+    store = FakeStore()
+    collector = HealthCollector(
+        subscriber,
+        store,
+        writers=3,
+        batch_size=5,
+    )
+
+    await collector.run()
+
+    assert sorted(store.saved) == sorted(statuses)
+    assert sorted(subscriber.committed) == list(range(len(statuses)))
+    assert store.max_in_flight == 3
+    for batch in store.batches:
+        assert 1 <= len(batch) <= 5
+
+
+@pytest.mark.asyncio
+async def test_health_collector_saves_batch_after_max_delay():
+    statuses = new_statuses(3)
+    delay_sec = 0.05
+    store = FakeStore()
+    collector = HealthCollector(
+        FakeSubscriber(statuses, delay_sec=delay_sec),
+        store,
+        batch_size=100,
+        batch_max_delay_sec=delay_sec / 2,
+    )
+
+    await collector.run()
+
+    assert store.saved == statuses
+    assert store.batches == [[status] for status in statuses]
+
+
+@pytest.mark.asyncio
+async def test_health_collector_retries_failed_saves():
+    statuses = new_statuses(4)
+    subscriber = FakeSubscriber(statuses)
+    store = FakeStore(failures=2)
+    collector = HealthCollector(
+        subscriber,
+        store,
+        batch_size=4,
+        max_retries=2,
+        retry_backoff_sec=0.01,
+    )
+
+    await collector.run()
+
+    assert store.saved == statuses
+    assert subscriber.committed == list(range(len(statuses)))
+
+
+@pytest.mark.asyncio
+async def test_health_collector_gives_up_without_ack():
+    statuses = new_statuses(4)
+    subscriber = FakeSubscriber(statuses)
+    store = FakeStore(failures=3)
+    collector = HealthCollector(
+        subscriber,
+        store,
+        batch_size=4,
+        max_retries=2,
+        retry_backoff_sec=0.01,
+    )
+
+    with pytest.raises(Exception):
+        await collector.run()
+
+    assert store.saved == []
+    assert subscriber.acked == []
+    assert subscriber.committed == []
+
+
+@pytest.mark.asyncio
+async def test_health_collector_keeps_partitions_order():
+    statuses = new_statuses(60)
+    partitions = 4
+    subscriber = FakeSubscriber(statuses, partitions=partitions)
+    store = FakeStore()
+    collector = HealthCollector(
+        subscriber,
+        store,
+        writers=partitions,
+        batch_size=3,
+    )
+
+    await collector.run()
+
+    assert sorted(store.saved) == sorted(statuses)
+    assert store.max_in_flight > 1
+
+    for partition in range(partitions):
+        expected = statuses[partition::partitions]
+        saved = [s for s in store.saved if s in expected]
+        assert saved == expected
+
+
+def test_health_collector_params_validation():
+    invalid_params = [
+        {"writers": 0},
+        {"writers": -1},
+        {"batch_size": 0},
+        {"batch_size": -1},
+        {"batch_max_delay_sec": 0},
+        {"batch_max_delay_sec": -1},
+        {"max_retries": -1},
+        {"retry_backoff_sec": -1},
+    ]
+
+    for params in invalid_params:
+        with pytest.raises(InvalidParamsError):
+            HealthCollector(FakeSubscriber([]), FakeStore(), **params)
+
+
+def new_statuses(count):
+    statuses = []
+    for i in range(count):
+        statuses.append((f"http://test{i}", HealthStatus(
+            timestamp=datetime.now(timezone.utc),
+            healthy=True,
+            response_time_ms=i,
+            status_code=200,
+            error=None,
+        )))
+    return statuses
@@ -0,0 +1,154 @@
+import socket
+import asyncio
+import pytest
+
+from health.dns import DNSCache
+from health.errors import InvalidParamsError
+from health.probes import http_probe
+
+
+class FakeResolver:
+    def __init__(self, delay_sec=0):
+        self.lookups = []
+        self.delay_sec = delay_sec
+
+    async def __call__(self, host, port, type=0):
+        self.lookups.append((host, port))
+        await asyncio.sleep(self.delay_sec)
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "name not known")
+        return [(socket.AF_INET, type, 6, "", ("127.0.0.1", port))]
+
+
+@pytest.mark.asyncio
+async def test_dns_cache_caches_addresses_until_ttl():
+    resolver = FakeResolver()
+    cache = DNSCache(ttl_sec=0.05, resolver=resolver)
+
+    first = await cache.getaddrinfo("cached.test", 80)
+    assert await cache.getaddrinfo("cached.test", 80) == first
+    assert resolver.lookups == [("cached.test", 80)]
+
+    await cache.getaddrinfo("cached.test", 443)
+    await cache.getaddrinfo("other.test", 80)
+    assert len(resolver.lookups) == 3
+
+    await asyncio.sleep(0.06)
+    assert await cache.getaddrinfo("cached.test", 80) == first
+    assert len(resolver.lookups) == 4
+
+
+@pytest.mark.asyncio
+async def test_dns_cache_caches_failures_until_negative_ttl():
+    resolver = FakeResolver()
+    cache = DNSCache(negative_ttl_sec=0.05, resolver=resolver)
+
+    for _ in range(3):
+        with pytest.raises(socket.gaierror):
+            await cache.getaddrinfo("fail.invalid", 80)
+    assert len(resolver.lookups) == 1
+
+    await asyncio.sleep(0.06)
+    with pytest.raises(socket.gaierror):
+        await cache.getaddrinfo("fail.invalid", 80)
+    assert len(resolver.lookups) == 2
+
+    no_negative = DNSCache(negative_ttl_sec=0, resolver=resolver)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            await no_negative.getaddrinfo("fail.invalid", 80)
+    assert len(resolver.lookups) == 4
+
+
+@pytest.mark.asyncio
+async def test_dns_cache_raises_new_error_for_each_cached_failure():
+    resolver = FakeResolver()
+    cache = DNSCache(resolver=resolver)
+
+    errs = []
+    for _ in range(3):
+        with pytest.raises(socket.gaierror) as err:
+            await cache.getaddrinfo("fail.invalid", 80)
+        errs.append(err.value)
+    assert len(resolver.lookups) == 1
+
+    cached = errs[1:]
+    assert cached[0] is not cached[1]
+    for err in cached:
+        assert err.args == errs[0].args
+        assert str(err) == str(errs[0])
+
+    def depth(err):
+        tb = err.__traceback__
+        n = 0
+        while tb is not None:
+            n += 1
+            tb = tb.tb_next
+        return n
+
+    assert depth(cached[0]) == depth(cached[1])
+
+
+@pytest.mark.asyncio
+async def test_dns_cache_shares_concurrent_lookups():
+    resolver = FakeResolver(delay_sec=0.02)
+    cache = DNSCache(resolver=resolver)
+
+    results = await asyncio.gather(*[
+        cache.getaddrinfo("shared.test", 80) for _ in range(10)])
+
+    assert resolver.lookups == [("shared.test", 80)]
+    assert all(r == results[0] for r in results)
+
+    # WHY: a caller timing out doesn't cancel the shared lookup
+    cache.clear()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(cache.getaddrinfo("shared.test", 80), 0.001)
+    await cache.getaddrinfo("shared.test", 80)
+    assert len(resolver.lookups) == 2
+
+
+@pytest.mark.asyncio
+async def test_dns_cache_evicts_entries():
+    resolver = FakeResolver()
+    cache = DNSCache(max_entries=2, resolver=resolver)
+
+    for host in ["a.test", "b.test", "c.test", "c.test", "a.test"]:
+        await cache.getaddrinfo(host, 80)
+
+    assert [host for host, _ in resolver.lookups] == [
+        "a.test", "b.test", "c.test", "a.test"]
+
+
+@pytest.mark.asyncio
+async def test_http_probe_resolves_through_dns_cache():
+    resolver = FakeResolver()
+    cache = DNSCache(resolver=resolver)
+
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        for _ in range(3):
+            res = await http_probe(
+                f"http://cached.test:{port}/", dns_cache=cache)
+            assert res.healthy
+            assert res.timings.dns_ms is not None
+    finally:
+        server.close()
+
+    assert resolver.lookups == [("cached.test", port)]
+
+
+def test_dns_cache_validation():
+    with pytest.raises(InvalidParamsError):
+        DNSCache(ttl_sec=0)
+    with pytest.raises(InvalidParamsError):
+        DNSCache(negative_ttl_sec=-1)
+    with pytest.raises(InvalidParamsError):
+        DNSCache(max_entries=0)
@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+
+from health.metrics import InvalidMetricError
+from health.metrics import Registry
+from health.metrics import serve_metrics
+
+
+def test_counter_and_gauge_rendering():
+    registry = Registry()
+    probes = registry.counter("probes_total", "Probes done")
+    in_flight = registry.gauge("in_flight", "Probes in flight")
+    lag = registry.gauge("lag", "Lag", labels=("topic", "partition"))
+
+    probes.inc()
+    probes.inc(2)
+    in_flight.inc()
+    in_flight.inc()
+    in_flight.dec()
+    lag.labels("health", 0).set(10)
+    lag.labels("health", 1).set(0.5)
+
+    assert registry.render() == "\n".join([
+        "# HELP probes_total Probes done",
+        "# TYPE probes_total counter",
+        "probes_total 3",
+        "# HELP in_flight Probes in flight",
+        "# TYPE in_flight gauge",
+        "in_flight 1",
+        "# HELP lag Lag",
+        "# TYPE lag gauge",
+        'lag{topic="health",partition="0"} 10',
+        'lag{topic="health",partition="1"} 0.5',
+    ]) + "\n"
+
+
+def test_histogram_rendering():
+    registry = Registry()
+    duration = registry.histogram(
+        "duration_seconds", "Duration", buckets=(1, 0.1), labels=("healthy",))
+
+    duration.labels("true").observe(0.05)
+    duration.labels("true").observe(0.1)
+    duration.labels("true").observe(0.5)
+    duration.labels("true").observe(5)
+
+    assert registry.render() == "\n".join([
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{healthy="true",le="0.1"} 2',
+        'duration_seconds_bucket{healthy="true",le="1"} 3',
+        'duration_seconds_bucket{healthy="true",le="+Inf"} 4',
+        'duration_seconds_sum{healthy="true"} 5.65',
+        'duration_seconds_count{healthy="true"} 4',
+    ]) + "\n"
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    errors = registry.counter("errors_total", "Errors", labels=("err",))
+    errors.labels('bad "quote"\\\n').inc()
+
+    lines = registry.render().splitlines()
+    assert lines[-1] == r'errors_total{err="bad \"quote\"\\\n"} 1'
+
+
+def test_invalid_metrics():
+    registry = Registry()
+    registry.counter("dup", "Dup")
+    with pytest.raises(InvalidMetricError):
+        registry.gauge("dup", "Dup")
+    with pytest.raises(InvalidMetricError):
+        registry.histogram("no_buckets", "No buckets", buckets=())
+
+    labeled = registry.counter("labeled", "Labeled", labels=("a", "b"))
+    with pytest.raises(InvalidMetricError):
+        labeled.labels("a")
+    with pytest.raises(InvalidMetricError):
+        labeled.inc()
+
+
+@pytest.mark.asyncio
+async def test_serve_metrics():
+    registry = Registry()
+    registry.counter("probes_total", "Probes done").inc(7)
+
+    server = await serve_metrics("127.0.0.1", 0, registry)
+    port = server.sockets[0].getsockname()[1]
+
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    head, body = response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert body == registry.render().encode()
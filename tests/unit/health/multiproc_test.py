@@ -0,0 +1,128 @@
+import asyncio
+import pytest
+
+from health import codec
+from health.checker import HealthCheck
+from health.errors import InvalidParamsError
+from health.multiproc import MultiProcessChecker
+
+
+async def start_server():
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Length: 7\r\n"
+            b"Connection: close\r\n"
+            b"\r\n"
+            b"healthy"
+        )
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return f"http://127.0.0.1:{port}", server
+
+
+async def wait_for(condition, timeout_sec):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_sec
+    while not condition() and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_multiprocess_checker_probes_all_checks():
+    base_url, server = await start_server()
+    results = {}
+
+    async def handler(url, value):
+        results.setdefault(url, []).append(
+            codec.decode(value, codec.COMPACT_V1))
+
+    checks = [
+        HealthCheck(url=f"{base_url}/{i}", period_sec=0.1,
+                    patterns=["healthy"])
+        for i in range(6)
+    ]
+    updated_checks = checks[2:] + [
+        HealthCheck(url=f"{base_url}/new", period_sec=0.1)]
+
+    checker = MultiProcessChecker(
+        handler, checks, processes=2, encoding=codec.COMPACT_V1, workers=2)
+    tasks = checker.start()
+
+    try:
+        # WHY: spawning processes is slow, so a generous timeout.
+        await wait_for(lambda: len(results) == len(checks), 30)
+        assert sorted(results) == sorted(c.url for c in checks)
+
+        checker.update(updated_checks)
+        await wait_for(lambda: f"{base_url}/new" in results, 10)
+        assert f"{base_url}/new" in results
+    finally:
+        await checker.close()
+        server.close()
+    assert all(task.done() for task in tasks)
+
+    for url, statuses in results.items():
+        got_url, status = statuses[0]
+        assert got_url == url
+        assert status.healthy
+        assert status.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_multiprocess_checker_close_handles_all_results():
+    base_url, server = await start_server()
+    handled = []
+
+    async def slow_handler(url, value):
+        # WHY: statuses pile up on the pipes, as when publishing is slow
+        await asyncio.sleep(0.01)
+        handled.append(url)
+
+    checks = [
+        HealthCheck(url=f"{base_url}/{i}", period_sec=0.05)
+        for i in range(10)
+    ]
+    checker = MultiProcessChecker(
+        slow_handler, checks, processes=2, workers=10)
+    tasks = checker.start()
+
+    try:
+        await wait_for(lambda: len(handled) >= 50, 30)
+        await checker.close()
+        assert all(task.done() for task in tasks)
+        closed_with = len(handled)
+        await asyncio.sleep(0.2)
+        assert len(handled) == closed_with
+    finally:
+        await checker.close()
+        server.close()
+
+
+def test_multiprocess_checker_validation():
+
+    async def nop_handler(url, value):
+        pass
+
+    checks = [HealthCheck(url="http://valid_url", period_sec=1)]
+
+    with pytest.raises(InvalidParamsError):
+        MultiProcessChecker(nop_handler, checks, processes=0)
+    with pytest.raises(InvalidParamsError):
+        MultiProcessChecker(nop_handler, [], processes=1)
+    with pytest.raises(InvalidParamsError):
+        MultiProcessChecker(
+            nop_handler, [HealthCheck(url="invalid", period_sec=1)],
+            processes=1)
+    with pytest.raises(InvalidParamsError):
+        MultiProcessChecker(nop_handler, checks, processes=1, workers=0)
+    with pytest.raises(InvalidParamsError):
+        MultiProcessChecker(
+            nop_handler, checks, processes=1, offload_min_bytes=1024)
+    with pytest.raises(codec.InvalidEncodingError):
+        MultiProcessChecker(
+            nop_handler, checks, processes=1, encoding="nope")
@@ -1,14 +1,29 @@
+import re
 import time
+import asyncio
+import multiprocessing
 import pytest
 import httpx
+import httpcore
 from datetime import datetime
 from datetime import timezone
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
 from pytest_httpx import to_response
 
+from health.probes import CONDITIONAL_GET
+from health.probes import HEAD
+from health.probes import OFFLOAD_SLICE_CHARS
+from health.probes import Offload
+from health.probes import RANGED_GET
+from health.probes import compile_pattern
 from health.probes import http_probe
+from health.probes import http_probe_many
+from health.probes import new_pooled_client
 from health.status import HealthErrorKind
+from health.validators import ValidatorCache
 
 
 @pytest.mark.asyncio
@@ -73,6 +88,362 @@ async def test_http_probe_failure_on_multiple_regexes_not_matching(httpx_mock):
     assert_health_status_timestamp(res)
 
 
+@pytest.mark.asyncio
+async def test_http_probe_many_shares_a_single_request(httpx_mock):
+    url = "http://test_http_probe_many_shares_a_single_request"
+    response_body = "the response body"
+    httpx_mock.add_response(url=url, method="GET", data=response_body)
+    statuses = await http_probe_many(url, [
+        ["the", "body"],
+        None,
+        ["body", "nomatch"],
+        ["nomatch", "duh", "the"],
+    ])
+
+    assert len(httpx_mock.get_requests()) == 1
+    assert len(statuses) == 4
+
+    assert_healthy_result(statuses[0])
+    assert_healthy_result(statuses[1])
+    unmatched_list = [["nomatch"], ["nomatch", "duh"]]
+    for status, unmatched in zip(statuses[2:], unmatched_list):
+        assert not status.healthy
+        assert status.status_code == 200
+        assert status.error.kind == HealthErrorKind.REGEX
+        assert len(status.error.details) == len(unmatched)
+        for detail, pattern in zip(status.error.details, unmatched):
+            assert f"'{pattern}'" in detail
+        assert status.timestamp == statuses[0].timestamp
+
+
+@pytest.mark.asyncio
+async def test_http_probe_many_shares_http_errors(httpx_mock):
+    url = "http://test_http_probe_many_shares_http_errors"
+    httpx_mock.add_response(url=url, method="GET", status_code=503)
+    statuses = await http_probe_many(url, [["nomatch"], None])
+
+    assert len(httpx_mock.get_requests()) == 1
+    for status in statuses:
+        assert not status.healthy
+        assert status.status_code == 503
+        assert status.error.kind == HealthErrorKind.HTTP
+
+
+def test_compile_pattern():
+    literal = compile_pattern("healthy <b>")
+    regex = compile_pattern("health+y")
+
+    assert compile_pattern(literal) is literal
+    assert compile_pattern(regex) is regex
+    assert literal == compile_pattern("healthy <b>")
+    assert literal != compile_pattern("healthy")
+    assert (literal.pattern, literal.flags) == (
+        "healthy <b>", re.compile("healthy <b>").flags)
+
+    assert literal.search("is healthy <b>!") is not None
+    assert literal.search("is healthy") is None
+    assert regex.search("is healthyyy") is not None
+
+    with pytest.raises(re.error):
+        compile_pattern("(")
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__()
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_http_probe_offloads_big_bodies(httpx_mock):
+    url = "http://test_http_probe_offloads_big_bodies"
+    executor = CountingExecutor()
+    offload = Offload(executor=executor, min_bytes=1024)
+
+    httpx_mock.add_response(url=url, method="GET", data="small body")
+    res = await http_probe(url, ["body"], offload=offload)
+    assert_healthy_result(res)
+    assert executor.submitted == 0
+
+    httpx_mock.add_response(url=url, method="GET", data="x" * 2048 + "body")
+    res = await http_probe(url, ["body"], offload=offload)
+    assert_healthy_result(res)
+    res = await http_probe(url, ["nomatch"], offload=offload)
+    assert res.error.kind == HealthErrorKind.REGEX
+    assert executor.submitted > 0
+
+    # WHY: bodies are still matched if the executor is gone
+    executor.shutdown()
+    res = await http_probe(url, ["body"], offload=offload)
+    assert_healthy_result(res)
+
+
+@pytest.mark.asyncio
+async def test_http_probe_offloads_big_bodies_on_slices(httpx_mock):
+    chunk_size = 10000
+    chunks = 3 * OFFLOAD_SLICE_CHARS // chunk_size
+    # WHY: the match spans the two first slices
+    split_at = OFFLOAD_SLICE_CHARS // chunk_size
+
+    async def body():
+        for i in range(chunks):
+            chunk = b"x" * chunk_size
+            if i == split_at:
+                chunk = chunk[:-3] + b"spl"
+            if i == split_at + 1:
+                chunk = b"it match" + chunk[8:]
+            yield chunk
+
+    url = "http://test_http_probe_offloads_big_bodies_on_slices"
+    executor = CountingExecutor()
+    offload = Offload(executor=executor, min_bytes=1)
+
+    httpx_mock.add_response(url=url, method="GET", data=body())
+    res = await http_probe(url, ["split match", "nomatch"], offload=offload)
+    assert res.error.kind == HealthErrorKind.REGEX
+    assert executor.submitted == 3
+
+    executor.submitted = 0
+    httpx_mock.add_response(url=url, method="GET", data=body())
+    res = await http_probe(url, ["split match"], offload=offload)
+    assert_healthy_result(res)
+    assert executor.submitted == 2
+
+
+@pytest.mark.asyncio
+async def test_http_probe_offloads_to_processes(httpx_mock):
+    url = "http://test_http_probe_offloads_to_processes"
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        offload = Offload(executor=executor, min_bytes=1)
+        httpx_mock.add_response(url=url, method="GET", data="the body")
+        res = await http_probe(url, ["body", "t.e"], offload=offload)
+        assert res.healthy
+        res = await http_probe(url, ["nomatch"], offload=offload)
+        assert res.error.kind == HealthErrorKind.REGEX
+
+
+@pytest.mark.asyncio
+async def test_http_probe_offloading_keeps_loop_responsive(httpx_mock):
+    url = "http://test_http_probe_offloading_keeps_loop_responsive"
+    # WHY: takes a few hundred milliseconds to match, the
+    # pattern is tried at each position of the body.
+    body = "a" * 2_000_000
+    patterns = [compile_pattern("a{1,50}b")]
+
+    async def max_loop_block(offload):
+        httpx_mock.add_response(url=url, method="GET", data=body)
+        gaps = []
+
+        async def ticker():
+            loop = asyncio.get_running_loop()
+            while True:
+                start = loop.time()
+                await asyncio.sleep(0.001)
+                gaps.append(loop.time() - start)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        try:
+            res = await http_probe(url, patterns, offload=offload)
+            # WHY: the ticker must wake up to record the last gap
+            await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+        assert res.error.kind == HealthErrorKind.REGEX
+        return max(gaps)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        # WHY: the process is started before measuring
+        executor.submit(time.time).result()
+        offload = Offload(executor=executor, min_bytes=1)
+        inline = await max_loop_block(None)
+        offloaded = await max_loop_block(offload)
+
+    assert inline > 0.1
+    assert offloaded < inline / 4
+
+
+def test_pooled_client_fails_on_unsupported_httpcore(monkeypatch):
+
+    def pool_without_backend(self, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr(
+        httpcore.AsyncConnectionPool, "__init__", pool_without_backend)
+    with pytest.raises(RuntimeError):
+        new_pooled_client()
+
+
+@pytest.mark.asyncio
+async def test_http_probe_head(httpx_mock):
+    url = "http://test_http_probe_head"
+    httpx_mock.add_response(url=url, method="HEAD")
+    res = await http_probe(url, method=HEAD)
+
+    assert_healthy_result(res)
+    assert httpx_mock.get_request().method == "HEAD"
+
+
+@pytest.mark.asyncio
+async def test_http_probe_ranged_get(httpx_mock):
+    url = "http://test_http_probe_ranged_get"
+    httpx_mock.add_response(
+        url=url, method="GET", status_code=206, data="the")
+
+    res = await http_probe(url, method=RANGED_GET)
+    assert_healthy_result(res, 206)
+
+    res = await http_probe(
+        url, ["the"], max_body_bytes=100, method=RANGED_GET)
+    assert_healthy_result(res, 206)
+
+    ranges = [r.headers["Range"] for r in httpx_mock.get_requests()]
+    assert ranges == ["bytes=0-0", "bytes=0-99"]
+
+
+@pytest.mark.asyncio
+async def test_http_probe_conditional_get(httpx_mock):
+    url = "http://test_http_probe_conditional_get"
+    etag = '"v1"'
+
+    def conditional_response(request, *args, **kwargs):
+        if request.headers.get("If-None-Match") == etag:
+            return to_response(status_code=304)
+        return to_response(headers={"ETag": etag}, data="the body")
+
+    httpx_mock.add_callback(conditional_response, url=url, method="GET")
+    validators = ValidatorCache()
+
+    res = await http_probe(
+        url, ["body", "nomatch"], method=CONDITIONAL_GET,
+        validators=validators)
+    assert res.status_code == 200
+    assert res.error.kind == HealthErrorKind.REGEX
+
+    # WHY: the result of the patterns is reused when not modified
+    res = await http_probe(
+        url, ["body", "nomatch"], method=CONDITIONAL_GET,
+        validators=validators)
+    assert res.status_code == 304
+    assert res.error.kind == HealthErrorKind.REGEX
+    assert len(res.error.details) == 1
+
+    res = await http_probe(
+        url, ["body"], method=CONDITIONAL_GET, validators=validators)
+    assert_healthy_result(res, 304)
+
+    # WHY: patterns that haven't been matched yet need the body
+    res = await http_probe(
+        url, ["the"], method=CONDITIONAL_GET, validators=validators)
+    assert_healthy_result(res, 200)
+    res = await http_probe(
+        url, ["the", "body"], method=CONDITIONAL_GET, validators=validators)
+    assert_healthy_result(res, 304)
+
+    conditional = [
+        "If-None-Match" in r.headers for r in httpx_mock.get_requests()]
+    assert conditional == [False, True, True, False, True]
+
+    # WHY: without validators it is a plain GET
+    res = await http_probe(url, method=CONDITIONAL_GET)
+    assert_healthy_result(res, 200)
+
+
+@pytest.mark.asyncio
+async def test_http_probe_stops_reading_body_when_all_patterns_match(
+        httpx_mock):
+    chunks_read = []
+
+    async def body():
+        for chunk in [b"first chunk", b"second chunk", b"third chunk"]:
+            chunks_read.append(chunk)
+            yield chunk
+
+    url = "http://test_http_probe_stops_reading_body_when_all_patterns_match"
+    httpx_mock.add_response(url=url, method="GET", data=body())
+    res = await http_probe(url, ["first", "second"])
+
+    assert_healthy_result(res)
+    assert chunks_read == [b"first chunk", b"second chunk"]
+
+
+@pytest.mark.asyncio
+async def test_http_probe_matches_patterns_spanning_chunks(httpx_mock):
+
+    async def body():
+        yield b"padding " * 1024 + b"spl"
+        yield b"it match " + b"padding " * 1024
+
+    url = "http://test_http_probe_matches_patterns_spanning_chunks"
+    httpx_mock.add_response(url=url, method="GET", data=body())
+    res = await http_probe(url, ["split match"])
+
+    assert_healthy_result(res)
+
+
+@pytest.mark.asyncio
+async def test_http_probe_context_patterns_match_on_whole_body(httpx_mock):
+
+    async def body():
+        for _ in range(50):
+            yield b"a" * 4000
+        yield b"xyz"
+
+    url = "http://test_http_probe_context_patterns_match_on_whole_body"
+    text = "a" * 200000 + "xyz"
+    patterns = ["a$", "^xyz", r"\bxyz", "a(?=x)", "^a+xyz$", r"z\Z"]
+    for pattern in patterns:
+        httpx_mock.add_response(url=url, method="GET", data=body())
+        res = await http_probe(url, [pattern])
+        # WHY: the chunks searched start and end in the middle of the
+        # body, the result must be the same of searching the whole body.
+        assert res.healthy == (re.search(pattern, text) is not None), pattern
+
+
+@pytest.mark.asyncio
+async def test_http_probe_decodes_body_like_httpx(httpx_mock):
+    url = "http://test_http_probe_decodes_body_like_httpx"
+    body = "café crème".encode("cp1252")
+
+    httpx_mock.add_response(url=url, method="GET", data=body)
+    res = await http_probe(url, ["café"])
+    assert_healthy_result(res)
+
+    httpx_mock.add_response(
+        url=url, method="GET", data="café".encode("utf-8"))
+    res = await http_probe(url, ["café"])
+    assert_healthy_result(res)
+
+    httpx_mock.add_response(
+        url=url, method="GET", data="café".encode("utf-16"),
+        headers={"Content-Type": "text/html; charset=utf-16"})
+    res = await http_probe(url, ["café"])
+    assert_healthy_result(res)
+
+
+@pytest.mark.asyncio
+async def test_http_probe_limits_body_bytes_read(httpx_mock):
+    url = "http://test_http_probe_limits_body_bytes_read"
+    response_body = "the response body"
+    httpx_mock.add_response(url=url, method="GET", data=response_body)
+    res = await http_probe(url, ["the", "body"], max_body_bytes=8)
+
+    assert not res.healthy
+    assert res.status_code == 200
+    assert res.error.kind == HealthErrorKind.REGEX
+    assert len(res.error.details) == 1
+    assert "body" in res.error.details[0]
+    assert "first 8 bytes" in res.error.details[0]
+
+    assert_health_status_timestamp(res)
+
+
 @pytest.mark.asyncio
 async def test_http_probe_failure_on_4XX_5XX(httpx_mock):
     url = "http://test_http_probe_failure"
@@ -144,6 +515,109 @@ async def test_http_probe_has_response_time_in_ms(httpx_mock):
     assert response_delay_ms <= res.response_time_ms <= max_response_delay_ms
 
 
+@pytest.mark.asyncio
+async def test_http_probe_cold_never_reuses_connection():
+    url, stop_server = await start_keepalive_server()
+    try:
+        for _ in range(3):
+            res = await http_probe(url)
+            assert_healthy_result(res)
+            assert not res.connection_reused
+    finally:
+        await stop_server()
+
+
+@pytest.mark.asyncio
+async def test_http_probe_warm_reuses_connection():
+    url, stop_server = await start_keepalive_server()
+    client = new_pooled_client()
+    try:
+        res = await http_probe(url, client=client)
+        assert_healthy_result(res)
+        assert not res.connection_reused
+
+        for _ in range(3):
+            res = await http_probe(url, ["ok"], client=client)
+            assert_healthy_result(res)
+            assert res.connection_reused
+    finally:
+        await client.aclose()
+        await stop_server()
+
+
+@pytest.mark.asyncio
+async def test_http_probe_has_timings_of_each_phase():
+    url, stop_server = await start_keepalive_server()
+    url = url.replace("127.0.0.1", "localhost")
+    client = new_pooled_client()
+    try:
+        res = await http_probe(url, client=client)
+        assert_healthy_result(res)
+        timings = res.timings
+        assert timings.dns_ms > 0
+        assert timings.connect_ms > 0
+        assert timings.tls_ms is None
+        assert timings.ttfb_ms > 0
+        assert timings.total_ms >= timings.dns_ms + timings.connect_ms
+
+        res = await http_probe(url, client=client)
+        assert_healthy_result(res)
+        assert res.connection_reused
+        timings = res.timings
+        assert timings.dns_ms is None
+        assert timings.connect_ms is None
+        assert timings.tls_ms is None
+        assert 0 < timings.ttfb_ms <= timings.total_ms
+    finally:
+        await client.aclose()
+        await stop_server()
+
+
+@pytest.mark.asyncio
+async def test_http_probe_has_timings_on_failure():
+    url, stop_server = await start_keepalive_server()
+    await stop_server()
+
+    res = await http_probe(url)
+
+    assert not res.healthy
+    assert res.response_time_ms == 0
+    assert res.timings.dns_ms > 0
+    assert res.timings.connect_ms is None
+    assert res.timings.ttfb_ms is None
+    assert res.timings.total_ms > 0
+
+
+async def start_keepalive_server(body=b"ok"):
+    handlers = set()
+
+    async def handle(reader, writer):
+        handlers.add(asyncio.current_task())
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\n")
+                writer.write(b"Content-Length: %d\r\n\r\n" % len(body))
+                writer.write(body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def stop():
+        server.close()
+        await server.wait_closed()
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    return f"http://127.0.0.1:{port}/", stop
+
+
 def assert_healthy_result(res, status_code=200):
     assert res.healthy
     assert res.status_code == status_code
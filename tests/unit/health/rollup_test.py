@@ -0,0 +1,117 @@
+import math
+import pytest
+from datetime import datetime
+
+from health.rollup import LATENCY_BOUNDS_MS
+from health.rollup import LATENCY_BUCKETS
+from health.errors import InvalidParamsError
+from health.rollup import Rollup
+from health.rollup import latency_bucket
+from health.rollup import latency_percentile
+from health.rollup import merge_sketches
+from health.rollup import rollup
+
+
+def record(timestamp, target_id=1, healthy=True, status_code=200,
+           response_time_ms=10, error_kind=None):
+    return (
+        timestamp,
+        target_id,
+        healthy,
+        status_code,
+        response_time_ms,
+        False,
+        error_kind,
+        None,
+    )
+
+
+def sketch(*response_times_ms):
+    s = [0] * LATENCY_BUCKETS
+    for response_time_ms in response_times_ms:
+        s[latency_bucket(response_time_ms)] += 1
+    return s
+
+
+def test_rollup():
+    records = [
+        record(datetime(2020, 10, 24, 13, 37, 1), response_time_ms=10),
+        record(datetime(2020, 10, 24, 13, 37, 59), response_time_ms=20),
+        record(datetime(2020, 10, 24, 13, 38, 0), healthy=False,
+               status_code=500, response_time_ms=30, error_kind="http"),
+        record(datetime(2020, 10, 24, 13, 38, 1), healthy=False,
+               status_code=0, response_time_ms=0, error_kind="timeout"),
+        record(datetime(2020, 10, 24, 13, 38, 2), target_id=2),
+    ]
+
+    got = sorted(rollup(records, "minutely"))
+    assert got == [
+        Rollup(
+            bucket=datetime(2020, 10, 24, 13, 37),
+            target_id=1,
+            count=2,
+            healthy_count=2,
+            error_counts=[0, 0, 0, 0],
+            latency_sketch=sketch(10, 20),
+        ),
+        Rollup(
+            bucket=datetime(2020, 10, 24, 13, 38),
+            target_id=1,
+            count=2,
+            healthy_count=0,
+            error_counts=[0, 1, 0, 1],
+            latency_sketch=sketch(30),
+        ),
+        Rollup(
+            bucket=datetime(2020, 10, 24, 13, 38),
+            target_id=2,
+            count=1,
+            healthy_count=1,
+            error_counts=[0, 0, 0, 0],
+            latency_sketch=sketch(10),
+        ),
+    ]
+
+    got = sorted(rollup(records, "hourly"))
+    assert len(got) == 2
+    assert got[0].bucket == datetime(2020, 10, 24, 13)
+    assert got[0].count == 4
+    assert got[0].healthy_count == 2
+    assert got[0].latency_sketch == sketch(10, 20, 30)
+
+
+def test_rollup_invalid_resolution():
+    with pytest.raises(InvalidParamsError):
+        rollup([], "weekly")
+
+
+def test_latency_buckets():
+    assert latency_bucket(0) == 0
+    assert latency_bucket(1) == 0
+    for i, bound in enumerate(LATENCY_BOUNDS_MS):
+        assert latency_bucket(bound) == i
+        assert latency_bucket(bound + 1) == i + 1
+        if i > 0:
+            # WHY: each bucket upper bound is at most 20% bigger
+            # than the previous one (ignoring rounding).
+            assert bound <= math.ceil(LATENCY_BOUNDS_MS[i - 1] * 1.2) + 1
+    assert latency_bucket(LATENCY_BOUNDS_MS[-1] + 1) == LATENCY_BUCKETS - 1
+
+
+def test_latency_percentile():
+    assert latency_percentile([0] * LATENCY_BUCKETS, 50) is None
+
+    s = sketch(*range(1, 101))
+    for percentile in (50, 95, 99, 100):
+        got = latency_percentile(s, percentile)
+        assert percentile <= got <= percentile * 1.2 + 1
+
+    s = sketch(LATENCY_BOUNDS_MS[-1] + 1)
+    assert latency_percentile(s, 99) == math.inf
+
+
+def test_merge_sketches():
+    merged = merge_sketches(sketch(1, 100), sketch(100, 5000), sketch())
+    assert merged == sketch(1, 100, 100, 5000)
+    assert latency_percentile(merged, 50) == latency_percentile(
+        sketch(100), 50)
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import pytest
+import subprocess
+
+from health.checker import HealthCheck
+from health.errors import InvalidParamsError
+from health.sharding import Shards
+
+
+URLS = [f"https://site{i}.com/health" for i in range(1000)]
+
+
+def owners(shards):
+    return {url: shards.owner(url) for url in URLS}
+
+
+def test_shards_split_checks():
+    names = ["a", "b", "c", "d"]
+    shards = Shards(names)
+    checks = [HealthCheck(url=url, period_sec=1) for url in URLS]
+
+    selected = []
+    for name in names:
+        shard_checks = shards.select(checks, name)
+        # WHY: each shard should get about 1/4 of the checks
+        assert 150 <= len(shard_checks) <= 350
+        selected.extend(shard_checks)
+
+    assert sorted(selected) == sorted(checks)
+
+
+def test_shards_minimal_movement():
+    before = owners(Shards(["a", "b", "c", "d"]))
+
+    after = owners(Shards(["a", "b", "c", "d", "e"]))
+    moved = [url for url in URLS if before[url] != after[url]]
+    assert all(after[url] == "e" for url in moved)
+    assert 100 <= len(moved) <= 300
+
+    after = owners(Shards(["a", "c", "d"]))
+    moved = [url for url in URLS if before[url] != after[url]]
+    assert all(before[url] == "b" for url in moved)
+    assert moved == [url for url in URLS if before[url] == "b"]
+
+    # WHY: the order of the names doesn't matter.
+    assert before == owners(Shards(["d", "c", "b", "a"]))
+
+
+def test_shards_are_stable_across_processes():
+    code = (
+        "import sys, json\n"
+        "from health.sharding import Shards\n"
+        "shards = Shards(['a', 'b', 'c'])\n"
+        "urls = json.loads(sys.stdin.read())\n"
+        "print(json.dumps([shards.owner(url) for url in urls]))\n"
+    )
+    want = [Shards(["a", "b", "c"]).owner(url) for url in URLS]
+
+    for seed in ("1", "2"):
+        env = dict(os.environ)
+        env["PYTHONHASHSEED"] = seed
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        res = subprocess.run(
+            [sys.executable, "-c", code],
+            input=json.dumps(URLS),
+            capture_output=True,
+            text=True,
+            env=env,
+            check=True,
+        )
+        assert json.loads(res.stdout) == want
+
+
+def test_shards_validation():
+    with pytest.raises(InvalidParamsError):
+        Shards([])
+    with pytest.raises(InvalidParamsError):
+        Shards(["a", "a"])
+    with pytest.raises(InvalidParamsError):
+        Shards(["a", ""])
+    with pytest.raises(InvalidParamsError):
+        Shards(["a"]).select([], "b")
@@ -0,0 +1,148 @@
+import pytest
+from datetime import datetime
+from datetime import timedelta
+
+from health.storage import DEFAULT_PARTITION
+from health.storage import Partition
+from health.storage import PostgreSQLStore
+from health.storage import PostgreSQLStoreError
+from health.storage import expired_partitions
+from health.storage import partitions_ahead
+
+
+def test_daily_partitions_ahead():
+    now = datetime(2020, 12, 31, 13, 37, 10)
+    got = partitions_ahead(now, "daily", 2)
+    want = [
+        Partition(
+            name="spyglass_health_status_p20201231",
+            start=datetime(2020, 12, 31),
+            end=datetime(2021, 1, 1),
+        ),
+        Partition(
+            name="spyglass_health_status_p20210101",
+            start=datetime(2021, 1, 1),
+            end=datetime(2021, 1, 2),
+        ),
+        Partition(
+            name="spyglass_health_status_p20210102",
+            start=datetime(2021, 1, 2),
+            end=datetime(2021, 1, 3),
+        ),
+    ]
+    assert got == want
+
+
+def test_hourly_partitions_ahead():
+    now = datetime(2020, 10, 24, 23, 0, 0)
+    got = partitions_ahead(now, "hourly", 1)
+    want = [
+        Partition(
+            name="spyglass_health_status_p2020102423",
+            start=datetime(2020, 10, 24, 23),
+            end=datetime(2020, 10, 25, 0),
+        ),
+        Partition(
+            name="spyglass_health_status_p2020102500",
+            start=datetime(2020, 10, 25, 0),
+            end=datetime(2020, 10, 25, 1),
+        ),
+    ]
+    assert got == want
+
+
+def test_expired_partitions():
+    names = [
+        "spyglass_health_status_p20201020",
+        "spyglass_health_status_p20201022",
+        "spyglass_health_status_p20201021",
+        "spyglass_health_status_p20201023",
+        "spyglass_health_status_p2020102312",
+        "spyglass_health_status_pinvalid",
+        "spyglass_health_status_legacy",
+        "spyglass_health_status_default",
+        "whatever",
+    ]
+    oldest = datetime(2020, 10, 22, 10)
+    got = expired_partitions(names, "daily", oldest)
+    assert got == [
+        "spyglass_health_status_p20201020",
+        "spyglass_health_status_p20201021",
+    ]
+
+    got = expired_partitions(names, "hourly", oldest + timedelta(days=10))
+    assert got == ["spyglass_health_status_p2020102312"]
+
+
+def test_invalid_partition_interval():
+    with pytest.raises(PostgreSQLStoreError):
+        partitions_ahead(datetime.utcnow(), "weekly", 1)
+    with pytest.raises(PostgreSQLStoreError):
+        expired_partitions([], "weekly", datetime.utcnow())
+
+
+class FakePool:
+    """
+    Records the statements executed, the pool and its connections
+    are the same object since only the statements matter.
+    """
+
+    def __init__(self, existent):
+        self.existent = existent
+        self.statements = []
+
+    async def fetchval(self, query, *args):
+        return self.existent
+
+    async def execute(self, query, *args):
+        self.statements.append((" ".join(query.split()), args))
+
+    def acquire(self):
+        return self
+
+    def transaction(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+@pytest.mark.asyncio
+async def test_manage_partitions_handles_out_of_range_statuses(monkeypatch):
+    pool = FakePool(existent=[])
+
+    async def create_pool(*args, **kwargs):
+        return pool
+
+    monkeypatch.setattr("health.storage.asyncpg.create_pool", create_pool)
+    store = PostgreSQLStore("postgres://fake")
+    await store.connect()
+
+    created, dropped = await store.manage_partitions(
+        "daily", 1, timedelta(days=7))
+    assert created[0] == DEFAULT_PARTITION
+    assert len(created) == 3
+    assert dropped == []
+
+    # WHY: a status out of the range of the existent partitions (eg:
+    # clock skew) is saved on the default partition instead of failing
+    # the whole batch, and moved when its partition is created.
+    default = "PARTITION OF spyglass_health_status DEFAULT"
+    assert any(default in sql for sql, _ in pool.statements)
+
+    out_of_range = datetime.utcnow() + timedelta(days=1, minutes=1)
+    moved = [
+        args for sql, args in pool.statements
+        if sql.startswith(f"WITH moved AS ( DELETE FROM {DEFAULT_PARTITION}")
+    ]
+    assert len(moved) == 2
+    assert any(start <= out_of_range < end for start, end in moved)
+
+    pool.statements = []
+    pool.existent = created
+    created, _ = await store.manage_partitions("daily", 1)
+    assert DEFAULT_PARTITION not in created
+    assert not any(default in sql for sql, _ in pool.statements)
@@ -0,0 +1,48 @@
+import pytest
+
+from health.errors import InvalidParamsError
+from health.validators import ValidatorCache
+from health.validators import Validators
+
+
+def validators(etag, searched=(), unmatched=(), truncated=False):
+    return Validators(
+        etag=etag,
+        last_modified=None,
+        searched=frozenset(searched),
+        unmatched=frozenset(unmatched),
+        truncated=truncated,
+    )
+
+
+def test_validator_cache_merges_results_of_same_content():
+    cache = ValidatorCache()
+
+    cache.update("url", validators('"v1"', ["a", "b"], ["b"]))
+    cache.update("url", validators('"v1"', ["b", "c"], ["c"]))
+    assert cache.get("url") == validators('"v1"', ["a", "b", "c"], ["c"])
+
+    cache.update("url", validators('"v2"', ["a"], [], truncated=True))
+    assert cache.get("url") == validators('"v2"', ["a"], [], truncated=True)
+
+    cache.update("url", validators(None))
+    assert cache.get("url") is None
+
+
+def test_validator_cache_evicts_least_recently_updated():
+    cache = ValidatorCache(max_entries=2)
+
+    for url in ["a", "b", "a", "c"]:
+        cache.update(url, validators('"v1"'))
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+    cache.clear()
+    assert cache.get("a") is None
+
+
+def test_validator_cache_validation():
+    with pytest.raises(InvalidParamsError):
+        ValidatorCache(max_entries=0)